@@ -0,0 +1,58 @@
+"""In-memory checkpointer for benchmarks which imitates database round trips"""
+import asyncio
+from collections.abc import AsyncIterator, Sequence
+from typing import Any, Dict, Optional
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import ChannelVersions, Checkpoint, CheckpointMetadata, CheckpointTuple
+from langgraph.checkpoint.memory import MemorySaver
+
+
+class LatencyMemorySaver(MemorySaver):
+    """MemorySaver whose async reads and writes take `latency` seconds. Calls are counted to compare database load"""
+
+    def __init__(self, latency: float = 0.0) -> None:
+        super().__init__()
+        self.latency = latency
+        self.calls = 0
+
+    async def _round_trip(self) -> None:
+        self.calls += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        await self._round_trip()
+        return await super().aget_tuple(config)
+
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        await self._round_trip()
+        async for checkpoint in super().alist(config, filter=filter, before=before, limit=limit):
+            yield checkpoint
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        await self._round_trip()
+        return await super().aput(config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        await self._round_trip()
+        await super().aput_writes(config, writes, task_id, task_path)
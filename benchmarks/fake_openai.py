@@ -0,0 +1,254 @@
+"""
+Fake OpenAI-compatible API for benchmarks: chat completions (streamed and not) with configurable latency and token rate,
+imitation of prompt caching and deterministic embeddings. Run with `python -m benchmarks.fake_openai --port 8901`.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, List
+
+import numpy as np
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+
+# Name of the knowledge base tool which the fake model calls, see src/agentic/agents/manager/tools/retrieval.py
+RETRIEVAL_TOOL_NAME = "AllSeeTeamInfoRetriever"
+# Start of the system message with prefetched knowledge base sections, see src/agentic/agents/manager/context.py
+CONTEXT_MESSAGE_PREFIX = "Сведения из базы знаний AllSee"
+
+REPLY_WORDS = (
+    "AllSee", "разрабатывает", "чат-боты", "и", "ИИ-ассистентов", "для", "бизнеса", "в", "разных", "сферах", "мы",
+    "помогаем", "автоматизировать", "поддержку", "клиентов", "продажи", "и", "внутренние", "процессы", "компании",
+)
+
+
+@dataclass
+class FakeModelConfig:
+    """Behaviour of the fake model"""
+    latency: float = 0.5
+    tokens_per_second: float = 50.0
+    reply_tokens: int = 60
+    tool_call_rate: float = 0.5
+    embedding_latency: float = 0.05
+    embedding_size: int = 256
+    stall_rate: float = 0.0
+    stall_seconds: float = 10.0
+    error_rate: float = 0.0
+
+
+def _completion_id() -> str:
+    return f"chatcmpl-{uuid.uuid4().hex[:24]}"
+
+
+def _reply_tokens(config: FakeModelConfig) -> List[str]:
+    return [random.choice(REPLY_WORDS) + " " for _ in range(config.reply_tokens)]
+
+
+def _should_call_tool(body: Dict[str, Any], config: FakeModelConfig) -> bool:
+    """
+    Call the retrieval tool only in response to a user message and only if it is available.
+    The model answers at once if the prompt already has knowledge base sections for the message
+    """
+    tools = {tool.get("function", {}).get("name") for tool in body.get("tools") or []}
+    messages = body.get("messages") or []
+    has_context = any(
+        message.get("role") == "system" and str(message.get("content") or "").startswith(CONTEXT_MESSAGE_PREFIX) for message in messages
+    )
+    return (
+        RETRIEVAL_TOOL_NAME in tools and bool(messages) and messages[-1].get("role") == "user" and not has_context
+        and random.random() < config.tool_call_rate
+    )
+
+
+def _message_tokens(message: Dict[str, Any]) -> int:
+    return len(str(message.get("content") or "")) // 3 + 4
+
+
+class PromptCache:
+    """
+    Imitation of provider prompt caching: a prompt prefix (tools and whole messages) which was sent before is cached,
+    if it is at least MIN_TOKENS long. The least recently used prefixes are dropped above max_prefixes
+    """
+    MIN_TOKENS = 1024
+
+    def __init__(self, max_prefixes: int = 100_000) -> None:
+        self.max_prefixes = max_prefixes
+        self._prefixes: "OrderedDict[str, None]" = OrderedDict()
+
+    def cached_tokens(self, body: Dict[str, Any]) -> int:
+        """Remember prefixes of the prompt and return number of tokens of the longest one which was cached"""
+        digest = hashlib.sha256(json.dumps(body.get("tools") or [], sort_keys=True).encode("utf-8"))
+        tokens = cached = 0
+        for message in body.get("messages") or []:
+            digest.update(json.dumps(message, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+            tokens += _message_tokens(message)
+            key = digest.hexdigest()
+            if key in self._prefixes:
+                self._prefixes.move_to_end(key)
+                cached = tokens
+            else:
+                self._prefixes[key] = None
+        while len(self._prefixes) > self.max_prefixes:
+            self._prefixes.popitem(last=False)
+        return cached if cached >= self.MIN_TOKENS else 0
+
+
+def _usage(body: Dict[str, Any], completion_tokens: int, cached_tokens: int = 0) -> Dict[str, Any]:
+    prompt_tokens = sum(_message_tokens(message) for message in body.get("messages") or [])
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": cached_tokens},
+    }
+
+
+def _tool_call() -> Dict[str, Any]:
+    return {
+        "id": f"call_{uuid.uuid4().hex[:24]}",
+        "type": "function",
+        "function": {"name": RETRIEVAL_TOOL_NAME, "arguments": json.dumps({"query": "Какие услуги оказывает AllSee?"}, ensure_ascii=False)},
+    }
+
+
+def create_fake_openai_app(config: FakeModelConfig) -> Starlette:
+    """Create ASGI app of the fake API"""
+    prompt_cache = PromptCache()
+
+    async def chat_completions(request: Request) -> Response:
+        body = await request.json()
+        model = body.get("model", "fake")
+        if random.random() < config.error_rate:
+            return JSONResponse({"error": {"message": "Fake server error", "type": "server_error"}}, status_code=500)
+        call_tool = _should_call_tool(body, config)
+        cached_tokens = prompt_cache.cached_tokens(body)
+        tokens = [] if call_tool else _reply_tokens(config)
+        # Stalled requests imitate a provider which accepted the request but is slow to answer
+        await asyncio.sleep(config.stall_seconds if random.random() < config.stall_rate else config.latency)
+
+        if not body.get("stream"):
+            await asyncio.sleep(len(tokens) / config.tokens_per_second)
+            message: Dict[str, Any] = {"role": "assistant", "content": "".join(tokens) or None}
+            if call_tool:
+                message["tool_calls"] = [_tool_call()]
+            return JSONResponse({
+                "id": _completion_id(),
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if call_tool else "stop"}],
+                "usage": _usage(body, max(len(tokens), 1), cached_tokens),
+            })
+
+        completion_id = _completion_id()
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+        def chunk(delta: Dict[str, Any], finish_reason: Any = None) -> str:
+            data = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+        async def stream() -> AsyncIterator[str]:
+            yield chunk({"role": "assistant", "content": ""})
+            if call_tool:
+                yield chunk({"tool_calls": [{"index": 0, **_tool_call()}]})
+                yield chunk({}, "tool_calls")
+            else:
+                for token in tokens:
+                    await asyncio.sleep(1 / config.tokens_per_second)
+                    yield chunk({"content": token})
+                yield chunk({}, "stop")
+            if include_usage:
+                usage = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                         "choices": [], "usage": _usage(body, max(len(tokens), 1), cached_tokens)}
+                yield f"data: {json.dumps(usage)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    async def embeddings(request: Request) -> Response:
+        body = await request.json()
+        inputs = body["input"]
+        # Input is a string, a list of strings or a list of token lists
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        await asyncio.sleep(config.embedding_latency)
+
+        data = []
+        for index, item in enumerate(inputs):
+            seed = int.from_bytes(hashlib.sha256(json.dumps(item, ensure_ascii=False).encode("utf-8")).digest()[:8], "little")
+            vector = np.random.default_rng(seed).standard_normal(config.embedding_size).astype(np.float32)
+            vector /= np.linalg.norm(vector)
+            if body.get("encoding_format") == "base64":
+                embedding: Any = base64.b64encode(vector.tobytes()).decode("ascii")
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": index, "embedding": embedding})
+        tokens = sum(len(item) if isinstance(item, list) else len(item) // 3 + 1 for item in inputs)
+        return JSONResponse({
+            "object": "list",
+            "data": data,
+            "model": body.get("model", "fake"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    async def healthz(request: Request) -> Response:
+        return JSONResponse({"status": "ok"})
+
+    return Starlette(routes=[
+        Route("/v1/chat/completions", chat_completions, methods=["POST"]),
+        Route("/v1/embeddings", embeddings, methods=["POST"]),
+        Route("/healthz", healthz, methods=["GET"]),
+    ])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible API for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8901)
+    parser.add_argument("--latency", type=float, default=FakeModelConfig.latency, help="Time to the first token in seconds")
+    parser.add_argument("--tokens-per-second", type=float, default=FakeModelConfig.tokens_per_second)
+    parser.add_argument("--reply-tokens", type=int, default=FakeModelConfig.reply_tokens)
+    parser.add_argument("--tool-call-rate", type=float, default=FakeModelConfig.tool_call_rate,
+                        help="Probability that the model calls the knowledge base tool in response to a user message")
+    parser.add_argument("--embedding-latency", type=float, default=FakeModelConfig.embedding_latency)
+    parser.add_argument("--embedding-size", type=int, default=FakeModelConfig.embedding_size)
+    parser.add_argument("--stall-rate", type=float, default=FakeModelConfig.stall_rate,
+                        help="Probability that a chat completion starts after --stall-seconds instead of --latency")
+    parser.add_argument("--stall-seconds", type=float, default=FakeModelConfig.stall_seconds)
+    parser.add_argument("--error-rate", type=float, default=FakeModelConfig.error_rate,
+                        help="Probability that a chat completion fails with 500 Internal Server Error")
+    args = parser.parse_args()
+
+    config = FakeModelConfig(
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        reply_tokens=args.reply_tokens,
+        tool_call_rate=args.tool_call_rate,
+        embedding_latency=args.embedding_latency,
+        embedding_size=args.embedding_size,
+        stall_rate=args.stall_rate,
+        stall_seconds=args.stall_seconds,
+        error_rate=args.error_rate,
+    )
+    uvicorn.run(create_fake_openai_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
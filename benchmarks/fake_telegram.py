@@ -0,0 +1,84 @@
+import asyncio
+import json
+import random
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+from telegram.request import BaseRequest, RequestData
+
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Benchmark bot", "username": "benchmark_bot"}
+
+
+class FakeTelegramRequest(BaseRequest):
+    """
+    Request backend of python-telegram-bot which answers Bot API calls locally with the given latency.
+    It records sent and edited messages of every chat, so reply latency can be measured.
+    A share of requests (flood_rate) can be answered with 429 Too Many Requests to exercise flood control handling.
+    """
+
+    def __init__(self, latency: float = 0.0, flood_rate: float = 0.0, flood_retry_after: int = 1) -> None:
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_retry_after = flood_retry_after
+        self.calls: Counter = Counter()
+        self.sent_at: Dict[int, List[float]] = defaultdict(list)
+        self._message_id = 0
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _message(self, chat_id: Any, **fields: Any) -> Dict[str, Any]:
+        self._message_id += 1
+        message_id = fields.pop("message_id", None) or self._message_id
+        return {
+            "message_id": int(message_id),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": BOT_USER,
+            **fields,
+        }
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: Optional[RequestData] = None,
+        read_timeout: Any = None,
+        write_timeout: Any = None,
+        connect_timeout: Any = None,
+        pool_timeout: Any = None,
+    ) -> Tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] += 1
+        parameters = request_data.parameters if request_data is not None else {}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if endpoint != "getMe" and self.flood_rate and random.random() < self.flood_rate:
+            self.calls["429 Too Many Requests"] += 1
+            return 429, json.dumps({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.flood_retry_after}",
+                "parameters": {"retry_after": self.flood_retry_after},
+            }).encode("utf-8")
+
+        result: Any = True
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint in ("sendMessage", "editMessageText"):
+            result = self._message(parameters["chat_id"], message_id=parameters.get("message_id"), text=str(parameters.get("text", "")))
+        elif endpoint == "sendDocument":
+            result = self._message(parameters["chat_id"], document={"file_id": "benchmark-file", "file_unique_id": "benchmark-file"})
+
+        if endpoint in ("sendMessage", "editMessageText", "sendDocument"):
+            self.sent_at[int(parameters["chat_id"])].append(time.monotonic())
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
@@ -0,0 +1,171 @@
+"""
+Micro-benchmark and fuzz test of the Markdown to Telegram HTML converter (src/handlers/formatting.py).
+The benchmark compares the converter with the previous regex chain on typical bot replies and on texts built
+from the fuzz corpus (dense with formatting and edge cases), the fuzz test checks that every produced message
+is valid Telegram HTML within the length limit.
+Run with `python -m benchmarks.formatting --help`.
+"""
+import argparse
+import html
+import os
+import random
+import re
+import sys
+import time
+from pathlib import Path
+from typing import Callable, List, Optional
+
+
+DATA_DIR = Path(__file__).parent / "data"
+CORPUS_PATH = DATA_DIR / "formatting_corpus.txt"
+REPLIES_PATH = DATA_DIR / "formatting_replies.txt"
+TEXT_SEPARATOR = "\n%%\n"
+
+# Fragments which are mixed into the corpus by the fuzz test
+FUZZ_FRAGMENTS = (
+    "*", "**", "_", "__", "`", "```", "<", ">", "&", ";", "<b>", "</b>", "<i>", "</i>", "<a href=\"https://a.b/?x=1&y=2\">",
+    "</a>", "[", "]", "(", ")", "](https://allsee.team)", "# ", "\n", "\n\n", " ", "&amp;", "&#12", "<a href=", "слово", "😀",
+)
+
+# Texts which are always checked by the fuzz test: emoji take two UTF-16 code units of the Telegram limit
+FUZZ_CASES = ("😀" * 6000, "👍🏻 " * 2000, "**" + "😀" * 3000 + "**")
+
+TAG_PATTERN = re.compile(r'<(/?)(b|i|a)(?: href="[^"<>]*")?>')
+ENTITY_PATTERN = re.compile(r"&(?:lt|gt|amp|quot);")
+
+
+def legacy_convert_markdown_to_html(text: str) -> str:
+    """Previous converter: a chain of regular expressions without escaping, kept as the benchmark baseline"""
+    text = re.sub(r'\[(.*?)\]\((.*?)\)', r'<a href="\2">\1</a>', text)
+    text = re.sub(r'\*\*(.*?)\*\*|__(.*?)__', lambda m: f'<b>{m.group(1) or m.group(2)}</b>', text)
+    text = re.sub(r'(?<![a-zA-Z0-9/])\*((?!\*).+?)\*(?![a-zA-Z0-9/])|(?<![a-zA-Z0-9/.:@])_((?!_).+?)_(?![a-zA-Z0-9/])',
+                  lambda m: f'<i>{m.group(1) or m.group(2)}</i>', text)
+    text = re.sub(r'^#+\s+', '', text, flags=re.MULTILINE)
+    text = re.sub(r'`{1,3}(.*?)`{1,3}', r'\1', text, flags=re.DOTALL)
+    return text
+
+
+def load_texts(path: Path) -> List[str]:
+    return path.read_text(encoding="utf-8").split(TEXT_SEPARATOR)
+
+
+def check_telegram_html(message: str, limit: int) -> Optional[str]:
+    """Return description of the problem if the message is not valid Telegram HTML of the bot, None otherwise"""
+    if len(message.encode("utf-16-le")) // 2 > limit:
+        return f"message is longer than {limit} UTF-16 code units"
+    stack: List[str] = []
+    position = 0
+    text = []
+    for match in TAG_PATTERN.finditer(message):
+        text.append(message[position:match.start()])
+        position = match.end()
+        closing, name = match.group(1) == "/", match.group(2)
+        if not closing:
+            if name == "a" and "a" in stack:
+                return "nested link"
+            stack.append(name)
+        elif not stack or stack.pop() != name:
+            return f"unbalanced </{name}>"
+    text.append(message[position:])
+    if stack:
+        return f"unclosed <{stack[-1]}>"
+    plain = ENTITY_PATTERN.sub("", "".join(text))
+    if re.search(r"[<>]|&(?!#\d+;)", plain):
+        return "unescaped character"
+    if not html.unescape("".join(text)).strip():
+        return "empty message"
+    return None
+
+
+def fuzz_text(corpus: List[str], rng: random.Random) -> str:
+    parts = []
+    for _ in range(rng.randint(1, 40)):
+        if rng.random() < 0.5:
+            snippet = rng.choice(corpus)
+            start = rng.randrange(len(snippet))
+            parts.append(snippet[start:start + rng.randint(1, 200)])
+        else:
+            parts.append(rng.choice(FUZZ_FRAGMENTS))
+    # Some texts are long enough to be split into several messages
+    return "".join(parts) * rng.choice((1, 1, 1, 5, 20))
+
+
+def fuzz(iterations: int, seed: int, limit: int) -> int:
+    from src.handlers.formatting import convert_markdown_to_html_messages
+
+    rng = random.Random(seed)
+    corpus = load_texts(CORPUS_PATH)
+    failures = 0
+    cases = [(text, False) for text in FUZZ_CASES]
+    for iteration in range(iterations):
+        text = fuzz_text(corpus, rng)
+        partial = rng.random() < 0.3
+        if partial:
+            text = text[:rng.randint(1, len(text))]
+        cases.append((text, partial))
+    for iteration, (text, partial) in enumerate(cases):
+        for message in convert_markdown_to_html_messages(text, partial=partial, limit=limit):
+            problem = check_telegram_html(message, limit)
+            if problem is not None:
+                failures += 1
+                print(f"Iteration {iteration}: {problem}\n  input: {text[:300]!r}\n  output: {message[:300]!r}")
+                break
+    print(f"Fuzz: {len(cases)} texts, {failures} failures")
+    return failures
+
+
+def build_texts(snippets: List[str], length: int, rng: random.Random) -> List[str]:
+    texts = []
+    for _ in range(50):
+        text = ""
+        while len(text) < length:
+            text += rng.choice(snippets) + "\n\n"
+        texts.append(text)
+    return texts
+
+
+def benchmark(name: str, function: Callable[[str], object], texts: List[str], repeat: int) -> None:
+    started_at = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            function(text)
+    elapsed = time.perf_counter() - started_at
+    characters = sum(len(text) for text in texts) * repeat
+    print(f"{name:<28} {elapsed / (repeat * len(texts)) * 1e6:10.1f} us/reply {characters / elapsed / 1e6:8.2f} M chars/s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Micro-benchmark and fuzz test of the Markdown to Telegram HTML converter")
+    parser.add_argument("--repeat", type=int, default=200, help="How many times replies are converted")
+    parser.add_argument("--reply-length", type=int, default=1500, help="Approximate length of benchmark replies in characters")
+    parser.add_argument("--fuzz", type=int, default=2000, help="Number of random texts to check, 0 disables the fuzz test")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--limit", type=int, default=4096, help="Message length limit")
+    args = parser.parse_args()
+
+    # Settings are loaded on import of the handlers, the converter doesn't use them
+    for variable in ("TELEGRAM_BOT_TOKEN", "LLM_API_KEY", "EMBEDDER_API_KEY", "CHECKPOINTER_POSTGRES_PASSWORD"):
+        os.environ.setdefault(variable, "benchmark")
+    from src.handlers.formatting import convert_markdown_to_html, convert_markdown_to_html_messages
+
+    rng = random.Random(args.seed)
+    corpus = load_texts(CORPUS_PATH)
+    for title, snippets in (("Typical replies", load_texts(REPLIES_PATH)), ("Fuzz corpus", corpus)):
+        texts = build_texts(snippets, args.reply_length, rng)
+        print(f"{title}, {sum(len(text) for text in texts) // len(texts)} characters:")
+        benchmark("legacy regex chain", legacy_convert_markdown_to_html, texts, args.repeat)
+        benchmark("convert_markdown_to_html", convert_markdown_to_html, texts, args.repeat)
+        benchmark("  with splitting", convert_markdown_to_html_messages, texts, args.repeat)
+        benchmark("  partial (streaming)", lambda text: convert_markdown_to_html_messages(text, partial=True), texts, args.repeat)
+
+    invalid = sum(
+        check_telegram_html(legacy_convert_markdown_to_html(text), args.limit) is not None for text in corpus
+    )
+    print(f"Corpus: {invalid}/{len(corpus)} texts are invalid Telegram HTML after the legacy converter")
+
+    if args.fuzz and fuzz(args.fuzz, args.seed, args.limit):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,424 @@
+"""
+Offline load test of the bot: synthetic Telegram updates are processed by the real handlers, update processor and graph,
+while Telegram, the LLM and the embedder are replaced with local fakes. Run with `python -m benchmarks.load_test --help`.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+
+QUESTIONS = (
+    "Привет! Чем занимается AllSee?",
+    "Какие услуги вы оказываете?",
+    "Расскажите про ваши кейсы в ритейле",
+    "Сколько стоит разработка чат-бота?",
+    "С какими сферами вы работаете?",
+    "Какие преимущества даёт внедрение ИИ?",
+    "Как проходит работа с вами?",
+    "Какая у вас миссия?",
+)
+
+CORPUS_SECTIONS = (
+    "Почему мы?", "Кто мы?", "Наша миссия", "Профиль компании", "Философия", "Ценности", "Легенда и история",
+    "Сферы деятельности", "Портреты потребителей", "Этапы принятия решения", "Наши услуги", "Преимущества внедрения ИИ",
+)
+
+
+@dataclass
+class LevelResult:
+    """Result of the load test at one concurrency level"""
+    concurrency: int
+    messages: int
+    seconds: float
+    messages_per_second: float
+    latency_p50: float
+    latency_p95: float
+    latency_p99: float
+    first_reply_p50: float
+    first_reply_p95: float
+    unanswered: int
+    telegram_calls_per_message: float
+    rss_per_chat_kb: float
+    coalesced_turns: int = 0
+    llm_calls_saved: float = 0.0
+    context_turns: int = 0
+    retrieval_tool_turns: int = 0
+    cached_answers: int = 0
+    checkpointer_calls_per_message: float = 0.0
+    prompt_cache_read_share: float = 0.0
+    traced_heap_per_chat_kb: Optional[float] = None
+    telegram_calls: Dict[str, int] = field(default_factory=dict)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _rss_bytes() -> int:
+    """Resident set size of the process"""
+    try:
+        with open("/proc/self/status", "r", encoding="ascii") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return float("nan")
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[int(percent) - 1]
+
+
+def _write_corpus(source_dir: Path) -> None:
+    """Synthetic knowledge base with sections named like the real one"""
+    source_dir.mkdir(parents=True, exist_ok=True)
+    for file_index in range(3):
+        sections = [
+            f"# {title}\n" + " ".join(f"Текст раздела {title.lower()} номер {index}." for index in range(40))
+            for title in CORPUS_SECTIONS[file_index::3]
+        ]
+        (source_dir / f"part-{file_index}.md").write_text("\n\n".join(sections), encoding="utf-8")
+
+
+async def _start_fake_openai(args: argparse.Namespace, port: int) -> asyncio.subprocess.Process:
+    """Run the fake OpenAI-compatible API in a separate process, so it doesn't compete with the bot for the event loop"""
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "benchmarks.fake_openai",
+        "--port", str(port),
+        "--latency", str(args.llm_latency),
+        "--tokens-per-second", str(args.llm_tokens_per_second),
+        "--reply-tokens", str(args.reply_tokens),
+        "--tool-call-rate", str(args.tool_call_rate),
+        "--embedding-latency", str(args.embedding_latency),
+        "--stall-rate", str(args.llm_stall_rate),
+        "--stall-seconds", str(args.llm_stall_seconds),
+        "--error-rate", str(args.llm_error_rate),
+    )
+    async with httpx.AsyncClient() as client:
+        for _ in range(100):
+            try:
+                if (await client.get(f"http://127.0.0.1:{port}/healthz")).status_code == 200:
+                    return process
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Fake OpenAI API didn't start")
+
+
+def _configure_environment(args: argparse.Namespace, port: int, work_dir: Path) -> None:
+    """Point the bot settings to the fakes. Must be done before src modules are imported, settings are read on import"""
+    api_url = f"http://127.0.0.1:{port}/v1"
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": "123456:benchmark",
+        "TELEGRAM_BOT_STREAMING": str(args.streaming).lower(),
+        "TELEGRAM_BOT_MAX_CONCURRENT_UPDATES": str(args.max_concurrent_updates),
+        "TELEGRAM_BOT_COALESCE_WINDOW": str(args.coalesce_window),
+        "KNOWLEDGE_BASE_PREFETCH": str(args.prefetch).lower(),
+        "ANSWER_CACHE_ENABLED": str(args.answer_cache).lower(),
+        "CHECKPOINTER_CACHE_ENABLED": str(args.checkpoint_cache).lower(),
+        "ANSWER_CACHE_PATH": str(work_dir / "answer-cache.sqlite3"),
+        "LLM_BASE_API": api_url,
+        "LLM_API_KEY": "benchmark",
+        "EMBEDDER_BASE_API": api_url,
+        "EMBEDDER_API_KEY": "benchmark",
+        # Fake embeddings must never get into the cache of real ones
+        "EMBEDDER_CACHE_PATH": str(work_dir / "embedding-cache.sqlite3"),
+        "KNOWLEDGE_BASE_SOURCE_DIR": str(work_dir / "source"),
+        "KNOWLEDGE_BASE_CHROMA_DIR": str(work_dir / "chroma"),
+        "ANONYMIZED_TELEMETRY": "False",
+    })
+    if args.secondary_endpoint:
+        # Stalls and errors of the fake API are random, so the same API serves as the secondary endpoint
+        os.environ["LLM_SECONDARY_BASE_API"] = api_url
+    if not args.knowledge_base:
+        # The tool answers that the knowledge base is unavailable at once instead of waiting for its warm-up
+        os.environ["KNOWLEDGE_BASE_READY_WAIT_SECONDS"] = "0"
+    # Only used with --postgres, but required by settings
+    os.environ.setdefault("CHECKPOINTER_POSTGRES_PASSWORD", "benchmark")
+
+
+async def _run_level(
+    app: Any,
+    telegram: Any,
+    concurrency: int,
+    messages_per_chat: int,
+    chat_id_offset: int,
+    trace_heap: bool,
+    burst: int = 1,
+    burst_interval: float = 0.0,
+) -> LevelResult:
+    """
+    Run `concurrency` chats at the same time, every chat sends messages one after another waiting for replies.
+    With burst > 1 every message is sent as `burst` messages `burst_interval` seconds apart, like users who type a question in parts
+    """
+    from telegram import Update
+    from src.handlers.coalescing import llm_calls_saved, messages_coalesced
+    from src.agentic.agents.manager.manager import manager_turns
+    from src.agentic.agents.manager.answer_cache import answer_cache_requests
+    from src.settings import settings
+    from src.tracing import llm_tokens
+
+    latencies: List[float] = []
+    first_replies: List[float] = []
+    unanswered = 0
+    update_id = chat_id_offset * 1000
+    calls_before = telegram.calls.copy()
+    coalesced_before = sum(messages_coalesced.value(stage=stage) for stage in ("debounce", "run"))
+    llm_calls_saved_before = llm_calls_saved.value()
+    context_turns_before = manager_turns.value(retrieval="context")
+    retrieval_tool_turns_before = manager_turns.value(retrieval="tool")
+    cached_answers_before = answer_cache_requests.value(tenant=app.tenant.name, result="hit")
+    # Calls of the fake checkpointer behind the cache (if any), they stand for database round trips
+    saver = getattr(app.graph.checkpointer, "saver", app.graph.checkpointer)
+    checkpointer_calls_before = getattr(saver, "calls", 0)
+    input_tokens_before = llm_tokens.value(model=settings.llm.MODEL, type="input")
+    cache_read_tokens_before = llm_tokens.value(model=settings.llm.MODEL, type="cache_read")
+
+    async def send(chat_id: int) -> None:
+        nonlocal update_id
+        update_id += 1
+        update = Update.de_json(
+            {
+                "update_id": update_id,
+                "message": {
+                    "message_id": update_id,
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": {"id": chat_id, "is_bot": False, "first_name": "Benchmark"},
+                    "text": random.choice(QUESTIONS),
+                },
+            },
+            app.bot,
+        )
+        await app.update_processor.process_update(update, app.process_update(update))
+
+    async def chat(chat_id: int) -> None:
+        nonlocal unanswered
+        for _ in range(messages_per_chat):
+            replies_before = len(telegram.sent_at[chat_id])
+            submitted_at = time.monotonic()
+            sends = []
+            for index in range(burst):
+                if index:
+                    await asyncio.sleep(burst_interval)
+                sends.append(asyncio.create_task(send(chat_id)))
+            await asyncio.gather(*sends)
+            latencies.append(time.monotonic() - submitted_at)
+            replies = telegram.sent_at[chat_id][replies_before:]
+            if replies:
+                first_replies.append(replies[0] - submitted_at)
+            else:
+                unanswered += 1
+
+    gc.collect()
+    if trace_heap:
+        import tracemalloc
+        tracemalloc.start()
+    rss_before = _rss_bytes()
+    started_at = time.monotonic()
+    await asyncio.gather(*(chat(chat_id_offset + index) for index in range(concurrency)))
+    seconds = time.monotonic() - started_at
+    gc.collect()
+    rss_per_chat = (_rss_bytes() - rss_before) / concurrency / 1024
+    traced_heap_per_chat = None
+    if trace_heap:
+        import tracemalloc
+        traced_heap_per_chat = tracemalloc.get_traced_memory()[0] / concurrency / 1024
+        tracemalloc.stop()
+
+    messages = concurrency * messages_per_chat * burst
+    input_tokens = llm_tokens.value(model=settings.llm.MODEL, type="input") - input_tokens_before
+    cache_read_tokens = llm_tokens.value(model=settings.llm.MODEL, type="cache_read") - cache_read_tokens_before
+    calls = {method: count - calls_before.get(method, 0) for method, count in telegram.calls.items() if count - calls_before.get(method, 0)}
+    return LevelResult(
+        concurrency=concurrency,
+        messages=messages,
+        seconds=seconds,
+        messages_per_second=messages / seconds,
+        latency_p50=_percentile(latencies, 50),
+        latency_p95=_percentile(latencies, 95),
+        latency_p99=_percentile(latencies, 99),
+        first_reply_p50=_percentile(first_replies, 50),
+        first_reply_p95=_percentile(first_replies, 95),
+        unanswered=unanswered,
+        telegram_calls_per_message=sum(calls.values()) / messages,
+        rss_per_chat_kb=rss_per_chat,
+        coalesced_turns=int(sum(messages_coalesced.value(stage=stage) for stage in ("debounce", "run")) - coalesced_before),
+        llm_calls_saved=llm_calls_saved.value() - llm_calls_saved_before,
+        context_turns=int(manager_turns.value(retrieval="context") - context_turns_before),
+        retrieval_tool_turns=int(manager_turns.value(retrieval="tool") - retrieval_tool_turns_before),
+        cached_answers=int(answer_cache_requests.value(tenant=app.tenant.name, result="hit") - cached_answers_before),
+        checkpointer_calls_per_message=(getattr(saver, "calls", 0) - checkpointer_calls_before) / messages,
+        prompt_cache_read_share=cache_read_tokens / input_tokens if input_tokens else 0.0,
+        traced_heap_per_chat_kb=traced_heap_per_chat,
+        telegram_calls=calls,
+    )
+
+
+async def run(args: argparse.Namespace) -> List[LevelResult]:
+    port = args.fake_api_port or _free_port()
+    work_dir = Path(tempfile.mkdtemp(prefix="bot-benchmark-"))
+    _configure_environment(args, port, work_dir)
+    fake_openai = await _start_fake_openai(args, port)
+    try:
+        # Bot modules are imported only now, when settings point to the fakes
+        from telegram.ext import ApplicationBuilder
+
+        from src.agentic.knowledge_base import sync_index
+        from src.bot import build_application, build_state_graph
+        from src.settings import settings
+        from src.storage import create_checkpoint_cache
+        from src.tenants import load_tenants
+        from .fake_telegram import FakeTelegramRequest
+        from .fake_checkpointer import LatencyMemorySaver
+
+        def with_cache(checkpointer: Any) -> Any:
+            return create_checkpoint_cache(checkpointer) if settings.checkpointer.CACHE_ENABLED else checkpointer
+
+        tenant = next(iter(load_tenants()))
+        knowledge_base = tenant.knowledge_base
+        if args.knowledge_base:
+            _write_corpus(work_dir / "source")
+            await asyncio.to_thread(sync_index)
+            knowledge_base.start()
+            if not await knowledge_base.wait_ready(60):
+                raise RuntimeError(f"Knowledge base is not ready: {knowledge_base.last_error}")
+
+        telegram = FakeTelegramRequest(latency=args.telegram_latency, flood_rate=args.telegram_flood_rate)
+        # Updates are submitted by the test itself, so the application is built as in webhook mode
+        app = build_application(
+            tenant,
+            webhook_mode=True,
+            app_builder=ApplicationBuilder().request(telegram).get_updates_request(FakeTelegramRequest()),
+        )
+
+        results: List[LevelResult] = []
+        if args.postgres:
+            from src.storage import InstrumentedPostgresSaver, create_connection_pool
+            async with create_connection_pool(name="benchmark") as pool:
+                checkpointer = InstrumentedPostgresSaver(pool)
+                await checkpointer.setup()
+                app.graph = build_state_graph(tenant.manager_agent, tenant.retrieve_context, tenant.answer_cache).compile(
+                    checkpointer=with_cache(checkpointer),
+                )
+                results = await _run_levels(app, telegram, args)
+        else:
+            checkpointer = LatencyMemorySaver(args.checkpointer_latency)
+            app.graph = build_state_graph(tenant.manager_agent, tenant.retrieve_context, tenant.answer_cache).compile(
+                checkpointer=with_cache(checkpointer),
+            )
+            results = await _run_levels(app, telegram, args)
+
+        await knowledge_base.stop()
+        return results
+    finally:
+        fake_openai.terminate()
+        await fake_openai.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+async def _run_levels(app: Any, telegram: Any, args: argparse.Namespace) -> List[LevelResult]:
+    results = []
+    await app.initialize()
+    try:
+        for level_index, concurrency in enumerate(args.concurrency):
+            # Every level uses new chats, so they start with empty history
+            result = await _run_level(
+                app, telegram, concurrency, args.messages_per_chat, (level_index + 1) * 1_000_000, args.trace_heap,
+                burst=args.burst, burst_interval=args.burst_interval,
+            )
+            results.append(result)
+            _print_result(result)
+    finally:
+        await app.shutdown()
+    return results
+
+
+def _print_result(result: LevelResult) -> None:
+    heap = f", heap {result.traced_heap_per_chat_kb:.0f} KiB/chat" if result.traced_heap_per_chat_kb is not None else ""
+    print(
+        f"concurrency {result.concurrency:>4}: {result.messages} messages in {result.seconds:.1f}s, "
+        f"{result.messages_per_second:.2f} msg/s, latency p50/p95/p99 "
+        f"{result.latency_p50:.2f}/{result.latency_p95:.2f}/{result.latency_p99:.2f}s, "
+        f"first reply p50/p95 {result.first_reply_p50:.2f}/{result.first_reply_p95:.2f}s, "
+        f"unanswered {result.unanswered}, {result.telegram_calls_per_message:.1f} Bot API calls/msg, "
+        f"RSS {result.rss_per_chat_kb:.0f} KiB/chat{heap}, "
+        f"{result.coalesced_turns} turns coalesced, ~{result.llm_calls_saved:.0f} LLM calls saved, "
+        f"turns answered with prefetched context/retrieval tool {result.context_turns}/{result.retrieval_tool_turns}, "
+        f"{result.cached_answers} cached answers, {result.prompt_cache_read_share:.0%} of input tokens from prompt cache, "
+        f"{result.checkpointer_calls_per_message:.1f} checkpointer calls/msg",
+        flush=True,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline load test of the bot with fake Telegram, LLM and embedder")
+    parser.add_argument("--concurrency", type=lambda value: [int(level) for level in value.split(",")], default=[1, 8, 32],
+                        help="Comma-separated numbers of simultaneously active chats")
+    parser.add_argument("--messages-per-chat", type=int, default=5)
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Time to the first token of the fake LLM in seconds")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--reply-tokens", type=int, default=60)
+    parser.add_argument("--tool-call-rate", type=float, default=0.5)
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--llm-stall-rate", type=float, default=0.0, help="Share of LLM requests which start after --llm-stall-seconds")
+    parser.add_argument("--llm-stall-seconds", type=float, default=10.0)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="Share of LLM requests which fail with a server error")
+    parser.add_argument("--secondary-endpoint", action="store_true",
+                        help="Use the fake API as the secondary LLM endpoint for hedged requests and failover")
+    parser.add_argument("--telegram-latency", type=float, default=0.05, help="Latency of every fake Bot API call in seconds")
+    parser.add_argument("--telegram-flood-rate", type=float, default=0.0,
+                        help="Share of fake Bot API calls answered with 429 Too Many Requests (retry after 1 second)")
+    parser.add_argument("--burst", type=int, default=1, help="Every message is sent as this number of messages in a row")
+    parser.add_argument("--burst-interval", type=float, default=0.3, help="Interval between messages of a burst in seconds")
+    parser.add_argument("--coalesce-window", type=float, default=0.0,
+                        help="Time a turn waits for more messages of the chat (the bot default is 1.0, 0 only cancels turns which haven't replied)")
+    parser.add_argument("--prefetch", action=argparse.BooleanOptionalAction, default=True,
+                        help="Search the knowledge base for every message before the agent is called (needs --knowledge-base)")
+    parser.add_argument("--answer-cache", action=argparse.BooleanOptionalAction, default=True,
+                        help="Reply to repeated first questions of chats from the answer cache (needs --knowledge-base)")
+    parser.add_argument("--max-concurrent-updates", type=int, default=16)
+    parser.add_argument("--streaming", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--knowledge-base", action=argparse.BooleanOptionalAction, default=True,
+                        help="Index a synthetic knowledge base with the fake embedder (requires tiktoken encodings)")
+    parser.add_argument("--postgres", action="store_true", help="Use the PostgreSQL checkpointer from settings instead of MemorySaver")
+    parser.add_argument("--checkpointer-latency", type=float, default=0.0,
+                        help="Latency of every MemorySaver read and write in seconds, like a database round trip")
+    parser.add_argument("--checkpoint-cache", action=argparse.BooleanOptionalAction, default=True,
+                        help="Cache the latest checkpoints of chats and write one checkpoint per turn")
+    parser.add_argument("--trace-heap", action="store_true", help="Measure Python heap per chat with tracemalloc (slows the bot down)")
+    parser.add_argument("--fake-api-port", type=int, default=None)
+    parser.add_argument("--json", type=Path, default=None, help="Write results to the JSON file")
+    args = parser.parse_args()
+
+    random.seed(0)
+    results = asyncio.run(run(args))
+    if args.json is not None:
+        args.json.write_text(json.dumps([asdict(result) for result in results], indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
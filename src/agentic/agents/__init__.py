@@ -1,4 +1,11 @@
-from .manager import manager_agent
+from .manager import create_manager_agent, ManagerState, MANAGER_AGENT_SYSTEM_PROMPT
+from .manager.history import compact_history
+from .manager.context import create_context_retrieval
+from .manager.answer_cache import AnswerCache, create_answer_cache
+from .manager.tools.retrieval import create_retrieval_tool, RETRIEVAL_TOOL_NAME, RETRIEVAL_TOOL_DESCRIPTION
 
 
-__all__ = ["manager_agent"]
+__all__ = [
+    "create_manager_agent", "ManagerState", "MANAGER_AGENT_SYSTEM_PROMPT", "compact_history", "create_context_retrieval",
+    "AnswerCache", "create_answer_cache", "create_retrieval_tool", "RETRIEVAL_TOOL_NAME", "RETRIEVAL_TOOL_DESCRIPTION",
+]
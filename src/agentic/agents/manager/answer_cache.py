@@ -0,0 +1,348 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.runnables.config import RunnableConfig
+from langchain_core.tools import BaseTool
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from .manager import STEPS_EXCEEDED_MESSAGE
+from .tools.retrieval import RETRIEVAL_TOOL_NAME
+from ...knowledge_base import KnowledgeBase
+from ...knowledge_base.index import IndexVersionWatcher
+from ...text import normalize_text
+from ....metrics import registry
+from ....settings import AnswerCacheSettings, settings
+
+
+# Response metadata key of replies served from the answer cache
+CACHED_ANSWER_KEY = "answer_cache"
+
+answer_cache_requests = registry.counter(
+    "answer_cache_requests_total",
+    "Lookups of first-turn questions in the answer cache by tenant and result (hit, miss)",
+    ["tenant", "result"],
+)
+answer_cache_stores = registry.counter(
+    "answer_cache_stores_total",
+    "Replies to missed first-turn questions by tenant and result: stored, or skipped because they can't be reused "
+    "(not_ready: the knowledge base was not ready, tools: other tools than retrieval were called, "
+    "incomplete: no final reply, version: the knowledge base changed during the turn)",
+    ["tenant", "result"],
+)
+answer_cache_evictions = registry.counter(
+    "answer_cache_evictions_total",
+    "Answer cache evictions by tenant and reason (size, ttl, version: the knowledge base or the prompt changed)",
+    ["tenant", "reason"],
+)
+answer_cache_entries = registry.gauge(
+    "answer_cache_entries",
+    "Number of cached replies by tenant",
+    ["tenant"],
+)
+answer_cache_saved_tokens = registry.counter(
+    "answer_cache_saved_tokens_total",
+    "LLM tokens the cached replies took to generate, counted for every reply served from the cache, by tenant and type",
+    ["tenant", "type"],
+)
+answer_cache_saved_seconds = registry.counter(
+    "answer_cache_saved_seconds_total",
+    "Time the cached replies took to generate, counted for every reply served from the cache, by tenant",
+    ["tenant"],
+)
+
+
+def prompt_version(system_prompt: str, tools: Sequence[Union[BaseTool, Callable[..., Any]]]) -> str:
+    """Hash of the agent prompt and tools, replies generated with another prompt are not served"""
+    text = json.dumps([system_prompt, *(convert_to_openai_tool(tool) for tool in tools)], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+class _Answer:
+    """Cached reply and the cost of its generation"""
+    __slots__ = ("text", "input_tokens", "output_tokens", "seconds", "expires_at")
+
+    def __init__(self, text: str, input_tokens: int, output_tokens: int, seconds: float, expires_at: float) -> None:
+        self.text = text
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.seconds = seconds
+        self.expires_at = expires_at
+
+
+class AnswerCache:
+    """
+    Cache of replies to the first question of a chat. Many users start with the same questions (what the company does,
+    which cases it has), their replies depend only on the question, the prompt and the knowledge base, so they are generated once.
+
+    - Keys are normalized question texts (case, punctuation and extra whitespace are ignored).
+    - Replies are cached for the current knowledge base index version and prompt, they are evicted when either changes.
+    - Only replies which can be reused are stored: the knowledge base was ready and no tools except retrieval were called
+      (e.g. sending a document to the user has to be repeated for every chat).
+    - The least recently used replies are evicted above max_entries, replies expire after ttl_seconds.
+    - Replies are kept in SQLite (if path is given), so they survive restarts and can be pre-generated (see main).
+
+    lookup and store are the graph nodes before and after the turn, see build_state_graph in src/bot.py.
+    """
+
+    # Misses waiting for their reply to be stored, by thread id. Turns cancelled before the reply are dropped above this number
+    MAX_PENDING = 1024
+
+    def __init__(
+        self,
+        name: str,
+        knowledge_base: KnowledgeBase,
+        prompt_version: str,
+        max_entries: int,
+        ttl_seconds: float,
+        max_question_chars: int,
+        path: Optional[str] = None,
+        retrieval_tool_name: str = RETRIEVAL_TOOL_NAME,
+    ) -> None:
+        self.name = name
+        self.knowledge_base = knowledge_base
+        self.prompt_version = prompt_version
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_question_chars = max_question_chars
+        self.retrieval_tool_name = retrieval_tool_name
+        self._entries: "OrderedDict[str, _Answer]" = OrderedDict()
+        self._pending: "OrderedDict[str, Tuple[str, str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._index_watcher = IndexVersionWatcher(knowledge_base.config)
+        self._version: Optional[str] = None
+        self._connection: Optional[sqlite3.Connection] = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS answers (tenant TEXT NOT NULL, question TEXT NOT NULL, version TEXT NOT NULL, "
+                "answer TEXT NOT NULL, input_tokens INTEGER NOT NULL, output_tokens INTEGER NOT NULL, seconds REAL NOT NULL, "
+                "expires_at REAL NOT NULL, PRIMARY KEY (tenant, question))"
+            )
+
+    @property
+    def version(self) -> str:
+        """Version of the cached replies: the knowledge base index version and the prompt version"""
+        self._check_version()
+        return self._version
+
+    def _check_version(self) -> None:
+        """Evict replies of the previous version if the index was rebuilt since the last check, load stored replies of the new one"""
+        if not self._index_watcher.check() and self._version is not None:
+            return
+        version = f"{self._index_watcher.version}:{self.prompt_version}"
+        with self._lock:
+            if version == self._version:
+                return
+            answer_cache_evictions.inc(len(self._entries), tenant=self.name, reason="version")
+            self._entries.clear()
+            self._version = version
+            if self._connection is not None:
+                with self._connection:
+                    deleted = self._connection.execute(
+                        "DELETE FROM answers WHERE tenant = ? AND (version != ? OR expires_at <= ?)", (self.name, version, time.time())
+                    ).rowcount
+                rows = self._connection.execute(
+                    "SELECT question, answer, input_tokens, output_tokens, seconds, expires_at FROM answers "
+                    "WHERE tenant = ? ORDER BY expires_at DESC LIMIT ?", (self.name, self.max_entries)
+                ).fetchall()
+                # Replies of the previous version are stale, expired ones would be evicted on lookup anyway
+                answer_cache_evictions.inc(deleted, tenant=self.name, reason="version")
+                for question, *values in reversed(rows):
+                    self._entries[question] = _Answer(*values)
+                if rows:
+                    logging.info(f"Loaded {len(rows)} cached answers of {self.name}")
+            answer_cache_entries.set(len(self._entries), tenant=self.name)
+
+    def _key(self, question: str) -> Optional[str]:
+        if len(question) > self.max_question_chars:
+            return None
+        return normalize_text(question) or None
+
+    def get(self, question: str) -> Optional[str]:
+        """Cached reply to the question"""
+        key = self._key(question)
+        if key is None:
+            return None
+        self._check_version()
+        answer = self._get(key)
+        return answer.text if answer is not None else None
+
+    def _get(self, key: str) -> Optional[_Answer]:
+        with self._lock:
+            answer = self._entries.get(key)
+            if answer is None:
+                return None
+            if answer.expires_at <= time.time():
+                self._delete([key])
+                answer_cache_evictions.inc(tenant=self.name, reason="ttl")
+                return None
+            self._entries.move_to_end(key)
+            return answer
+
+    def _put(self, key: str, answer: _Answer) -> None:
+        with self._lock:
+            self._entries[key] = answer
+            self._entries.move_to_end(key)
+            evicted = []
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[0])
+            answer_cache_evictions.inc(len(evicted), tenant=self.name, reason="size")
+            if self._connection is not None:
+                with self._connection:
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (self.name, key, self._version, answer.text, answer.input_tokens, answer.output_tokens,
+                         answer.seconds, answer.expires_at),
+                    )
+            self._delete(evicted)
+
+    def _delete(self, keys: List[str]) -> None:
+        """Remove the entries, the lock must be held"""
+        for key in keys:
+            self._entries.pop(key, None)
+        if keys and self._connection is not None:
+            with self._connection:
+                self._connection.executemany("DELETE FROM answers WHERE tenant = ? AND question = ?", [(self.name, key) for key in keys])
+        answer_cache_entries.set(len(self._entries), tenant=self.name)
+
+    async def lookup(self, state: Dict[str, Any], config: RunnableConfig) -> Dict[str, Any]:
+        """Graph node which replies to the first question of a chat from the cache"""
+        messages: List[BaseMessage] = state["messages"]
+        if len(messages) != 1 or not isinstance(messages[0], HumanMessage) or state.get("summary"):
+            return {}
+        key = self._key(str(messages[0].content))
+        if key is None:
+            return {}
+        self._check_version()
+        answer = self._get(key)
+        if answer is None:
+            answer_cache_requests.inc(tenant=self.name, result="miss")
+            thread_id = config["configurable"].get("thread_id")
+            self._pending[thread_id] = (key, self._version, time.monotonic())
+            while len(self._pending) > self.MAX_PENDING:
+                self._pending.popitem(last=False)
+            return {}
+
+        answer_cache_requests.inc(tenant=self.name, result="hit")
+        answer_cache_saved_tokens.inc(answer.input_tokens, tenant=self.name, type="input")
+        answer_cache_saved_tokens.inc(answer.output_tokens, tenant=self.name, type="output")
+        answer_cache_saved_seconds.inc(answer.seconds, tenant=self.name)
+        return {"messages": [AIMessage(id=str(uuid.uuid4()), content=answer.text, response_metadata={CACHED_ANSWER_KEY: True})]}
+
+    async def store(self, state: Dict[str, Any], config: RunnableConfig) -> Dict[str, Any]:
+        """Graph node which caches the reply to a missed first question if it can be reused"""
+        pending = self._pending.pop(config["configurable"].get("thread_id"), None)
+        if pending is None:
+            return {}
+        key, version, started_at = pending
+        messages: List[BaseMessage] = state["messages"]
+        reply = messages[-1]
+        calls = [call["name"] for message in messages if isinstance(message, AIMessage) for call in message.tool_calls]
+        if not self.knowledge_base.ready:
+            result = "not_ready"
+        elif any(name != self.retrieval_tool_name for name in calls):
+            result = "tools"
+        elif (
+            not isinstance(reply, AIMessage) or reply.tool_calls or not isinstance(reply.content, str)
+            or not reply.content.strip() or reply.content == STEPS_EXCEEDED_MESSAGE
+            or any(isinstance(message, HumanMessage) for message in messages[1:])
+        ):
+            result = "incomplete"
+        elif version != self.version:
+            result = "version"
+        else:
+            result = "stored"
+            usage = [message.usage_metadata or {} for message in messages if isinstance(message, AIMessage)]
+            self._put(key, _Answer(
+                text=reply.content,
+                input_tokens=sum(item.get("input_tokens", 0) for item in usage),
+                output_tokens=sum(item.get("output_tokens", 0) for item in usage),
+                seconds=time.monotonic() - started_at,
+                expires_at=time.time() + self.ttl_seconds,
+            ))
+        answer_cache_stores.inc(tenant=self.name, result=result)
+        return {}
+
+
+def create_answer_cache(
+    name: str,
+    knowledge_base: KnowledgeBase,
+    system_prompt: str,
+    tools: Sequence[Union[BaseTool, Callable[..., Any]]],
+    retrieval_tool_name: str = RETRIEVAL_TOOL_NAME,
+    config: Optional[AnswerCacheSettings] = None,
+) -> AnswerCache:
+    """Create answer cache of a bot from settings"""
+    config = config or settings.answer_cache
+    return AnswerCache(
+        name=name,
+        knowledge_base=knowledge_base,
+        prompt_version=prompt_version(system_prompt, tools),
+        max_entries=config.MAX_ENTRIES,
+        ttl_seconds=config.TTL_SECONDS,
+        max_question_chars=config.MAX_QUESTION_CHARS,
+        path=config.PATH or None,
+        retrieval_tool_name=retrieval_tool_name,
+    )
+
+
+async def pregenerate_answers(tenant: Any, questions: List[str]) -> int:
+    """Generate and cache replies to the questions with the tenant bot graph, returns the number of cached replies"""
+    # Imported here, the bot module depends on the agents package
+    from langgraph.checkpoint.memory import MemorySaver
+    from ....bot import build_state_graph
+
+    tenant.knowledge_base.start()
+    if not await tenant.knowledge_base.wait_ready(timeout=600):
+        raise RuntimeError(f"Knowledge base of {tenant.name} is not ready: {tenant.knowledge_base.last_error}")
+    graph = build_state_graph(tenant.manager_agent, tenant.retrieve_context, tenant.answer_cache).compile(checkpointer=MemorySaver())
+    cached = 0
+    for question in questions:
+        if tenant.answer_cache.get(question) is None:
+            config = {"configurable": {"thread_id": f"answer-cache:{uuid.uuid4().hex}"}}
+            await graph.ainvoke({"messages": [{"role": "user", "content": question}]}, config)
+        if tenant.answer_cache.get(question) is None:
+            logging.warning(f"Reply to {question!r} can't be cached, see answer_cache_stores_total")
+        else:
+            cached += 1
+    return cached
+
+
+def main():
+    """Command line entry point for pre-generation of cached replies: python -m src.agentic.agents.manager.answer_cache"""
+    parser = argparse.ArgumentParser(description="Generate replies to frequent first questions and put them into the answer cache")
+    parser.add_argument("questions", help="Text file with one question per line")
+    parser.add_argument("--tenant", help="Tenant from the tenants config, the only (default) tenant if not set")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=settings.telegram_bot.LOGGING_LEVEL)
+    if not settings.answer_cache.ENABLED or not settings.answer_cache.PATH:
+        parser.error("Answer cache is disabled or not persistent, set ANSWER_CACHE_ENABLED and ANSWER_CACHE_PATH")
+
+    # Imported here, tenants module depends on the agents package
+    from ....tenants import load_tenants
+    tenants = load_tenants()
+    tenant = tenants.get(args.tenant) if args.tenant else next(iter(tenants))
+    with open(args.questions, encoding="utf-8") as file:
+        questions = [line.strip() for line in file if line.strip()]
+
+    cached = asyncio.run(pregenerate_answers(tenant, questions))
+    logging.info(f"Done: {cached} of {len(questions)} replies of {tenant.name} are cached, version {tenant.answer_cache.version}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from langchain_core.documents import Document
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+from langchain_core.runnables.config import RunnableConfig
+
+from ....metrics import registry
+from ...knowledge_base import KnowledgeBase
+
+
+# Prefix of the system message with the prefetched knowledge base sections, it is added to the prompt before the user message
+CONTEXT_MESSAGE_PREFIX: str = (
+    "Сведения из базы знаний AllSee, найденные по последнему сообщению пользователя. "
+    "Если их недостаточно для ответа, воспользуйся инструментом поиска по базе знаний:\n\n"
+)
+
+context_retrievals = registry.counter(
+    "manager_context_retrievals_total",
+    "Speculative knowledge base retrievals for user messages by result (found, empty, not_ready, timeout, error)",
+    ["knowledge_base", "result"],
+)
+context_retrieval_seconds = registry.histogram(
+    "manager_context_retrieval_seconds",
+    "Duration of speculative knowledge base retrievals for user messages",
+    ["knowledge_base"],
+)
+
+
+def last_user_message(messages: List[BaseMessage]) -> Optional[HumanMessage]:
+    for message in reversed(messages):
+        if isinstance(message, HumanMessage):
+            return message
+    return None
+
+
+def format_documents(documents: List[Document]) -> str:
+    """Join sections the same way the retriever tool does, so the model sees the same text in both cases"""
+    return "\n\n".join(document.page_content for document in documents)
+
+
+def build_context_message(context: Optional[str]) -> List[SystemMessage]:
+    """Build system message with the prefetched knowledge base sections"""
+    if not context:
+        return []
+    return [SystemMessage(content=CONTEXT_MESSAGE_PREFIX + context)]
+
+
+def create_context_retrieval(
+    knowledge_base: KnowledgeBase,
+    timeout: float,
+) -> Callable[[Dict[str, Any], RunnableConfig], Awaitable[Dict[str, Any]]]:
+    """
+    Create graph node which searches the knowledge base for the latest user message before the manager agent is called.
+    The found sections are put into the context of the agent prompt, so in most turns the agent answers with one LLM call
+    instead of calling the retrieval tool first. The node runs in parallel with history compaction. If the knowledge base
+    is not ready or the search takes longer than `timeout` seconds, the agent gets no context and falls back to the tool.
+    """
+
+    async def retrieve_context(state: Dict[str, Any], config: RunnableConfig) -> Dict[str, Any]:
+        message = last_user_message(state["messages"])
+        if message is None or not str(message.content).strip():
+            return {"context": ""}
+        if knowledge_base.retriever is None:
+            # The tool waits for the warm-up if the agent needs the knowledge base, here it would only delay the reply
+            knowledge_base.start()
+            context_retrievals.inc(knowledge_base=knowledge_base.name, result="not_ready")
+            return {"context": ""}
+
+        started_at = time.monotonic()
+        try:
+            documents = await asyncio.wait_for(knowledge_base.retriever.ainvoke(str(message.content), config), timeout)
+        except asyncio.TimeoutError:
+            context_retrievals.inc(knowledge_base=knowledge_base.name, result="timeout")
+            logging.warning(f"Speculative retrieval from knowledge base {knowledge_base.name} timed out after {timeout:g}s")
+            return {"context": ""}
+        except Exception as e:
+            context_retrievals.inc(knowledge_base=knowledge_base.name, result="error")
+            logging.error(f"Speculative retrieval from knowledge base {knowledge_base.name} failed: {e}")
+            return {"context": ""}
+        finally:
+            context_retrieval_seconds.observe(time.monotonic() - started_at, knowledge_base=knowledge_base.name)
+
+        context_retrievals.inc(knowledge_base=knowledge_base.name, result="found" if documents else "empty")
+        return {"context": format_documents(documents)}
+
+    return retrieve_context
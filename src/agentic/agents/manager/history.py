@@ -0,0 +1,186 @@
+import json
+import logging
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence
+
+import tiktoken
+from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    HumanMessage,
+    RemoveMessage,
+    SystemMessage,
+    ToolMessage,
+)
+from langgraph.constants import TAG_NOSTREAM
+
+from ....settings import settings
+from ...llm import llm
+
+
+SUMMARY_PROMPT: str = (
+    """
+    Ты ведёшь краткое содержание диалога менеджера компании AllSee с пользователем.
+    Обнови краткое содержание с учётом новых сообщений. Сохрани факты о пользователе (имя, компания, сфера, задачи),
+    его вопросы и интересы, важные ответы менеджера и отправленные пользователю материалы.
+    Не добавляй ничего от себя. Пиши по-русски, не длиннее {max_tokens} токенов.
+    """
+)
+
+# Prefix of the system message with the summary which is added to the prompt after the system prompt
+SUMMARY_MESSAGE_PREFIX: str = "Краткое содержание предыдущей части диалога:\n"
+
+TRUNCATION_MARK: str = "\n[...результат сокращён...]"
+
+# Approximate number of tokens which OpenAI adds for every message (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+@lru_cache(maxsize=None)
+def _get_encoding() -> Optional[tiktoken.Encoding]:
+    """Get tokenizer of the configured LLM, None if it can't be loaded (e.g. tiktoken files can't be downloaded)"""
+    try:
+        try:
+            return tiktoken.encoding_for_model(settings.llm.MODEL)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logging.warning(f"Failed to load tokenizer, token counts will be approximate: {e}")
+        return None
+
+
+def count_text_tokens(text: str) -> int:
+    """Count tokens of the text with the LLM tokenizer"""
+    encoding = _get_encoding()
+    if encoding is None:
+        # Rough estimation for the case when tokenizer is not available
+        return len(text) // 3 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _message_text(message: BaseMessage) -> str:
+    """Get all text of the message which is sent to the LLM"""
+    if isinstance(message.content, str):
+        text = message.content
+    else:
+        text = "".join(part.get("text", "") if isinstance(part, dict) else str(part) for part in message.content)
+    if isinstance(message, AIMessage) and message.tool_calls:
+        text += json.dumps(message.tool_calls, ensure_ascii=False)
+    return text
+
+
+def count_tokens(messages: Sequence[BaseMessage]) -> int:
+    """Count prompt tokens of the messages"""
+    return sum(count_text_tokens(_message_text(message)) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+
+def split_into_turns(messages: Sequence[BaseMessage]) -> List[List[BaseMessage]]:
+    """
+    Split messages into turns. Every turn starts with a user message and contains all agent messages and tool results after it,
+    so removing whole turns never leaves tool calls without their results.
+    """
+    turns: List[List[BaseMessage]] = []
+    for message in messages:
+        if isinstance(message, HumanMessage) or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def build_summary_message(summary: Optional[str]) -> List[SystemMessage]:
+    """Build system message with the summary of the dropped part of the conversation"""
+    if not summary:
+        return []
+    return [SystemMessage(content=SUMMARY_MESSAGE_PREFIX + summary)]
+
+
+def _truncate_tool_results(turns: List[List[BaseMessage]]) -> List[BaseMessage]:
+    """Truncate long tool results of all turns except the current one. Returns updated messages (with the same ids)"""
+    limit = settings.history.TOOL_RESULT_MAX_CHARS
+    updated: List[BaseMessage] = []
+    for turn in turns[:-1]:
+        for index, message in enumerate(turn):
+            if not isinstance(message, ToolMessage) or not isinstance(message.content, str):
+                continue
+            if len(message.content) <= limit or message.content.endswith(TRUNCATION_MARK):
+                continue
+            truncated = message.model_copy(update={"content": message.content[:limit] + TRUNCATION_MARK})
+            turn[index] = truncated
+            updated.append(truncated)
+    return updated
+
+
+async def _summarize(summary: Optional[str], messages: Sequence[BaseMessage]) -> str:
+    """Merge dropped messages into the running summary"""
+    dialog_lines = []
+    for message in messages:
+        text = str(message.content) if isinstance(message, AIMessage) else _message_text(message)
+        if isinstance(message, AIMessage) and message.tool_calls:
+            text += " [вызов инструментов: " + ", ".join(call["name"] for call in message.tool_calls) + "]"
+        if not text.strip():
+            continue
+        role = {"human": "Пользователь", "ai": "Менеджер", "tool": "Инструмент"}.get(message.type, message.type)
+        dialog_lines.append(f"{role}: {text}")
+
+    request = [
+        SystemMessage(content=SUMMARY_PROMPT.format(max_tokens=settings.history.SUMMARY_MAX_TOKENS)),
+        HumanMessage(
+            content=(
+                f"Текущее краткое содержание:\n{summary or '(пусто)'}\n\n"
+                f"Новые сообщения:\n" + "\n".join(dialog_lines)
+            )
+        ),
+    ]
+    # Summary is an internal step, its tokens must not be streamed to the user
+    summarizer = llm.bind(max_tokens=settings.history.SUMMARY_MAX_TOKENS).with_config(tags=[TAG_NOSTREAM])
+    response = await summarizer.ainvoke(request)
+    return str(response.content).strip()
+
+
+async def compact_history(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Graph node which keeps conversation history within the token budget before the manager agent is called.
+    History is changed only when it is longer than HISTORY_MAX_TOKENS, so between compactions every prompt starts
+    with the previous one and the provider prompt cache is reused.
+
+    - Tool results of the previous turns are truncated.
+    - If the history is still too long, the oldest turns are removed from the state and merged
+      into the running summary, so only HISTORY_KEEP_TOKENS of the latest turns are kept verbatim.
+    """
+    turns = split_into_turns(state["messages"])
+    if sum(count_tokens(turn) for turn in turns) <= settings.history.MAX_TOKENS:
+        return {}
+    updated_messages: List[BaseMessage] = _truncate_tool_results(turns)
+
+    history_tokens = sum(count_tokens(turn) for turn in turns)
+    if history_tokens <= settings.history.MAX_TOKENS or len(turns) < 2:
+        return {"messages": updated_messages} if updated_messages else {}
+
+    # Keep the latest turns within the budget, the current turn is always kept
+    kept_tokens = count_tokens(turns[-1])
+    cut = len(turns) - 1
+    while cut > 0:
+        turn_tokens = count_tokens(turns[cut - 1])
+        if kept_tokens + turn_tokens > settings.history.KEEP_TOKENS:
+            break
+        kept_tokens += turn_tokens
+        cut -= 1
+
+    dropped_messages = [message for turn in turns[:cut] for message in turn]
+    try:
+        summary = await _summarize(state.get("summary"), dropped_messages)
+    except Exception as e:
+        # History is compacted on the next turn, it is better to answer with a longer prompt than not to answer
+        logging.error(f"Failed to summarize conversation history: {e}")
+        return {"messages": updated_messages} if updated_messages else {}
+
+    logging.info(
+        f"Compacted conversation history: {len(dropped_messages)} messages summarized, "
+        f"{history_tokens} -> {kept_tokens} tokens (+{count_text_tokens(summary)} summary tokens)"
+    )
+    dropped_ids = {message.id for message in dropped_messages}
+    return {
+        "messages": [RemoveMessage(id=message.id) for message in dropped_messages]
+        + [message for message in updated_messages if message.id not in dropped_ids],
+        "summary": summary,
+    }
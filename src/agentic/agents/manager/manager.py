@@ -1,11 +1,20 @@
-from typing import List
+import time
+from typing import Any, Callable, Dict, List, Optional, cast
 
-from langchain_core.tools import StructuredTool
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.runnables.config import RunnableConfig
+from langchain_core.tools import BaseTool
 
+from .context import build_context_message
+from .history import build_summary_message
 from .tools.telegram import send_document_to_user
-from .tools.retrieval import retrieval_tool
+from .tools.retrieval import RETRIEVAL_TOOL_NAME, create_retrieval_tool
+from ...knowledge_base import create_knowledge_base
 from ...llm import llm
-from langgraph.prebuilt import create_react_agent
+from ....metrics import registry
+from langgraph.graph import END, START, MessagesState, StateGraph
+from langgraph.prebuilt import ToolNode, tools_condition
+from langgraph.prebuilt.chat_agent_executor import AgentState
 from langgraph.graph.state import CompiledGraph
 
 
@@ -65,16 +74,130 @@ MANAGER_AGENT_SYSTEM_PROMPT: str = (
 )
 
 
-# Create the manager agent using prebuild create_react_agent. Reade more about it here: https://langchain-ai.github.io/langgraph/reference/prebuilt/#langgraph.prebuilt.chat_agent_executor.create_react_agent
-# For more flexible tool execution and node routing inside agent it is bette to implement your own ToolNode and ToolEdge. Here are som good starting points:
-# - https://langchain-ai.github.io/langgraph/tutorials/introduction/#part-2-enhancing-the-chatbot-with-tools
-# - https://langchain-ai.github.io/langgraph/how-tos/tool-calling/
-manager_tools: List[StructuredTool] = [
-    send_document_to_user,
-    retrieval_tool,
-]
-manager_agent: CompiledGraph = create_react_agent(
-    model=llm,
-    prompt=MANAGER_AGENT_SYSTEM_PROMPT,
-    tools=manager_tools,
+# Reply of the agent when the turn runs out of graph steps while the model still calls tools
+STEPS_EXCEEDED_MESSAGE: str = "Извините, не удалось подготовить ответ. Попробуйте переформулировать вопрос."
+
+manager_turns = registry.counter(
+    "manager_turns_total",
+    "Manager agent turns by the way the knowledge base was used: context (answered with the prefetched sections "
+    "without calling the retrieval tool), tool (the retrieval tool was called) or none",
+    ["retrieval"],
+)
+retrieval_round_trip_saved_seconds = registry.histogram(
+    "manager_retrieval_round_trip_saved_seconds",
+    "Estimated reply latency saved by a turn answered with the prefetched sections: "
+    "average duration of the LLM calls which requested the retrieval tool",
 )
+
+
+class ManagerState(MessagesState):
+    """
+    State of the bot graph: messages, running summary of the messages which were removed from the history
+    and knowledge base sections prefetched for the current user message
+    """
+    summary: str
+    context: str
+
+
+class ManagerAgentState(AgentState):
+    """State of the manager agent, summary and context are shared with the bot graph"""
+    summary: str
+    context: str
+
+
+class _MovingAverage:
+    """Exponential moving average of observed values"""
+
+    def __init__(self, weight: float = 0.1) -> None:
+        self.weight = weight
+        self.value: Optional[float] = None
+
+    def observe(self, value: float) -> None:
+        self.value = value if self.value is None else self.value + self.weight * (value - self.value)
+
+
+def _current_turn_start(messages: List[BaseMessage]) -> Optional[int]:
+    """Index of the latest user message"""
+    for index in range(len(messages) - 1, -1, -1):
+        if isinstance(messages[index], HumanMessage):
+            return index
+    return None
+
+
+def create_manager_prompt(system_prompt: str) -> Callable[[ManagerAgentState], List[BaseMessage]]:
+    """Create prompt builder of the manager agent with the given system prompt"""
+
+    def build_manager_prompt(state: ManagerAgentState) -> List[BaseMessage]:
+        """
+        Build LLM prompt: system prompt, summary of the earlier conversation (if any) and the remaining history.
+        Prefetched knowledge base sections (if any) are put right before the current user message
+        """
+        messages = state["messages"]
+        current = _current_turn_start(messages)
+        if current is None:
+            current = len(messages)
+        return [
+            SystemMessage(content=system_prompt),
+            *build_summary_message(state.get("summary")),
+            *messages[:current],
+            *build_context_message(state.get("context")),
+            *messages[current:],
+        ]
+
+    return build_manager_prompt
+
+
+def create_manager_agent(
+    system_prompt: str = MANAGER_AGENT_SYSTEM_PROMPT,
+    tools: Optional[List[BaseTool]] = None,
+    retrieval_tool_name: str = RETRIEVAL_TOOL_NAME,
+) -> CompiledGraph:
+    """
+    Create the manager agent of a bot. By default, it has the tool for sending documents and the tool for searching
+    the knowledge base configured in settings. Every bot (tenant) gets its own agent with its own prompt and knowledge base.
+
+    The agent is a ReAct loop: the model is called with the prompt, tools it requests are run concurrently by ToolNode
+    and the model is called again with their results. Knowledge base sections prefetched for the user message
+    (see create_context_retrieval) are added to the prompt, so the model usually answers without the retrieval tool round trip,
+    the tool is still available when the sections are not enough
+    """
+    if tools is None:
+        tools = [send_document_to_user, create_retrieval_tool(create_knowledge_base())]
+    prompt = create_manager_prompt(system_prompt)
+    model = llm.bind_tools(tools)
+    # Duration of the LLM calls which end with a retrieval tool call, it is the round trip a prefetched context saves
+    retrieval_round_trip = _MovingAverage()
+
+    def record_turn(state: ManagerAgentState) -> None:
+        turn = state["messages"][(_current_turn_start(state["messages"]) or 0):]
+        if any(call["name"] == retrieval_tool_name for message in turn if isinstance(message, AIMessage) for call in message.tool_calls):
+            manager_turns.inc(retrieval="tool")
+        elif state.get("context"):
+            manager_turns.inc(retrieval="context")
+            if retrieval_round_trip.value is not None:
+                retrieval_round_trip_saved_seconds.observe(retrieval_round_trip.value)
+        else:
+            manager_turns.inc(retrieval="none")
+
+    async def call_model(state: ManagerAgentState, config: RunnableConfig) -> Dict[str, Any]:
+        started_at = time.monotonic()
+        response = cast(AIMessage, await model.ainvoke(prompt(state), config))
+        if any(call["name"] == retrieval_tool_name for call in response.tool_calls):
+            retrieval_round_trip.observe(time.monotonic() - started_at)
+        if response.tool_calls and state["remaining_steps"] < 2:
+            # Tool results would not be answered within the recursion limit
+            return {"messages": [AIMessage(id=response.id, content=STEPS_EXCEEDED_MESSAGE)], "context": ""}
+        if response.tool_calls:
+            return {"messages": [response]}
+        record_turn(state)
+        # Prefetched sections are needed only in the current turn, they are not kept in the history
+        return {"messages": [response], "context": ""}
+
+    graph_builder = StateGraph(ManagerAgentState)
+    # Streaming of the reply relies on the node name, see src/handlers/streaming.py
+    graph_builder.add_node("agent", call_model)
+    graph_builder.add_node("tools", ToolNode(tools))
+    graph_builder.add_edge(START, "agent")
+    graph_builder.add_conditional_edges("agent", tools_condition, ["tools", END])
+    graph_builder.add_edge("tools", "agent")
+    return graph_builder.compile()
@@ -1,12 +1,17 @@
 import logging
+import os
 from typing import Optional
 
 from pydantic import BaseModel, Field
-from telegram import Update
+from telegram import Message, Update
+from telegram.error import BadRequest
 
 from langchain_core.tools import StructuredTool
 from langchain_core.runnables.config import RunnableConfig
 
+from .....storage import TelegramFileIdCache
+from .....tracing import traced
+
 
 class DocumentReply(BaseModel):
     """Pydantic model for sending a document to a user"""
@@ -20,29 +25,73 @@ class ReplyResult(BaseModel):
     error: str | None = Field(description="Текст ошибки, если отправка не удалась")
 
 
+async def reply_document_with_cache(
+    message: Message,
+    document_path: str,
+    caption: Optional[str],
+    file_id_cache: Optional[TelegramFileIdCache],
+) -> None:
+    """Reply with a local document, reusing Telegram file_id of the previous upload of the same file content if possible"""
+    # Without cache or for non-local documents (URLs, file_ids) just send the document as is
+    if file_id_cache is None or not os.path.isfile(document_path):
+        await message.reply_document(document=document_path, caption=caption, parse_mode="HTML")
+        return
+
+    bot_id = message.get_bot().id
+    content_hash = None
+    try:
+        content_hash = await file_id_cache.hash_file(document_path)
+        file_id = await file_id_cache.get(bot_id, document_path, content_hash)
+    except Exception as e:
+        logging.error(f"Failed to read Telegram file_id cache for {document_path}: {e}")
+        file_id = None
+
+    if file_id is not None:
+        try:
+            await message.reply_document(document=file_id, caption=caption, parse_mode="HTML")
+            return
+        # Telegram can reject old file_id, in this case we upload the file again
+        except BadRequest as e:
+            logging.warning(f"Cached file_id for {document_path} was rejected, uploading the file again: {e}")
+            # Forget the rejected file_id, so it isn't tried again if the upload below fails too
+            try:
+                await file_id_cache.delete(bot_id, document_path)
+            except Exception as e:
+                logging.error(f"Failed to delete Telegram file_id for {document_path}: {e}")
+
+    sent_message = await message.reply_document(document=document_path, caption=caption, parse_mode="HTML")
+    if content_hash is not None and sent_message.document is not None:
+        try:
+            await file_id_cache.put(bot_id, document_path, content_hash, sent_message.document.file_id)
+        except Exception as e:
+            logging.error(f"Failed to store Telegram file_id for {document_path}: {e}")
+
+
 async def send_document_to_user(reply_document_path: str, reply_text: Optional[str], config: RunnableConfig) -> ReplyResult:
     """A tool for sending a document to a user"""
     # Try to get the update from InjectedState and send the document to the user
     try:
         update: Update = config["configurable"].get("update")
-        print("\n\n-----")
-        print(update)
-        print(reply_text)
-        print(reply_document_path)
-        await update.message.reply_document(
-            document=reply_document_path,
-            caption=reply_text,
-            parse_mode="HTML",
-        )
-
-    # Handling error if sending the message fails
+        # Cache of file_id values is optional, without it the document is uploaded every time
+        file_id_cache: Optional[TelegramFileIdCache] = config["configurable"].get("file_id_cache")
+        # The turn can't be superseded by a newer message after the user got a reply
+        on_reply = config["configurable"].get("on_reply")
+        if on_reply is not None:
+            on_reply()
+        with traced("telegram.send_document", **{"document.path": reply_document_path}):
+            await reply_document_with_cache(
+                message=update.message,
+                document_path=reply_document_path,
+                caption=reply_text,
+                file_id_cache=file_id_cache,
+            )
+
+    # Handling error if sending the message fails. Flood control errors are retried by the rate limiter before they get here
     except Exception as e:
         logging.error(f"Failed to send message to user: {e}")
         return ReplyResult(success=False, error=str(e))
-    
-    # Returning success result
-    finally:
-        return ReplyResult(success=True, error=None)
+
+    return ReplyResult(success=True, error=None)
 
 
 # Creating a structured tool for sending a document to a user
@@ -0,0 +1,31 @@
+from .loader import load_and_split_markdown, load_sections
+from .embeddings import EmbeddingCache, EmbeddingService, create_embedding_service
+from .index import create_embeddings, shared_embeddings, open_vectorstore, read_index_version, sync_index
+from .cache import CachedRetriever, RetrievalCache, create_retrieval_cache
+from .keyword import BM25Index
+from .hybrid import CrossEncoderReranker, HybridRetriever, reciprocal_rank_fusion
+from .service import KnowledgeBase, KnowledgeBaseRetriever, create_knowledge_base
+
+
+__all__ = [
+    "load_and_split_markdown",
+    "load_sections",
+    "EmbeddingCache",
+    "EmbeddingService",
+    "create_embedding_service",
+    "create_embeddings",
+    "shared_embeddings",
+    "open_vectorstore",
+    "read_index_version",
+    "sync_index",
+    "CachedRetriever",
+    "RetrievalCache",
+    "create_retrieval_cache",
+    "BM25Index",
+    "CrossEncoderReranker",
+    "HybridRetriever",
+    "reciprocal_rank_fusion",
+    "KnowledgeBase",
+    "KnowledgeBaseRetriever",
+    "create_knowledge_base",
+]
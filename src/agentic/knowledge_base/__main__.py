@@ -0,0 +1,40 @@
+import argparse
+import logging
+
+from ...settings import settings
+from .index import open_vectorstore, sync_index
+
+
+def main():
+    """Command line entry point for knowledge base indexing: python -m src.agentic.knowledge_base"""
+    parser = argparse.ArgumentParser(description="Synchronize knowledge base vector store with source files")
+    parser.add_argument("--dry-run", action="store_true", help="Only show which sections would be added or deleted")
+    parser.add_argument("--rebuild", action="store_true", help="Drop the collection and embed all sections again")
+    parser.add_argument("--allow-empty", action="store_true",
+                        help="Empty the index if no source files are found, by default indexing fails and keeps the index")
+    parser.add_argument("--tenant", help="Index the knowledge base of the tenant from the tenants config instead of the KNOWLEDGE_BASE_* settings")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=settings.telegram_bot.LOGGING_LEVEL)
+
+    config = None
+    if args.tenant:
+        # Imported here, tenants module depends on the agents package
+        from ...tenants import load_tenant_configs
+        tenants = {tenant.name: tenant for tenant in load_tenant_configs()}
+        if args.tenant not in tenants:
+            parser.error(f"Unknown tenant {args.tenant!r}, configured tenants: {', '.join(tenants)}")
+        config = tenants[args.tenant].knowledge_base_settings()
+
+    vectorstore = open_vectorstore(config)
+    try:
+        result = sync_index(vectorstore, dry_run=args.dry_run, config=config, rebuild=args.rebuild, allow_empty=args.allow_empty)
+    except ValueError as e:
+        parser.exit(1, f"{e}\n")
+    logging.info(
+        f"Done: {len(result.added)} added, {len(result.deleted)} deleted, {result.unchanged} unchanged, version {result.version}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+from pydantic import ConfigDict
+
+from ...metrics import registry
+from ...settings import KnowledgeBaseSettings, settings
+from ...tracing import traced
+from ..text import normalize_text
+from .index import IndexVersionWatcher
+
+
+cache_requests = registry.counter(
+    "retrieval_cache_requests_total",
+    "Retrieval cache lookups by cache level and result",
+    ["cache", "result"],
+)
+cache_evictions = registry.counter(
+    "retrieval_cache_evictions_total",
+    "Retrieval cache evictions by cache level and reason",
+    ["cache", "reason"],
+)
+cache_entries = registry.gauge(
+    "retrieval_cache_entries",
+    "Number of entries in the retrieval cache by cache level",
+    ["cache"],
+)
+
+
+class _SemanticEntry:
+    """Search results for a query embedding"""
+    __slots__ = ("vector", "documents", "expires_at")
+
+    def __init__(self, vector: np.ndarray, documents: List[Document], expires_at: float) -> None:
+        self.vector = vector
+        self.documents = documents
+        self.expires_at = expires_at
+
+
+class RetrievalCache:
+    """
+    Two-level cache of the knowledge base retrieval.
+
+    - Query cache: LRU of query embeddings keyed by normalized query text, it saves embedding API calls for repeated questions.
+    - Semantic cache: LRU of search results with TTL, keyed by query embedding. By default a lookup hits only for the same
+      embedding, it saves vector searches for repeated questions. With `similarity_threshold` a lookup also hits if a cached
+      embedding is similar enough (cosine similarity) to the query embedding, so rephrased questions reuse the results too.
+      Embeddings of questions with different meaning can be very similar (e.g. "cases in retail" and "cases in medicine"),
+      so approximate reuse needs a strict threshold and trades retrieval accuracy for fewer searches.
+
+    Both levels are cleared when the index version (see index manifest) changes.
+    """
+
+    def __init__(
+        self,
+        max_queries: int,
+        max_results: int,
+        ttl_seconds: float,
+        similarity_threshold: Optional[float] = None,
+        index_watcher: Optional[IndexVersionWatcher] = None,
+    ) -> None:
+        self.max_queries = max_queries
+        self.max_results = max_results
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._queries: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._results: "OrderedDict[str, _SemanticEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._index_watcher = index_watcher or IndexVersionWatcher()
+
+    def _check_index_version(self) -> None:
+        """Clear the cache if the index was rebuilt since the last check"""
+        if self._index_watcher.check():
+            self.clear(reason="invalidation")
+
+    def _update_gauges(self) -> None:
+        cache_entries.set(len(self._queries), cache="query")
+        cache_entries.set(len(self._results), cache="semantic")
+
+    def clear(self, reason: str = "invalidation") -> None:
+        """Remove all cached entries"""
+        with self._lock:
+            cache_evictions.inc(len(self._queries), cache="query", reason=reason)
+            cache_evictions.inc(len(self._results), cache="semantic", reason=reason)
+            self._queries.clear()
+            self._results.clear()
+            self._update_gauges()
+
+    def get_embedding(self, query: str) -> Optional[List[float]]:
+        """Get cached embedding of the query"""
+        self._check_index_version()
+        key = normalize_text(query)
+        with self._lock:
+            embedding = self._queries.get(key)
+            if embedding is None:
+                cache_requests.inc(cache="query", result="miss")
+                return None
+            self._queries.move_to_end(key)
+        cache_requests.inc(cache="query", result="hit")
+        return embedding
+
+    def put_embedding(self, query: str, embedding: List[float]) -> None:
+        """Store embedding of the query"""
+        key = normalize_text(query)
+        with self._lock:
+            self._queries[key] = embedding
+            self._queries.move_to_end(key)
+            while len(self._queries) > self.max_queries:
+                self._queries.popitem(last=False)
+                cache_evictions.inc(cache="query", reason="size")
+            self._update_gauges()
+
+    def get_documents(self, embedding: List[float]) -> Optional[List[Document]]:
+        """Get cached search results for the query embedding or, with the similarity threshold, for the most similar one"""
+        key = self._embedding_key(embedding)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None and entry.expires_at <= now:
+                del self._results[key]
+                cache_evictions.inc(cache="semantic", reason="ttl")
+                entry = None
+            if entry is None and self.similarity_threshold is not None:
+                key = self._find_similar(self._normalize(embedding), now)
+                entry = self._results.get(key) if key is not None else None
+
+            if entry is None:
+                self._update_gauges()
+                cache_requests.inc(cache="semantic", result="miss")
+                return None
+            self._results.move_to_end(key)
+        cache_requests.inc(cache="semantic", result="hit")
+        return entry.documents
+
+    def _find_similar(self, vector: np.ndarray, now: float) -> Optional[str]:
+        """Key of the cached embedding most similar to the vector above the similarity threshold, expired entries are removed"""
+        best_key, best_similarity = None, self.similarity_threshold
+        for key, entry in list(self._results.items()):
+            if entry.expires_at <= now:
+                del self._results[key]
+                cache_evictions.inc(cache="semantic", reason="ttl")
+                continue
+            similarity = float(np.dot(vector, entry.vector))
+            if similarity >= best_similarity:
+                best_key, best_similarity = key, similarity
+        return best_key
+
+    def put_documents(self, embedding: List[float], documents: List[Document]) -> None:
+        """Store search results for the query embedding"""
+        key = self._embedding_key(embedding)
+        entry = _SemanticEntry(self._normalize(embedding), documents, time.monotonic() + self.ttl_seconds)
+        with self._lock:
+            self._results[key] = entry
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+                cache_evictions.inc(cache="semantic", reason="size")
+            self._update_gauges()
+
+    @staticmethod
+    def _embedding_key(embedding: List[float]) -> str:
+        return hashlib.sha256(np.asarray(embedding, dtype=np.float32).tobytes()).hexdigest()
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+class CachedRetriever(BaseRetriever):
+    """Vector store retriever which uses RetrievalCache to skip embedding calls and vector searches for repeated questions"""
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    vectorstore: VectorStore
+    embeddings: Embeddings
+    cache: RetrievalCache
+    k: int = 3
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        embedding = self.cache.get_embedding(query)
+        if embedding is None:
+            with traced("embedding"):
+                embedding = self.embeddings.embed_query(query)
+            self.cache.put_embedding(query, embedding)
+
+        documents = self.cache.get_documents(embedding)
+        if documents is None:
+            documents = self._search(query, embedding)
+            self.cache.put_documents(embedding, documents)
+        return documents
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        embedding = self.cache.get_embedding(query)
+        if embedding is None:
+            with traced("embedding"):
+                embedding = await self.embeddings.aembed_query(query)
+            self.cache.put_embedding(query, embedding)
+
+        documents = self.cache.get_documents(embedding)
+        if documents is None:
+            documents = await self._asearch(query, embedding)
+            self.cache.put_documents(embedding, documents)
+        return documents
+
+    def _search(self, query: str, embedding: List[float]) -> List[Document]:
+        """Search the knowledge base on cache miss"""
+        with traced("vector_search"):
+            return self.vectorstore.similarity_search_by_vector(embedding, k=self.k)
+
+    async def _asearch(self, query: str, embedding: List[float]) -> List[Document]:
+        with traced("vector_search"):
+            return await self.vectorstore.asimilarity_search_by_vector(embedding, k=self.k)
+
+
+def create_retrieval_cache(config: Optional[KnowledgeBaseSettings] = None) -> RetrievalCache:
+    """Create retrieval cache of the knowledge base (configured in settings by default)"""
+    config = config or settings.knowledge_base
+    return RetrievalCache(
+        max_queries=config.CACHE_MAX_QUERIES,
+        max_results=config.CACHE_MAX_RESULTS,
+        ttl_seconds=config.CACHE_TTL_SECONDS,
+        similarity_threshold=config.CACHE_SIMILARITY_THRESHOLD,
+        index_watcher=IndexVersionWatcher(config),
+    )
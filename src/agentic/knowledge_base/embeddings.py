@@ -0,0 +1,266 @@
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import openai
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+
+from ...metrics import registry
+from ...rate_limiter import TokenBucket
+from ...settings import settings
+from ...tracing import traced
+
+
+# Errors which are worth retrying: rate limits, timeouts, connection problems and server errors
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+embedding_requests = registry.counter(
+    "embedding_requests_total",
+    "Embedding API requests by result",
+    ["result"],
+)
+embedding_request_seconds = registry.histogram(
+    "embedding_request_seconds",
+    "Duration of embedding API requests",
+)
+embedding_cache_lookups = registry.counter(
+    "embedding_disk_cache_lookups_total",
+    "Lookups of texts in the persistent embedding cache by result",
+    ["result"],
+)
+
+
+def _estimate_tokens(text: str) -> int:
+    """Rough token count used for rate limiting, exact count is not needed to stay within the limit"""
+    return len(text) // 3 + 1
+
+
+class EmbeddingCache:
+    """Persistent cache of embeddings in SQLite keyed by hash of the model name and text"""
+
+    def __init__(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, List[float]]:
+        """Get cached embeddings of the keys which are present in the cache"""
+        found: Dict[str, List[float]] = {}
+        with self._lock:
+            # SQLite limits number of query parameters, so keys are looked up in chunks
+            for start in range(0, len(keys), 500):
+                chunk = list(keys[start:start + 500])
+                rows = self._connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, items: Dict[str, List[float]]) -> None:
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items.items()],
+            )
+
+
+class EmbeddingService(Embeddings):
+    """
+    Embedding client for index builds and queries:
+    - texts are embedded in batches, several batches are requested concurrently;
+    - requests and tokens are rate limited with token buckets;
+    - rate limits, timeouts and server errors are retried with exponential backoff (honoring Retry-After);
+    - embeddings of documents are stored in a persistent cache, so unchanged texts are never embedded again
+      and an interrupted index build continues from the embedded batches.
+    """
+
+    def __init__(
+        self,
+        client: OpenAIEmbeddings,
+        batch_size: int,
+        max_concurrency: int,
+        max_retries: int,
+        retry_min_seconds: float,
+        retry_max_seconds: float,
+        requests_per_minute: float = 0,
+        tokens_per_minute: float = 0,
+        cache: Optional[EmbeddingCache] = None,
+    ) -> None:
+        self.client = client
+        self.model = client.model
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.retry_min_seconds = retry_min_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.cache = cache
+        # Limits of embedding APIs are per minute, so a full minute of the limit can be used at once
+        self._request_limiter = TokenBucket(requests_per_minute / 60, requests_per_minute) if requests_per_minute > 0 else None
+        self._token_limiter = TokenBucket(tokens_per_minute / 60, tokens_per_minute) if tokens_per_minute > 0 else None
+
+    def _retry_delay(self, error: Exception, attempt: int, delay: float) -> float:
+        """Delay before the retry: Retry-After header if the API sent it, otherwise the backoff delay with jitter"""
+        embedding_requests.inc(result="retry")
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        try:
+            wait = min(float(retry_after), self.retry_max_seconds) if retry_after is not None else None
+        except ValueError:
+            wait = None
+        # Jitter spreads retries of concurrent batches
+        wait = wait or delay * random.uniform(0.5, 1.5)
+        logging.warning(f"Embedding request failed ({type(error).__name__}), retry {attempt}/{self.max_retries} in {wait:.1f}s")
+        return wait
+
+    def _rate_limit_delay(self, texts: List[str]) -> float:
+        delay = 0.0
+        if self._request_limiter is not None:
+            delay = max(delay, self._request_limiter.reserve(1))
+        if self._token_limiter is not None:
+            delay = max(delay, self._token_limiter.reserve(sum(_estimate_tokens(text) for text in texts)))
+        return delay
+
+    async def _arequest(self, texts: List[str]) -> List[List[float]]:
+        """Embed one batch, retrying transient errors"""
+        await asyncio.sleep(self._rate_limit_delay(texts))
+        delay = self.retry_min_seconds
+        for attempt in range(1, self.max_retries + 2):
+            started_at = time.monotonic()
+            try:
+                with traced("embedding.request", **{"embedding.texts": len(texts)}):
+                    embeddings = await self.client.aembed_documents(texts)
+            except RETRYABLE_ERRORS as e:
+                if attempt > self.max_retries:
+                    embedding_requests.inc(result="error")
+                    raise
+                await asyncio.sleep(self._retry_delay(e, attempt, delay))
+                delay = min(delay * 2, self.retry_max_seconds)
+                continue
+            embedding_request_seconds.observe(time.monotonic() - started_at)
+            embedding_requests.inc(result="success")
+            return embeddings
+
+    def _request(self, texts: List[str]) -> List[List[float]]:
+        """Sync version of _arequest. Sync calls use the sync API client, async client is bound to the event loop"""
+        time.sleep(self._rate_limit_delay(texts))
+        delay = self.retry_min_seconds
+        for attempt in range(1, self.max_retries + 2):
+            started_at = time.monotonic()
+            try:
+                with traced("embedding.request", **{"embedding.texts": len(texts)}):
+                    embeddings = self.client.embed_documents(texts)
+            except RETRYABLE_ERRORS as e:
+                if attempt > self.max_retries:
+                    embedding_requests.inc(result="error")
+                    raise
+                time.sleep(self._retry_delay(e, attempt, delay))
+                delay = min(delay * 2, self.retry_max_seconds)
+                continue
+            embedding_request_seconds.observe(time.monotonic() - started_at)
+            embedding_requests.inc(result="success")
+            return embeddings
+
+    def _lookup(self, keys: List[str]) -> Dict[str, List[float]]:
+        cached = self.cache.get_many(keys) if self.cache is not None and keys else {}
+        embedding_cache_lookups.inc(len(cached), result="hit")
+        embedding_cache_lookups.inc(len(keys) - len(cached), result="miss")
+        return cached
+
+    def _missing_batches(self, keys: List[str], texts: List[str], cached: Dict[str, List[float]]) -> List[Dict[str, str]]:
+        """Split texts which are not cached into batches. Same text is embedded once even if it is repeated"""
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                missing.setdefault(key, text)
+        missing_keys = list(missing)
+        if missing_keys:
+            logging.info(f"Embedding {len(missing_keys)} texts, {len(set(keys)) - len(missing_keys)} taken from the cache")
+        return [
+            {key: missing[key] for key in missing_keys[start:start + self.batch_size]}
+            for start in range(0, len(missing_keys), self.batch_size)
+        ]
+
+    def _store(self, batch: Dict[str, str], embeddings: List[List[float]], cached: Dict[str, List[float]]) -> Dict[str, List[float]]:
+        """Store embeddings of the batch at once, so an interrupted build doesn't embed it again"""
+        embedded = dict(zip(batch, embeddings))
+        cached.update(embedded)
+        return embedded
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [EmbeddingCache.key(self.model, text) for text in texts]
+        cached = await asyncio.to_thread(self._lookup, keys)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def embed_batch(batch: Dict[str, str]) -> None:
+            async with semaphore:
+                embeddings = await self._arequest(list(batch.values()))
+            embedded = self._store(batch, embeddings, cached)
+            if self.cache is not None:
+                await asyncio.to_thread(self.cache.put_many, embedded)
+
+        await asyncio.gather(*(embed_batch(batch) for batch in self._missing_batches(keys, texts, cached)))
+        return [cached[key] for key in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [EmbeddingCache.key(self.model, text) for text in texts]
+        cached = self._lookup(keys)
+
+        def embed_batch(batch: Dict[str, str]) -> None:
+            embedded = self._store(batch, self._request(list(batch.values())), cached)
+            if self.cache is not None:
+                self.cache.put_many(embedded)
+
+        batches = self._missing_batches(keys, texts, cached)
+        if batches:
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                # list() re-raises the first error of the batches
+                list(executor.map(embed_batch, batches))
+        return [cached[key] for key in keys]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        # Queries are cached in memory by the retrieval cache, so they are not stored on disk
+        return (await self._arequest([text]))[0]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._request([text])[0]
+
+
+def create_embedding_service() -> EmbeddingService:
+    """Create embedding service from settings"""
+    client = OpenAIEmbeddings(
+        api_key=settings.embedder.API_KEY,
+        model=settings.embedder.MODEL,
+        base_url=settings.embedder.BASE_API,
+        openai_proxy=settings.embedder.PROXY_URL,
+        chunk_size=settings.embedder.BATCH_SIZE,
+        timeout=settings.embedder.TIMEOUT,
+        # Retries are done by the service, so they respect the rate limiter
+        max_retries=0,
+    )
+    return EmbeddingService(
+        client=client,
+        batch_size=settings.embedder.BATCH_SIZE,
+        max_concurrency=settings.embedder.MAX_CONCURRENCY,
+        max_retries=settings.embedder.MAX_RETRIES,
+        retry_min_seconds=settings.embedder.RETRY_MIN_SECONDS,
+        retry_max_seconds=settings.embedder.RETRY_MAX_SECONDS,
+        requests_per_minute=settings.embedder.REQUESTS_PER_MINUTE,
+        tokens_per_minute=settings.embedder.TOKENS_PER_MINUTE,
+        cache=EmbeddingCache(settings.embedder.CACHE_PATH) if settings.embedder.CACHE_PATH else None,
+    )
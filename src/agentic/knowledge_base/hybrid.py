@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+from pydantic import Field, PrivateAttr
+
+from ...metrics import registry
+from ...tracing import traced
+from .cache import CachedRetriever
+from .index import IndexVersionWatcher
+from .keyword import BM25Index
+
+
+retrieval_candidates = registry.histogram(
+    "retrieval_candidates",
+    "Number of candidates found by every retrieval method before fusion",
+    ["method"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50),
+)
+
+
+def _document_key(document: Document) -> str:
+    return document.id or document.metadata.get("content_hash") or document.page_content
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[Document]], k: int = 60) -> List[Tuple[Document, float]]:
+    """Merge ranked lists of documents: every document gets sum of 1 / (k + rank) over the lists it appears in"""
+    scores: Dict[str, float] = {}
+    documents: Dict[str, Document] = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking, start=1):
+            key = _document_key(document)
+            documents.setdefault(key, document)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return [(documents[key], score) for key, score in sorted(scores.items(), key=lambda item: -item[1])]
+
+
+class CrossEncoderReranker:
+    """Local cross-encoder reranker, requires optional sentence-transformers package"""
+
+    def __init__(self, model_name: str) -> None:
+        try:
+            from sentence_transformers import CrossEncoder
+        except ImportError as e:
+            raise ImportError("Reranking requires sentence-transformers package: pip install sentence-transformers") from e
+        self.model = CrossEncoder(model_name)
+
+    def rerank(self, query: str, documents: Sequence[Document]) -> List[Tuple[Document, float]]:
+        """Score documents by relevance to the query, best first"""
+        if not documents:
+            return []
+        scores = self.model.predict([(query, document.page_content) for document in documents])
+        return sorted(zip(documents, (float(score) for score in scores)), key=lambda item: -item[1])
+
+
+class HybridRetriever(CachedRetriever):
+    """
+    Cached retriever which combines vector search with BM25 keyword search by reciprocal rank fusion,
+    optionally reranks fused candidates with a cross-encoder and returns k best sections.
+    The keyword index is built from the vector store sections and rebuilt when the index version changes.
+    """
+
+    fetch_k: int = 10
+    rrf_k: int = 60
+    vector_max_distance: Optional[float] = None
+    keyword_min_score: float = 0.0
+    reranker: Optional[Any] = None
+    rerank_min_score: Optional[float] = None
+    index_watcher: IndexVersionWatcher = Field(default_factory=IndexVersionWatcher)
+
+    _keyword_index: Optional[BM25Index] = PrivateAttr(default=None)
+    _index_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def refresh_keyword_index(self) -> BM25Index:
+        """Get the keyword index, rebuilding it if the knowledge base index was updated"""
+        with self._index_lock:
+            if self.index_watcher.check() or self._keyword_index is None:
+                self._keyword_index = BM25Index.from_vectorstore(self.vectorstore)
+                logging.info(f"Built keyword index of {len(self._keyword_index)} knowledge base sections")
+            return self._keyword_index
+
+    def _vector_candidates(self, embedding: List[float]) -> List[Document]:
+        with traced("vector_search"):
+            results = self.vectorstore.similarity_search_by_vector_with_relevance_scores(embedding, k=self.fetch_k)
+        # Chroma returns distances, lower is more similar
+        return [document for document, distance in results if self.vector_max_distance is None or distance <= self.vector_max_distance]
+
+    def _keyword_candidates(self, query: str) -> List[Document]:
+        with traced("keyword_search"):
+            results = self.refresh_keyword_index().search(query, k=self.fetch_k, min_score=self.keyword_min_score)
+        return [document for document, _ in results]
+
+    def _fuse(self, query: str, vector_candidates: List[Document], keyword_candidates: List[Document]) -> List[Document]:
+        retrieval_candidates.observe(len(vector_candidates), method="vector")
+        retrieval_candidates.observe(len(keyword_candidates), method="keyword")
+        candidates = [document for document, _ in reciprocal_rank_fusion([vector_candidates, keyword_candidates], k=self.rrf_k)]
+        if self.reranker is None:
+            return candidates[:self.k]
+
+        with traced("rerank", **{"rerank.candidates": len(candidates)}):
+            reranked = self.reranker.rerank(query, candidates)
+        return [
+            document for document, score in reranked
+            if self.rerank_min_score is None or score >= self.rerank_min_score
+        ][:self.k]
+
+    def _search(self, query: str, embedding: List[float]) -> List[Document]:
+        return self._fuse(query, self._vector_candidates(embedding), self._keyword_candidates(query))
+
+    async def _asearch(self, query: str, embedding: List[float]) -> List[Document]:
+        # Chroma and BM25 searches are synchronous, they run concurrently in threads
+        vector_candidates, keyword_candidates = await asyncio.gather(
+            asyncio.to_thread(self._vector_candidates, embedding),
+            asyncio.to_thread(self._keyword_candidates, query),
+        )
+        if self.reranker is None:
+            return self._fuse(query, vector_candidates, keyword_candidates)
+        return await asyncio.to_thread(self._fuse, query, vector_candidates, keyword_candidates)
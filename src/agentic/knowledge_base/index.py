@@ -0,0 +1,191 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+from langchain_chroma import Chroma
+
+from ...settings import KnowledgeBaseSettings, settings
+from .embeddings import EmbeddingService, create_embedding_service
+from .loader import load_sections
+
+
+# Manifest is written to the Chroma directory after every index update, its version changes whenever indexed content changes
+MANIFEST_FILE_NAME = "index-manifest.json"
+
+# Number of sections embedded and added to the vector store at once
+ADD_BATCH_SIZE = 64
+
+
+def create_embeddings() -> EmbeddingService:
+    """Create embedding client from settings. For now, we are using OpenAI-compatible API, but it can be made more configurable in the future"""
+    return create_embedding_service()
+
+
+@lru_cache(maxsize=None)
+def shared_embeddings() -> EmbeddingService:
+    """Embedding client shared by all knowledge bases of the process, so they share its rate limits and cache"""
+    return create_embeddings()
+
+
+def open_vectorstore(config: Optional[KnowledgeBaseSettings] = None) -> Chroma:
+    """Open (or create empty) persistent Chroma collection of the knowledge base (configured in settings by default)"""
+    config = config or settings.knowledge_base
+    return Chroma(
+        persist_directory=config.CHROMA_DIR,
+        collection_name=config.COLLECTION_NAME,
+        embedding_function=shared_embeddings(),
+    )
+
+
+@dataclass
+class IndexSyncResult:
+    """Result of the knowledge base index synchronization"""
+    added: List[str] = field(default_factory=list)
+    deleted: List[str] = field(default_factory=list)
+    unchanged: int = 0
+    version: Optional[str] = None
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.added or self.deleted)
+
+
+def _index_version(ids: List[str]) -> str:
+    """
+    Version of the index is a hash of the embedding model and all section ids, which are content hashes themselves,
+    so caches keyed by the version are invalidated when either changes
+    """
+    return hashlib.sha256("\n".join([settings.embedder.MODEL, *sorted(ids)]).encode("utf-8")).hexdigest()
+
+
+def write_manifest(version: str, sections_count: int, sources: List[str], config: Optional[KnowledgeBaseSettings] = None) -> None:
+    """Write index manifest to the Chroma directory"""
+    config = config or settings.knowledge_base
+    manifest_path = os.path.join(config.CHROMA_DIR, MANIFEST_FILE_NAME)
+    manifest = {
+        "version": version,
+        "sections": sections_count,
+        "sources": sources,
+        "embedder_model": settings.embedder.MODEL,
+        "updated_at": time.time(),
+    }
+    os.makedirs(config.CHROMA_DIR, exist_ok=True)
+    # Write to a temporary file first so readers never see a half-written manifest
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(manifest, file, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def read_manifest(config: Optional[KnowledgeBaseSettings] = None) -> Dict[str, Any]:
+    """Read index manifest, empty if the index was never built"""
+    manifest_path = os.path.join((config or settings.knowledge_base).CHROMA_DIR, MANIFEST_FILE_NAME)
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def read_index_version(config: Optional[KnowledgeBaseSettings] = None) -> Optional[str]:
+    """Read index version from the manifest, None if the index was never built"""
+    return read_manifest(config).get("version")
+
+
+class IndexVersionWatcher:
+    """Detects index rebuilds. The manifest is read only if its modification time changed since the previous check"""
+
+    def __init__(self, config: Optional[KnowledgeBaseSettings] = None) -> None:
+        self.config = config or settings.knowledge_base
+        self._manifest_path = os.path.join(self.config.CHROMA_DIR, MANIFEST_FILE_NAME)
+        self._manifest_mtime: Optional[int] = None
+        self.version: Optional[str] = None
+
+    def check(self) -> bool:
+        """Returns True if the index version changed since the previous check"""
+        try:
+            mtime = os.stat(self._manifest_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self._manifest_mtime:
+            return False
+
+        self._manifest_mtime = mtime
+        version = read_index_version(self.config)
+        if version == self.version:
+            return False
+        self.version = version
+        return True
+
+
+def sync_index(
+    vectorstore: Optional[Chroma] = None,
+    dry_run: bool = False,
+    config: Optional[KnowledgeBaseSettings] = None,
+    rebuild: bool = False,
+    allow_empty: bool = False,
+) -> IndexSyncResult:
+    """
+    Synchronize vector store with knowledge base source files.
+    Only sections which were added or changed are embedded, sections which were removed or changed are deleted from the store.
+    With `rebuild` the collection is dropped first and all sections are embedded again.
+    If no sections are found (e.g. the source directory is not mounted), the index is left as it is unless `allow_empty` is set.
+    An index built with another embedding model can't be updated, it has to be rebuilt.
+    """
+    config = config or settings.knowledge_base
+    vectorstore = vectorstore or open_vectorstore(config)
+    sections = load_sections(config.SOURCE_DIR, config.SOURCE_GLOB)
+    if not sections and not allow_empty:
+        raise ValueError(
+            f"No knowledge base sections found in {config.SOURCE_DIR} matching {config.SOURCE_GLOB}, the index is left as it is"
+        )
+    sections_by_id = {section.id: section for section in sections}
+    index_model = read_manifest(config).get("embedder_model")
+    if not rebuild and index_model is not None and index_model != settings.embedder.MODEL:
+        raise ValueError(
+            f"Knowledge base index in {config.CHROMA_DIR} was built with embedding model {index_model}, "
+            f"but EMBEDDER_MODEL is {settings.embedder.MODEL}: rebuild the index with --rebuild"
+        )
+    if rebuild and not dry_run:
+        logging.info("Dropping existing collection")
+        vectorstore.reset_collection()
+
+    # Only ids are needed to find the difference, so documents and embeddings are not loaded
+    existing_ids = set(vectorstore.get(include=[])["ids"])
+    new_ids = [doc_id for doc_id in sections_by_id if doc_id not in existing_ids]
+    removed_ids = sorted(existing_ids - sections_by_id.keys())
+
+    result = IndexSyncResult(
+        added=new_ids,
+        deleted=removed_ids,
+        unchanged=len(sections_by_id) - len(new_ids),
+        version=_index_version(list(sections_by_id)),
+    )
+    logging.info(
+        f"Knowledge base index: {len(new_ids)} sections to add, {len(removed_ids)} to delete, {result.unchanged} unchanged"
+    )
+    if dry_run:
+        return result
+
+    if removed_ids:
+        vectorstore.delete(ids=removed_ids)
+
+    # Embed all new sections at once, so batches are requested concurrently. Embeddings are stored in the persistent cache,
+    # so adding documents below doesn't call the API again and an interrupted build doesn't embed them again
+    if new_ids and getattr(vectorstore.embeddings, "cache", None) is not None:
+        vectorstore.embeddings.embed_documents([sections_by_id[doc_id].page_content for doc_id in new_ids])
+
+    # Add sections in batches so an interrupted build keeps already added sections and continues from them on the next run
+    for start in range(0, len(new_ids), ADD_BATCH_SIZE):
+        batch_ids = new_ids[start:start + ADD_BATCH_SIZE]
+        vectorstore.add_documents(documents=[sections_by_id[doc_id] for doc_id in batch_ids], ids=batch_ids)
+        logging.info(f"Added {min(start + ADD_BATCH_SIZE, len(new_ids))}/{len(new_ids)} sections")
+
+    sources = sorted({section.metadata["source"] for section in sections})
+    write_manifest(result.version, len(sections_by_id), sources, config)
+    return result
@@ -0,0 +1,71 @@
+import math
+import re
+from collections import Counter, defaultdict
+from typing import Dict, List, Sequence, Tuple
+
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# Tokens are cut to this length, a cheap replacement of stemming for Russian inflections ("услуги", "услугах" -> "услуги")
+STEM_LENGTH = 6
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercase word tokens cut to STEM_LENGTH characters"""
+    return [token[:STEM_LENGTH] for token in TOKEN_PATTERN.findall(text.lower().replace("ё", "е"))]
+
+
+class BM25Index:
+    """
+    In-memory Okapi BM25 index of knowledge base sections. It finds sections by exact words (names of sections,
+    cases and services) which dense retrieval often misses. The knowledge base is small, so the index is rebuilt from scratch.
+    """
+
+    def __init__(self, documents: Sequence[Document], k1: float = 1.5, b: float = 0.75) -> None:
+        self.documents = list(documents)
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        self._lengths: List[int] = []
+        for index, document in enumerate(self.documents):
+            tokens = tokenize(document.page_content)
+            self._lengths.append(len(tokens))
+            for term, frequency in Counter(tokens).items():
+                self._postings[term].append((index, frequency))
+
+        self._average_length = sum(self._lengths) / len(self._lengths) if self._lengths else 0.0
+        documents_count = len(self.documents)
+        self._idf = {
+            term: math.log(1 + (documents_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self._postings.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def search(self, query: str, k: int, min_score: float = 0.0) -> List[Tuple[Document, float]]:
+        """Find k best matching sections with score above min_score, best first"""
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self._idf.get(term)
+            if idf is None:
+                continue
+            for index, frequency in self._postings[term]:
+                length_norm = 1 - self.b + self.b * self._lengths[index] / self._average_length
+                scores[index] += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+
+        ranked = sorted(((index, score) for index, score in scores.items() if score > min_score), key=lambda item: -item[1])
+        return [(self.documents[index], score) for index, score in ranked[:k]]
+
+    @classmethod
+    def from_vectorstore(cls, vectorstore: Chroma) -> "BM25Index":
+        """Build index from the sections stored in the vector store, so both indexes always contain the same sections"""
+        result = vectorstore.get(include=["documents", "metadatas"])
+        documents = [
+            Document(id=doc_id, page_content=content, metadata=metadata or {})
+            for doc_id, content, metadata in zip(result["ids"], result["documents"], result["metadatas"])
+        ]
+        return cls(documents)
@@ -0,0 +1,69 @@
+import hashlib
+import logging
+import os
+from pathlib import Path
+from typing import List
+
+from langchain_core.documents import Document
+from langchain_text_splitters import MarkdownHeaderTextSplitter
+
+
+def load_and_split_markdown(file_path: str) -> List[Document]:
+    """Loads a markdown file and splits it into sections based on headers."""
+    logging.info(f"Loading markdown file {file_path}")
+    with open(file_path, "r", encoding="utf-8") as file:
+        raw_text = file.read()
+
+    # Split the text into sections based on headers. Need to make it configurable in the future
+    splitter = MarkdownHeaderTextSplitter(
+        headers_to_split_on=[("#", "Header 1")],
+        strip_headers=False
+    )
+
+    split_docs = splitter.split_text(raw_text)
+
+    # Filter out empty sections
+    filtered_split_docs = []
+    for split_id, split in enumerate(split_docs):
+        if not split.metadata.get("Header 1", "").strip() and split.page_content.replace("#", "").replace("\n", "").strip() == "":
+            logging.debug(f"Skip empty section {split_id} with no header and no content")
+            continue
+        filtered_split_docs.append(split)
+
+    logging.info(f"Number of sections in {file_path}: {len(filtered_split_docs)}")
+    for i, doc in enumerate(filtered_split_docs):
+        logging.debug(f"Section {i+1}: {doc.metadata.get('Header 1', 'No header')}: {doc.page_content[:100]}...")
+
+    return filtered_split_docs
+
+
+def section_id(source: str, content: str) -> str:
+    """Content hash of the section which is used as its id in the vector store"""
+    return hashlib.sha256(f"{source}\n{content}".encode("utf-8")).hexdigest()
+
+
+def load_sections(source_dir: str, source_glob: str) -> List[Document]:
+    """
+    Load and split all markdown files of the knowledge base.
+    Every section gets "source" (path relative to source_dir) and "content_hash" metadata. Content hash is used as section id,
+    so changed sections get new ids and unchanged sections keep their ids between index builds.
+    """
+    sections: List[Document] = []
+    seen_ids = set()
+    for path in sorted(Path(source_dir).glob(source_glob)):
+        if not path.is_file():
+            continue
+        source = path.relative_to(source_dir).as_posix()
+        for doc in load_and_split_markdown(os.fspath(path)):
+            doc_id = section_id(source, doc.page_content)
+            # Sections with the same content in the same file are indexed once
+            if doc_id in seen_ids:
+                logging.debug(f"Skip duplicated section in {source}: {doc.metadata.get('Header 1', 'No header')}")
+                continue
+            seen_ids.add(doc_id)
+            doc.id = doc_id
+            doc.metadata["source"] = source
+            doc.metadata["content_hash"] = doc_id
+            sections.append(doc)
+
+    return sections
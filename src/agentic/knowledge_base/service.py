@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import time
+from typing import List, Literal, Optional
+
+from langchain_chroma import Chroma
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict
+
+from ...metrics import registry
+from ...settings import KnowledgeBaseSettings, settings
+from .cache import CachedRetriever, create_retrieval_cache
+from .hybrid import CrossEncoderReranker, HybridRetriever
+from .index import IndexVersionWatcher, open_vectorstore
+
+
+# Text returned by the retriever while the knowledge base is not ready, so the agent answers without it instead of failing
+UNAVAILABLE_MESSAGE = (
+    "База знаний временно недоступна. Ответь пользователю по общим сведениям о компании, "
+    "не придумывая конкретных фактов, и предложи уточнить детали позже."
+)
+
+# Query embedded during warm-up to check that the embedding provider is reachable
+WARMUP_QUERY = "AllSee"
+
+KnowledgeBaseState = Literal["not_started", "loading", "ready", "failed"]
+
+knowledge_base_ready = registry.gauge(
+    "knowledge_base_ready",
+    "1 if the knowledge base retriever is ready, 0 otherwise",
+    ["knowledge_base"],
+)
+knowledge_base_unavailable_requests = registry.counter(
+    "knowledge_base_unavailable_requests_total",
+    "Retrieval requests answered without the knowledge base because it was not ready",
+    ["knowledge_base"],
+)
+
+
+class KnowledgeBase:
+    """
+    Knowledge base retriever which is created in a background warm-up task instead of import time:
+    the Chroma collection is opened in a thread and the embedding provider is checked with a probe query.
+    Failed warm-ups are retried with exponential backoff, the bot works without the knowledge base meanwhile.
+    """
+
+    def __init__(
+        self,
+        retry_seconds: float,
+        max_retry_seconds: float,
+        ready_wait_seconds: float,
+        config: Optional[KnowledgeBaseSettings] = None,
+        name: str = "default",
+    ) -> None:
+        self.name = name
+        self.config = config or settings.knowledge_base
+        self.retry_seconds = retry_seconds
+        self.max_retry_seconds = max_retry_seconds
+        self.ready_wait_seconds = ready_wait_seconds
+        self.state: KnowledgeBaseState = "not_started"
+        self.last_error: Optional[str] = None
+        self._retriever: Optional[CachedRetriever] = None
+        self._ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._retriever is not None
+
+    @property
+    def retriever(self) -> Optional[CachedRetriever]:
+        """Retriever of the knowledge base, None until the warm-up is complete"""
+        return self._retriever
+
+    def start(self) -> None:
+        """Start the warm-up in a background task, does nothing if it is already started"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._warm_up(), name=f"KnowledgeBaseWarmUp-{self.name}")
+
+    async def stop(self) -> None:
+        """Cancel the warm-up if it is still running"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def wait_ready(self, timeout: float) -> bool:
+        """Wait until the knowledge base is ready. Returns False if it is not ready within the timeout"""
+        if self.ready:
+            return True
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def _warm_up(self) -> None:
+        """Create the retriever, retrying until it succeeds"""
+        delay = self.retry_seconds
+        attempt = 1
+        while True:
+            self.state = "loading"
+            try:
+                self._retriever = await self._create_retriever()
+            except Exception as e:
+                self.state = "failed"
+                self.last_error = str(e)
+                logging.error(f"Knowledge base {self.name} warm-up attempt {attempt} failed, retrying in {delay:g}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_retry_seconds)
+                attempt += 1
+                continue
+
+            self.state = "ready"
+            self.last_error = None
+            knowledge_base_ready.set(1, knowledge_base=self.name)
+            self._ready.set()
+            return
+
+    async def _create_retriever(self) -> CachedRetriever:
+        started_at = time.monotonic()
+        # Chroma opens its SQLite database synchronously, so it is done in a thread to not block the event loop
+        vectorstore = await asyncio.to_thread(open_vectorstore, self.config)
+        doc_count = await asyncio.to_thread(vectorstore._collection.count)
+        opened_at = time.monotonic()
+        if doc_count == 0:
+            logging.warning(f"Knowledge base {self.name} index is empty, run `python -m src.agentic.knowledge_base` to build it")
+
+        await vectorstore.embeddings.aembed_query(WARMUP_QUERY)
+        checked_at = time.monotonic()
+
+        retriever = await asyncio.to_thread(self._create_search, vectorstore)
+        logging.info(
+            f"Knowledge base {self.name} is ready with {doc_count} documents: vector store opened in {opened_at - started_at:.2f}s, "
+            f"embedding provider checked in {checked_at - opened_at:.2f}s, "
+            f"{self.config.RETRIEVAL_MODE} search prepared in {time.monotonic() - checked_at:.2f}s"
+        )
+        return retriever
+
+    def _create_search(self, vectorstore: Chroma) -> CachedRetriever:
+        """Create retriever of the configured search mode, keyword index and reranker model are loaded here"""
+        config = self.config
+        if config.RETRIEVAL_MODE == "vector":
+            return CachedRetriever(
+                vectorstore=vectorstore,
+                embeddings=vectorstore.embeddings,
+                cache=create_retrieval_cache(config),
+                k=config.RETRIEVAL_K,
+            )
+
+        reranker = None
+        if config.RERANKER_MODEL:
+            try:
+                reranker = CrossEncoderReranker(config.RERANKER_MODEL)
+            except ImportError as e:
+                # Misconfiguration shouldn't leave the bot without the knowledge base
+                logging.error(f"Reranker is disabled: {e}")
+        retriever = HybridRetriever(
+            vectorstore=vectorstore,
+            embeddings=vectorstore.embeddings,
+            cache=create_retrieval_cache(config),
+            k=config.RETRIEVAL_K,
+            fetch_k=config.RETRIEVAL_FETCH_K,
+            rrf_k=config.RETRIEVAL_RRF_K,
+            vector_max_distance=config.RETRIEVAL_VECTOR_MAX_DISTANCE,
+            keyword_min_score=config.RETRIEVAL_KEYWORD_MIN_SCORE,
+            reranker=reranker,
+            rerank_min_score=config.RERANK_MIN_SCORE,
+            index_watcher=IndexVersionWatcher(config),
+        )
+        retriever.refresh_keyword_index()
+        return retriever
+
+
+class KnowledgeBaseRetriever(BaseRetriever):
+    """
+    Retriever which delegates to the knowledge base retriever when it is ready.
+    The warm-up is started by the first query if it wasn't started with the bot (knowledge bases of tenants are loaded lazily).
+    Queries received during the warm-up wait for it a bit, then get a notice that the knowledge base is unavailable.
+    """
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    knowledge_base: KnowledgeBase
+
+    def _unavailable(self) -> List[Document]:
+        knowledge_base_unavailable_requests.inc(knowledge_base=self.knowledge_base.name)
+        return [Document(page_content=UNAVAILABLE_MESSAGE)]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        retriever = self.knowledge_base.retriever
+        if retriever is None:
+            return self._unavailable()
+        return retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        self.knowledge_base.start()
+        if not await self.knowledge_base.wait_ready(self.knowledge_base.ready_wait_seconds):
+            logging.warning(f"Knowledge base {self.knowledge_base.name} is not ready ({self.knowledge_base.state}), answering without it")
+            return self._unavailable()
+        return await self.knowledge_base.retriever.ainvoke(query, config={"callbacks": run_manager.get_child()})
+
+
+def create_knowledge_base(config: Optional[KnowledgeBaseSettings] = None, name: str = "default") -> KnowledgeBase:
+    """
+    Create knowledge base (configured in settings by default). Its warm-up is started with start() in the running event loop
+    or by the first retrieval query
+    """
+    config = config or settings.knowledge_base
+    return KnowledgeBase(
+        retry_seconds=config.WARMUP_RETRY_SECONDS,
+        max_retry_seconds=config.WARMUP_MAX_RETRY_SECONDS,
+        ready_wait_seconds=config.READY_WAIT_SECONDS,
+        config=config,
+        name=name,
+    )
@@ -1,13 +1,50 @@
+from typing import Optional
+
 from langchain_openai import ChatOpenAI
-import httpx
 
+from .router import ModelEndpoint, ModelRouter
 from ..settings import settings
 
 
-# For now, we are using OpenAI's ChatGPT model, but in the future, we need to make model selection more configurable.
-llm: ChatOpenAI = ChatOpenAI(
-    api_key=settings.llm.API_KEY,
-    model=settings.llm.MODEL,
-    base_url=settings.llm.BASE_API,
-    openai_proxy=settings.llm.PROXY_URL,
-)
+def create_chat_model(model: str, base_url: Optional[str], api_key: str) -> ChatOpenAI:
+    """Create client of an OpenAI-compatible endpoint"""
+    return ChatOpenAI(
+        api_key=api_key,
+        model=model,
+        base_url=base_url,
+        openai_proxy=settings.llm.PROXY_URL,
+        timeout=settings.llm.TIMEOUT,
+        max_retries=settings.llm.MAX_RETRIES,
+        # Token usage of streamed responses is used for tracing
+        stream_usage=settings.llm.STREAM_USAGE,
+    )
+
+
+def create_model_router() -> ModelRouter:
+    """Create the model router from settings: the main model, optional fast model and optional secondary endpoint"""
+    config = settings.llm
+    fast = secondary = None
+    if config.FAST_MODEL:
+        fast = ModelEndpoint("fast", create_chat_model(config.FAST_MODEL, config.BASE_API, config.API_KEY))
+    if config.SECONDARY_BASE_API or config.SECONDARY_MODEL:
+        secondary = ModelEndpoint("secondary", create_chat_model(
+            config.SECONDARY_MODEL or config.MODEL,
+            config.SECONDARY_BASE_API or config.BASE_API,
+            config.SECONDARY_API_KEY or config.API_KEY,
+        ))
+    return ModelRouter(
+        main=ModelEndpoint("main", create_chat_model(config.MODEL, config.BASE_API, config.API_KEY)),
+        fast=fast,
+        secondary=secondary,
+        fast_max_chars=config.FAST_MAX_CHARS,
+        fast_pattern=config.FAST_PATTERN,
+        hedge=config.HEDGE,
+        hedge_percentile=config.HEDGE_PERCENTILE,
+        hedge_delay=config.HEDGE_DELAY,
+        hedge_min_delay=config.HEDGE_MIN_DELAY,
+        prompt_cache_key=config.PROMPT_CACHE_KEY,
+    )
+
+
+# All agents share the router, it sends every request to the model and endpoint which fit it best
+llm: ModelRouter = create_model_router()
@@ -0,0 +1,325 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel, LanguageModelInput
+from langchain_core.language_models.base import LangSmithParams
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_core.runnables import Runnable
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from langchain_openai import ChatOpenAI
+from pydantic import ConfigDict
+
+from ..metrics import registry
+from .text import normalize_text
+
+
+# Response metadata key with the model which actually answered, token usage is attributed to it (see src/tracing.py)
+ROUTED_MODEL_KEY = "routed_model"
+
+llm_requests = registry.counter(
+    "llm_requests_total",
+    "LLM requests by model, endpoint and result (success, error, cancelled by the hedged duplicate)",
+    ["model", "endpoint", "result"],
+)
+llm_first_token_seconds = registry.histogram(
+    "llm_first_token_seconds",
+    "Time to the first streamed token (to the whole response for non-streamed requests) by model and endpoint",
+    ["model", "endpoint"],
+)
+llm_request_seconds = registry.histogram(
+    "llm_request_seconds",
+    "Duration of LLM requests which produced the response, by model and endpoint",
+    ["model", "endpoint"],
+)
+llm_routed_requests = registry.counter(
+    "llm_routed_requests_total",
+    "LLM requests by route: fast (small talk answered by the fast model) or main",
+    ["route"],
+)
+llm_hedged_requests = registry.counter(
+    "llm_hedged_requests_total",
+    "Requests duplicated to the backup endpoint because the first one exceeded its latency budget, by route and winner",
+    ["route", "winner"],
+)
+llm_failovers = registry.counter(
+    "llm_failovers_total",
+    "Requests retried at the backup endpoint because the first endpoint failed, by route",
+    ["route"],
+)
+
+
+class ModelEndpoint:
+    """Chat model of an API endpoint and recent latencies of its responses"""
+
+    # Latency percentile is used as the hedging budget only when there are enough samples
+    MIN_SAMPLES = 20
+
+    def __init__(self, name: str, model: ChatOpenAI, window: int = 200) -> None:
+        self.name = name
+        self.model = model
+        # Time to the first chunk of streamed responses and time to non-streamed responses are kept apart
+        self._latencies: Dict[bool, Deque[float]] = {False: deque(maxlen=window), True: deque(maxlen=window)}
+
+    @property
+    def model_name(self) -> str:
+        return self.model.model_name
+
+    def observe(self, stream: bool, seconds: float) -> None:
+        self._latencies[stream].append(seconds)
+
+    def latency_percentile(self, stream: bool, percent: float) -> Optional[float]:
+        latencies = self._latencies[stream]
+        if len(latencies) < self.MIN_SAMPLES:
+            return None
+        return float(np.percentile(latencies, percent))
+
+
+class ModelRouter(BaseChatModel):
+    """
+    Chat model which routes requests between OpenAI-compatible endpoints:
+    - small talk (a short user message matching fast_pattern, e.g. greetings and thanks) goes to the fast model, other requests
+      go to the main model;
+    - if the first endpoint doesn't respond within the hedging budget (latency percentile of its recent responses), the same request
+      is sent to the backup endpoint and the first response wins, the other request is cancelled. The budget is measured to the
+      first token of streamed responses, so tokens are streamed from one endpoint only;
+    - if the first endpoint fails before responding, the request fails over to the backup endpoint.
+    The backup of the fast model is the main model, the backup of the main model is the secondary endpoint (if configured).
+    With prompt_cache_key requests are tagged with the key of their static prefix (see _with_prompt_cache_key).
+    """
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    main: ModelEndpoint
+    fast: Optional[ModelEndpoint] = None
+    secondary: Optional[ModelEndpoint] = None
+    fast_max_chars: int = 80
+    fast_pattern: str = ""
+    hedge: bool = True
+    hedge_percentile: float = 95
+    hedge_delay: float = 5
+    hedge_min_delay: float = 0.5
+    prompt_cache_key: bool = False
+
+    @property
+    def _llm_type(self) -> str:
+        return "model-router"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {
+            "main": self.main.model_name,
+            "fast": self.fast.model_name if self.fast else None,
+            "secondary": self.secondary.model_name if self.secondary else None,
+        }
+
+    def _get_ls_params(self, stop: Optional[List[str]] = None, **kwargs: Any) -> LangSmithParams:
+        # The route is chosen after the run is started, the model which answered is in the response metadata
+        return self.main.model._get_ls_params(stop=stop, **kwargs)
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs: Any) -> Runnable[LanguageModelInput, BaseMessage]:
+        """Bind tools in OpenAI format, they are passed to the model of the chosen route"""
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], **kwargs)
+
+    def _with_prompt_cache_key(self, messages: List[BaseMessage], kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Add prompt_cache_key to the request: hash of the system prompt and tools, which start every prompt of an agent.
+        Providers route requests with the same key to the same cache, so the static prefix is cached for all chats of the bot
+        """
+        if not self.prompt_cache_key or not messages or not isinstance(messages[0], SystemMessage):
+            return kwargs
+        prefix = json.dumps([messages[0].content, kwargs.get("tools")], ensure_ascii=False, sort_keys=True, default=str)
+        key = hashlib.sha256(prefix.encode("utf-8")).hexdigest()[:32]
+        return {**kwargs, "extra_body": {**(kwargs.get("extra_body") or {}), "prompt_cache_key": key}}
+
+    def _is_small_talk(self, messages: List[BaseMessage]) -> bool:
+        if not messages or not isinstance(messages[-1], HumanMessage) or not isinstance(messages[-1].content, str):
+            return False
+        text = messages[-1].content
+        return len(text) <= self.fast_max_chars and re.fullmatch(self.fast_pattern, normalize_text(text)) is not None
+
+    def _route(self, messages: List[BaseMessage]) -> Tuple[str, ModelEndpoint, Optional[ModelEndpoint]]:
+        """Route name, endpoint of the request and its backup endpoint"""
+        if self.fast is not None and self._is_small_talk(messages):
+            route, endpoint, backup = "fast", self.fast, self.main
+        else:
+            route, endpoint, backup = "main", self.main, self.secondary
+        llm_routed_requests.inc(route=route)
+        return route, endpoint, backup
+
+    def _hedge_budget(self, endpoint: ModelEndpoint, stream: bool) -> float:
+        latency = endpoint.latency_percentile(stream, self.hedge_percentile)
+        return max(self.hedge_min_delay, self.hedge_delay if latency is None else latency)
+
+    async def _race(
+        self,
+        route: str,
+        endpoint: ModelEndpoint,
+        backup: Optional[ModelEndpoint],
+        start: Callable[[ModelEndpoint], Awaitable[Any]],
+        discard: Callable[[Any], Awaitable[None]],
+        stream: bool,
+    ) -> Tuple[ModelEndpoint, Any]:
+        """
+        Send the request to the endpoint, hedge it or fail over to the backup endpoint.
+        Returns the endpoint which responded first and its result; results of the other requests are discarded
+        """
+        tasks: Dict[asyncio.Task, Tuple[ModelEndpoint, float]] = {}
+
+        def launch(target: ModelEndpoint) -> None:
+            tasks[asyncio.ensure_future(start(target))] = (target, time.monotonic())
+
+        launch(endpoint)
+        hedge_at = time.monotonic() + self._hedge_budget(endpoint, stream) if self.hedge and backup is not None else None
+        backup_started = hedged = False
+        error: Optional[BaseException] = None
+        try:
+            while tasks:
+                timeout = None if hedge_at is None else max(0.0, hedge_at - time.monotonic())
+                done, _ = await asyncio.wait(set(tasks), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logging.warning(f"LLM request to {endpoint.name} ({endpoint.model_name}) exceeded its latency budget, hedging to {backup.name}")
+                    hedge_at = None
+                    backup_started = hedged = True
+                    launch(backup)
+                    continue
+
+                winner: Optional[Tuple[ModelEndpoint, Any]] = None
+                for task in done:
+                    target, launched_at = tasks.pop(task)
+                    if task.exception() is not None:
+                        error = task.exception()
+                        llm_requests.inc(model=target.model_name, endpoint=target.name, result="error")
+                        logging.warning(f"LLM request to {target.name} ({target.model_name}) failed: {error!r}")
+                        continue
+                    if winner is not None:
+                        await discard(task.result())
+                        llm_requests.inc(model=target.model_name, endpoint=target.name, result="cancelled")
+                        continue
+                    seconds = time.monotonic() - launched_at
+                    target.observe(stream, seconds)
+                    llm_first_token_seconds.observe(seconds, model=target.model_name, endpoint=target.name)
+                    winner = (target, task.result())
+
+                if winner is not None:
+                    if hedged:
+                        llm_hedged_requests.inc(route=route, winner="backup" if winner[0] is backup else "first")
+                    return winner
+                if not tasks and backup is not None and not backup_started:
+                    logging.warning(f"LLM request fails over to {backup.name} ({backup.model_name})")
+                    llm_failovers.inc(route=route)
+                    hedge_at = None
+                    backup_started = True
+                    launch(backup)
+            raise error
+        finally:
+            # Requests which lost the race (or all of them if the caller is cancelled)
+            for task, (target, launched_at) in tasks.items():
+                task.cancel()
+                # The slow request is still counted in the latency percentile, its latency is at least the time it ran
+                target.observe(stream, time.monotonic() - launched_at)
+                llm_requests.inc(model=target.model_name, endpoint=target.name, result="cancelled")
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if not isinstance(result, BaseException):
+                    await discard(result)
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        route, endpoint, backup = self._route(messages)
+        kwargs = self._with_prompt_cache_key(messages, kwargs)
+
+        async def start(target: ModelEndpoint) -> ChatResult:
+            return await target.model._agenerate(messages, stop=stop, **kwargs)
+
+        async def discard(result: ChatResult) -> None:
+            pass
+
+        started_at = time.monotonic()
+        target, result = await self._race(route, endpoint, backup, start, discard, stream=False)
+        llm_requests.inc(model=target.model_name, endpoint=target.name, result="success")
+        llm_request_seconds.observe(time.monotonic() - started_at, model=target.model_name, endpoint=target.name)
+        for generation in result.generations:
+            generation.message.response_metadata[ROUTED_MODEL_KEY] = target.model_name
+        return result
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        route, endpoint, backup = self._route(messages)
+        kwargs = self._with_prompt_cache_key(messages, kwargs)
+
+        async def start(target: ModelEndpoint) -> Tuple[Optional[ChatGenerationChunk], AsyncIterator[ChatGenerationChunk]]:
+            # Tokens are reported to callbacks by the router run, so the endpoint stream gets no run manager
+            chunks = target.model._astream(messages, stop=stop, **kwargs)
+            try:
+                return await chunks.__anext__(), chunks
+            except StopAsyncIteration:
+                return None, chunks
+            except BaseException:
+                await chunks.aclose()
+                raise
+
+        async def discard(result: Tuple[Optional[ChatGenerationChunk], AsyncIterator[ChatGenerationChunk]]) -> None:
+            await result[1].aclose()
+
+        started_at = time.monotonic()
+        target, (first, chunks) = await self._race(route, endpoint, backup, start, discard, stream=True)
+        try:
+            if first is not None:
+                # Only the first chunk is tagged, metadata of chunks is merged into the response
+                first.message.response_metadata[ROUTED_MODEL_KEY] = target.model_name
+                yield first
+            async for chunk in chunks:
+                yield chunk
+        except Exception:
+            # Tokens could already be shown to the user, so the request is not repeated at the backup endpoint
+            llm_requests.inc(model=target.model_name, endpoint=target.name, result="error")
+            raise
+        finally:
+            await chunks.aclose()
+        llm_requests.inc(model=target.model_name, endpoint=target.name, result="success")
+        llm_request_seconds.observe(time.monotonic() - started_at, model=target.model_name, endpoint=target.name)
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        # The bot calls the model asynchronously, sync calls are only routed and failed over without hedging
+        route, endpoint, backup = self._route(messages)
+        kwargs = self._with_prompt_cache_key(messages, kwargs)
+        for target in (endpoint, backup):
+            if target is None:
+                continue
+            try:
+                result = target.model._generate(messages, stop=stop, **kwargs)
+            except Exception as e:
+                llm_requests.inc(model=target.model_name, endpoint=target.name, result="error")
+                if target is backup or backup is None:
+                    raise
+                logging.warning(f"LLM request to {target.name} ({target.model_name}) failed, failing over to {backup.name}: {e!r}")
+                llm_failovers.inc(route=route)
+                continue
+            llm_requests.inc(model=target.model_name, endpoint=target.name, result="success")
+            for generation in result.generations:
+                generation.message.response_metadata[ROUTED_MODEL_KEY] = target.model_name
+            return result
+        raise RuntimeError("No LLM endpoint is configured")
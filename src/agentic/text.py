@@ -0,0 +1,9 @@
+import re
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize text for exact matching: case, punctuation and extra whitespace are ignored.
+    Used for keys of the retrieval and answer caches and for matching small talk routed to the fast model
+    """
+    return re.sub(r"\s+", " ", re.sub(r"[^\w\s]", " ", text.lower())).strip()
@@ -1,55 +1,208 @@
 import logging
 import asyncio
 import signal
-from typing import Optional
+import time
+from typing import Any, Callable, List, Optional
 
+from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, Application
-from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver, AsyncConnectionPool
-from langgraph.graph import MessagesState, StateGraph, START
+from psycopg_pool import AsyncConnectionPool
+from langchain_core.messages import AIMessage
+from langgraph.graph import END, StateGraph, START
 from langgraph.graph.state import CompiledStateGraph
 
 from src.settings import settings
-from src.agentic.agents import manager_agent
+from src.server import HealthChecks, HttpServer, create_web_app
+from src.storage import (
+    InstrumentedPostgresSaver,
+    TelegramFileIdCache,
+    create_checkpoint_cache,
+    create_checkpoint_retention,
+    create_connection_pool,
+)
+from src.tracing import setup_tracing, shutdown_tracing
+from src.update_processor import PerChatUpdateProcessor
+from src.rate_limiter import create_rate_limiter
+from src.tenants import Tenant, load_tenants
+from src.agentic.agents import AnswerCache, ManagerState, compact_history
 from src.handlers import (
     handle_start,
     handle_user_message,
+    MessageCoalescer,
 )
 
 
+# Updates handled by handle_user_message
+USER_MESSAGE_FILTER = filters.TEXT & ~filters.COMMAND
+
+
+def build_state_graph(
+    manager_agent: CompiledStateGraph,
+    retrieve_context: Optional[Callable[..., Any]] = None,
+    answer_cache: Optional[AnswerCache] = None,
+) -> StateGraph:
+    """
+    Build the conversation graph of a bot, it is compiled with the checkpointer.
+    retrieve_context is the node which prefetches knowledge base sections for the manager (see Tenant.retrieve_context),
+    answer_cache replies to first questions of chats which were answered before (see Tenant.answer_cache)
+    """
+    # History is compacted before every manager run, so the prompt stays within the token budget
+    graph_builder = StateGraph(ManagerState)
+    graph_builder.add_node("compact_history", compact_history)
+    graph_builder.add_node("manager", manager_agent)
+    first_nodes = ["compact_history"]
+    if retrieve_context is None:
+        graph_builder.add_edge("compact_history", "manager")
+    else:
+        # Knowledge base is searched at the same time as history is compacted, the manager starts when both are done
+        graph_builder.add_node("retrieve_context", retrieve_context)
+        graph_builder.add_edge(["compact_history", "retrieve_context"], "manager")
+        first_nodes.append("retrieve_context")
+    if answer_cache is None:
+        for node in first_nodes:
+            graph_builder.add_edge(START, node)
+        return graph_builder
+
+    # A cached reply ends the turn before any LLM call, otherwise the reply of the manager is offered to the cache
+    graph_builder.add_node("lookup_answer", answer_cache.lookup)
+    graph_builder.add_node("store_answer", answer_cache.store)
+    graph_builder.add_edge(START, "lookup_answer")
+    graph_builder.add_conditional_edges(
+        "lookup_answer",
+        lambda state: END if isinstance(state["messages"][-1], AIMessage) else first_nodes,
+        [*first_nodes, END],
+    )
+    graph_builder.add_edge("manager", "store_answer")
+    return graph_builder
+
+
+def build_application(tenant: Tenant, webhook_mode: bool, app_builder: Optional[ApplicationBuilder] = None) -> Application:
+    """
+    Create application of the tenant bot. Updates from different chats are processed concurrently, updates from the same chat are processed in order.
+    app_builder can be given to set up the builder further (e.g. request backend)
+    """
+    coalesce = settings.telegram_bot.COALESCE_MESSAGES
+    update_processor = PerChatUpdateProcessor(
+        max_concurrent_updates=settings.telegram_bot.MAX_CONCURRENT_UPDATES,
+        max_pending_updates=settings.telegram_bot.MAX_PENDING_UPDATES,
+        # A new user message cancels the turn of the previous one until it has replied
+        supersedes=USER_MESSAGE_FILTER.check_update if coalesce else None,
+    )
+    # Outgoing messages are rate limited per bot, Telegram flood limits are per bot token
+    app_builder = (
+        (app_builder or ApplicationBuilder())
+        .token(tenant.config.token)
+        .concurrent_updates(update_processor)
+        .rate_limiter(create_rate_limiter())
+    )
+    if webhook_mode:
+        # Updates are received by our HTTP server, so polling updater is not needed
+        app_builder = app_builder.updater(None)
+    app = app_builder.build()
+    app.tenant = tenant
+    if coalesce:
+        app.message_coalescer = MessageCoalescer(settings.telegram_bot.COALESCE_WINDOW)
+    app.add_handler(CommandHandler("start", handle_start))
+    app.add_handler(MessageHandler(USER_MESSAGE_FILTER, handle_user_message))
+    return app
+
+
 async def setup_and_start_bot() -> None:
-    """Setup and start the bot."""
+    """Setup and start the bots of all tenants."""
     # Set logging level
     logging.basicConfig(level=settings.telegram_bot.LOGGING_LEVEL)
+    startup_timer = _StartupTimer()
+    setup_tracing()
 
-    # Create application
-    logging.info("Creating application")
-    app = ApplicationBuilder().token(settings.telegram_bot.TOKEN).build()
+    # Every tenant has its own bot, prompt and knowledge base. They share the event loop, the database pool and the embedding client
+    tenants = load_tenants()
+    startup_timer.mark("tenants loaded")
 
-    # Create state graph
-    logging.info("Creating state graph")
-    graph_builder = StateGraph(MessagesState)
-    graph_builder.add_node("manager", manager_agent)
-    graph_builder.add_edge(START, "manager")
-    
-    # Set up the checkpointer, compile the graph, and add it to the application
-    connection_kwargs = {"autocommit": True}
-    async with AsyncConnectionPool(conninfo=settings.checkpointer.POSGRES_CONNECTION_STRING, kwargs=connection_kwargs) as pool:
-        postgres_saver = AsyncPostgresSaver(pool)
+    # Open preloaded knowledge bases in the background, bots answer without them until they are ready.
+    # Other knowledge bases are opened by the first retrieval query
+    for tenant in tenants:
+        if tenant.config.preload_knowledge_base:
+            tenant.knowledge_base.start()
+
+    # Create applications
+    logging.info("Creating applications")
+    webhook_mode = settings.telegram_bot.MODE == "webhook"
+    apps: List[Application] = [build_application(tenant, webhook_mode) for tenant in tenants]
+    startup_timer.mark("applications created")
+
+    # Set up the checkpointer, compile the graphs, and add them to the applications
+    async with create_connection_pool() as pool:
+        postgres_saver = InstrumentedPostgresSaver(pool)
         await postgres_saver.setup()
-        compiled_graph = graph_builder.compile(checkpointer=postgres_saver)
-        app.graph = compiled_graph
+        # Turns of active chats start from the cached checkpoint and write one checkpoint when they end
+        if webhook_mode and settings.checkpointer.CACHE_ENABLED:
+            logging.warning("Checkpoint cache is enabled in webhook mode, only one bot process may serve the webhook")
+        checkpointer = create_checkpoint_cache(postgres_saver) if settings.checkpointer.CACHE_ENABLED else postgres_saver
+        # Set up the cache of Telegram file_id values for sent documents in the same database
+        file_id_cache = TelegramFileIdCache(pool)
+        await file_id_cache.setup()
+        for app in apps:
+            # Chats of different tenants have different thread ids, so one checkpointer keeps their histories apart
+            app.graph = build_state_graph(app.tenant.manager_agent, app.tenant.retrieve_context, app.tenant.answer_cache).compile(checkpointer=checkpointer)
+            app.file_id_cache = file_id_cache
+        startup_timer.mark("database set up")
 
-        # Add handlers
-        logging.info("Adding handlers")
-        app.add_handler(CommandHandler("start", handle_start))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_user_message))
+        # Old checkpoints are pruned in the background, so the checkpointer database doesn't grow without bound
+        retention_task: Optional[asyncio.Task] = None
+        if settings.checkpointer.RETENTION_INTERVAL_MINUTES > 0:
+            retention = create_checkpoint_retention(pool)
+            retention_task = asyncio.create_task(
+                retention.run_periodically(settings.checkpointer.RETENTION_INTERVAL_MINUTES * 60),
+                name="CheckpointRetention",
+            )
+
+        # Set up readiness checks and HTTP server with health endpoints (and webhook endpoints in webhook mode)
+        health_checks = HealthChecks()
+        health_checks.register("telegram", _async_value(lambda: all(app.running for app in apps)))
+        health_checks.register("postgres", lambda: _check_pool(pool))
+        for tenant in tenants:
+            check_name = "knowledge_base" if len(tenants) == 1 else f"knowledge_base.{tenant.name}"
+            health_checks.register(check_name, _async_value(lambda knowledge_base=tenant.knowledge_base: knowledge_base.ready), critical=False)
+        http_server: Optional[HttpServer] = None
+        if webhook_mode or settings.telegram_bot.HTTP_SERVER_ENABLED:
+            webhooks = {
+                app.tenant.config.webhook_path: (app, app.tenant.config.webhook_secret_token) for app in apps
+            } if webhook_mode else None
+            web_app = create_web_app(health_checks, webhooks=webhooks)
+            http_server = HttpServer(
+                web_app,
+                host=settings.telegram_bot.HTTP_LISTEN,
+                port=settings.telegram_bot.HTTP_PORT,
+                log_level=settings.telegram_bot.LOGGING_LEVEL,
+            )
 
         try:
-            # Start the bot
-            logging.info("Starting bot")
-            await app.initialize()
-            await app.start()
-            await app.updater.start_polling()
+            # Start the bots
+            logging.info("Starting bots")
+            for app in apps:
+                await app.initialize()
+                await app.start()
+            startup_timer.mark("applications started")
+            if http_server is not None:
+                await http_server.start()
+                logging.info(f"HTTP server is listening on {settings.telegram_bot.HTTP_LISTEN}:{settings.telegram_bot.HTTP_PORT}")
+                startup_timer.mark("HTTP server started")
+
+            for app in apps:
+                config = app.tenant.config
+                if webhook_mode:
+                    # Messages of a chat are ordered and coalesced within the process, so only one process may serve the webhook
+                    await app.bot.set_webhook(
+                        url=config.webhook_url,
+                        secret_token=config.webhook_secret_token,
+                        allowed_updates=Update.ALL_TYPES,
+                        max_connections=settings.telegram_bot.WEBHOOK_MAX_CONNECTIONS,
+                    )
+                    logging.info(f"Webhook of {config.name} is set to {config.webhook_url}")
+                else:
+                    await app.updater.start_polling()
+            startup_timer.mark("receiving updates started")
+            startup_timer.finish()
             
             # Block until a signal is received
             stop_signal = asyncio.Event()
@@ -60,6 +213,51 @@ async def setup_and_start_bot() -> None:
             
         finally:
             logging.info("Shutting down...")
+            for tenant in tenants:
+                await tenant.knowledge_base.stop()
+            if retention_task is not None:
+                retention_task.cancel()
+                await asyncio.gather(retention_task, return_exceptions=True)
+            for app in apps:
+                if app.updater is not None and app.updater.running:
+                    await app.updater.stop()
+            if http_server is not None:
+                await http_server.stop()
+            for app in apps:
+                if app.running:
+                    await app.stop()
+                await app.shutdown()
+            shutdown_tracing()
+
+
+class _StartupTimer:
+    """Logs duration of startup phases"""
+
+    def __init__(self) -> None:
+        self._started_at = self._phase_started_at = time.monotonic()
+
+    def mark(self, phase: str) -> None:
+        """Log duration of the phase which has just completed"""
+        now = time.monotonic()
+        logging.info(f"Startup: {phase} in {now - self._phase_started_at:.2f}s")
+        self._phase_started_at = now
+
+    def finish(self) -> None:
+        logging.info(f"Startup completed in {time.monotonic() - self._started_at:.2f}s")
+
+
+def _async_value(getter):
+    """Wrap a synchronous readiness getter into a coroutine function"""
+    async def check() -> bool:
+        return getter()
+    return check
+
+
+async def _check_pool(pool: AsyncConnectionPool) -> bool:
+    """Check that the database is reachable through the pool"""
+    async with pool.connection(timeout=2) as conn:
+        await conn.execute("SELECT 1")
+    return True
 
 
 def main():
@@ -1,8 +1,10 @@
 from .start import handle_start
 from .message import handle_user_message
+from .coalescing import MessageCoalescer
 
 
 __all__ = [
     "handle_start",
-    "handle_user_message"
+    "handle_user_message",
+    "MessageCoalescer",
 ]
@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackHandler
+from langgraph.checkpoint.base import BaseCheckpointSaver
+
+from src.metrics import registry
+
+
+messages_coalesced = registry.counter(
+    "bot_messages_coalesced_total",
+    "Turns superseded by a newer message of the chat, their messages are answered together with it. "
+    "Stage is debounce (the graph run didn't start) or run (the run was cancelled before it replied)",
+    ["stage"],
+)
+llm_calls_saved = registry.counter(
+    "bot_llm_calls_saved_total",
+    "Estimated LLM calls saved by coalescing: average LLM calls of a turn for every superseded turn minus calls it already made",
+)
+superseded_llm_calls = registry.counter(
+    "bot_superseded_llm_calls_total",
+    "LLM calls made by graph runs which were cancelled by a newer message",
+)
+
+
+class LLMCallCounter(AsyncCallbackHandler):
+    """Counts LLM calls of a graph run"""
+
+    def __init__(self) -> None:
+        self.calls = 0
+
+    async def on_chat_model_start(self, *args: Any, **kwargs: Any) -> None:
+        self.calls += 1
+
+
+class ChatTurn:
+    """User messages of a chat which are answered by one graph run"""
+
+    def __init__(self, text: str) -> None:
+        self.texts: List[str] = [text]
+        self.llm_calls = LLMCallCounter()
+        # Id of the current graph run, it is stored in metadata of checkpoints written by the run
+        self.run_id: Optional[str] = None
+        # Superseded run whose checkpoints have to be discarded
+        self.superseded_run_id: Optional[str] = None
+        # Checkpoint the next run starts from instead of the latest one of the thread
+        self.fork_from: Optional[str] = None
+
+    @property
+    def text(self) -> str:
+        return "\n".join(self.texts)
+
+    def start_run(self) -> Dict[str, Any]:
+        """Configurable values of the graph run of the turn"""
+        self.run_id = uuid.uuid4().hex
+        configurable = {"turn_id": self.run_id}
+        if self.fork_from is not None:
+            configurable["checkpoint_id"] = self.fork_from
+        return configurable
+
+
+class MessageCoalescer:
+    """
+    Merges messages which a user sends in quick succession into one turn, so they get one reply from one graph run.
+    A turn waits `window` seconds before the graph run. Until the turn replies, a newer message of the chat cancels it
+    (see PerChatUpdateProcessor.set_supersedable), and the messages of the cancelled turn are answered with the newer one.
+    Checkpoints written by a cancelled run are discarded: the next run forks from the checkpoint the cancelled run started from.
+    """
+
+    def __init__(self, window: float) -> None:
+        self.window = window
+        self._pending: Dict[str, ChatTurn] = {}
+        self._turns = 0
+        self._turn_llm_calls = 0
+
+    @asynccontextmanager
+    async def turn(self, thread_id: str, text: str) -> AsyncIterator[ChatTurn]:
+        """Turn with the message and messages of the superseded turns of the chat"""
+        turn = self._pending.pop(thread_id, None)
+        if turn is None:
+            turn = ChatTurn(text)
+        else:
+            turn.texts.append(text)
+            turn.llm_calls = LLMCallCounter()
+        try:
+            yield turn
+        except asyncio.CancelledError:
+            # Handler is cancelled by a newer message of the chat, which picks up the pending messages
+            self._supersede(thread_id, turn)
+            raise
+        self._turns += 1
+        self._turn_llm_calls += turn.llm_calls.calls
+
+    def _supersede(self, thread_id: str, turn: ChatTurn) -> None:
+        """Keep messages of the cancelled turn for the next turn of the chat"""
+        stage = "debounce" if turn.run_id is None else "run"
+        messages_coalesced.inc(stage=stage)
+        superseded_llm_calls.inc(turn.llm_calls.calls)
+        if self._turns:
+            llm_calls_saved.inc(max(0.0, self._turn_llm_calls / self._turns - turn.llm_calls.calls))
+        if turn.run_id is not None:
+            turn.superseded_run_id = turn.run_id
+            turn.run_id = None
+        logging.info(f"Turn of {len(turn.texts)} messages in thread {thread_id} is superseded at {stage} stage")
+        self._pending[thread_id] = turn
+
+    async def discard_superseded_run(self, checkpointer: BaseCheckpointSaver, thread_id: str, turn: ChatTurn) -> None:
+        """Find the checkpoint the superseded run of the turn started from, the next run forks from it"""
+        if turn.superseded_run_id is None:
+            return
+        config = {"configurable": {"thread_id": thread_id, "checkpoint_ns": ""}}
+        first = None
+        async for checkpoint in checkpointer.alist(config, filter={"turn_id": turn.superseded_run_id}):
+            first = checkpoint
+        # The run could be cancelled before it wrote anything
+        if first is not None:
+            # The first checkpoint of a run holds only its input. In a new thread it has no parent and the run forks from it
+            turn.fork_from = (first.parent_config or first.config)["configurable"]["checkpoint_id"]
+        turn.superseded_run_id = None
@@ -0,0 +1,349 @@
+import html
+import logging
+import re
+from typing import Dict, List, Tuple
+
+
+# Telegram message length limit in UTF-16 code units (characters outside the BMP, e.g. emoji, take two)
+MAX_MESSAGE_LENGTH = 4096
+
+# HTML tags which the LLM is allowed to use (see the manager prompt) and their Telegram names
+ALLOWED_TAGS = {"b": "b", "strong": "b", "i": "i", "em": "i", "a": "a"}
+
+# Markdown emphasis delimiters and tags they are converted to
+EMPHASIS_TAGS = {"**": "b", "__": "b", "*": "i", "_": "i"}
+
+# Named entities supported by Telegram, other entities are replaced with their characters
+TELEGRAM_ENTITIES = {"&lt;", "&gt;", "&amp;", "&quot;"}
+
+# Everything which is not plain text, matched in one scan of the text. Alternatives are tried in order,
+# the lookahead lets the regex engine skip plain text quickly
+TOKEN_PATTERN = re.compile(
+    r"(?=[`<&\[#*_])(?:```(?:[\w+-]*\n)?(?P<code_block>.*?)```"
+    r"|`(?P<code>[^`\n]+)`"
+    r"|<(?P<tag_close>/)?(?P<tag_name>b|strong|i|em|a)(?P<tag_attrs>\s[^<>]*)?>"
+    r"|(?P<entity>&(?:#\d+|#x[0-9a-f]+|[a-z][a-z0-9]*);)"
+    r"|\[(?P<link_text>[^\[\]\n]+)\]\((?P<link_url>[^()\s]+)\)"
+    r"|(?P<header>#{1,6}[ \t]+)"
+    r"|(?P<emphasis>\*\*|__|\*|_))",
+    re.DOTALL | re.IGNORECASE,
+)
+HREF_PATTERN = re.compile(r"""href\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""", re.IGNORECASE)
+
+# Tag or entity which is cut in the middle at the end of a partial text
+UNFINISHED_TAG_PATTERN = re.compile(r"</?(?:[a-z]+(?:\s[^<>]*)?)?|&[#\w]*", re.IGNORECASE)
+# Any tag of the rendered HTML, used to get plain text of a message
+HTML_TAG_PATTERN = re.compile(r"<[^<>]*>")
+
+# Token: (kind, HTML, tag name), kind is "text" (escaped text), "open" or "close" (tags)
+Token = Tuple[str, str, str]
+
+
+def _can_open(delimiter: str, before: str, after: str) -> bool:
+    """Emphasis can start before a non-space character. Underscores and single asterisks don't start inside words and URLs"""
+    if not after or after.isspace():
+        return False
+    if delimiter == "**":
+        return True
+    forbidden = "/" if delimiter == "*" else "/.:@_"
+    return not before or not (before.isalnum() or before in forbidden)
+
+
+def _can_close(delimiter: str, before: str, after: str) -> bool:
+    """Emphasis can end after a non-space character. Underscores and single asterisks don't end inside words and URLs"""
+    if not before or before.isspace():
+        return False
+    if delimiter == "**":
+        return True
+    return not after or not (after.isalnum() or after == "/")
+
+
+def _link_tag(href: str) -> Token:
+    return ("open", f'<a href="{html.escape(href)}">', "a")
+
+
+OPEN_TAGS: Dict[str, Token] = {"b": ("open", "<b>", "b"), "i": ("open", "<i>", "i")}
+CLOSE_TAGS: Dict[str, Token] = {name: ("close", f"</{name}>", name) for name in ("b", "i", "a")}
+
+
+def _escape(text: str) -> str:
+    # Most of the text doesn't need escaping, checking it is faster than replacing
+    if "&" in text or "<" in text or ">" in text:
+        return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    return text
+
+
+def _scan(text: str, tokens: List[Token], partial: bool = False) -> None:
+    """
+    Tokenize text in one pass: plain text is escaped, allowed HTML tags are kept, Markdown links and emphasis
+    are converted to tags and other Markdown syntax is removed. Tags may be unbalanced, they are fixed by _balance.
+    """
+    # Emphasis which was opened and not closed yet: delimiter -> (index of its token, position in the text).
+    # Like in the old converter, emphasis doesn't continue on the next line, unclosed delimiters are shown as is
+    pending: Dict[str, Tuple[int, int]] = {}
+
+    def revert_pending(before: int) -> None:
+        for delimiter, (index, opened_at) in list(pending.items()):
+            if text.find("\n", opened_at, before) != -1:
+                tokens[index] = ("text", delimiter, "")
+                del pending[delimiter]
+
+    position = 0
+    for match in TOKEN_PATTERN.finditer(text):
+        start = match.start()
+        if start > position:
+            tokens.append(("text", _escape(text[position:start]), ""))
+        position = match.end()
+        kind = match.lastgroup
+
+        if kind == "emphasis":
+            delimiter = match.group(kind)
+            if pending:
+                revert_pending(start)
+            before = text[start - 1] if start else ""
+            after = text[position] if position < len(text) else ""
+            if delimiter in pending and _can_close(delimiter, before, after):
+                del pending[delimiter]
+                tokens.append(CLOSE_TAGS[EMPHASIS_TAGS[delimiter]])
+            elif delimiter not in pending and _can_open(delimiter, before, after):
+                pending[delimiter] = (len(tokens), start)
+                tokens.append(OPEN_TAGS[EMPHASIS_TAGS[delimiter]])
+            else:
+                tokens.append(("text", delimiter, ""))
+        elif kind == "tag_name" or kind == "tag_attrs":
+            name = ALLOWED_TAGS[match.group("tag_name").lower()]
+            if match.group("tag_close"):
+                tokens.append(CLOSE_TAGS[name])
+            elif name != "a":
+                tokens.append(OPEN_TAGS[name])
+            else:
+                href = HREF_PATTERN.search(match.group("tag_attrs") or "")
+                # Links without a target are dropped, their text is kept
+                if href is not None:
+                    tokens.append(_link_tag(html.unescape(next(value for value in href.groups() if value is not None))))
+        elif kind == "entity":
+            entity = match.group(kind)
+            tokens.append(("text", entity if entity.lower() in TELEGRAM_ENTITIES else _escape(html.unescape(entity)), ""))
+        elif kind == "link_url":
+            tokens.append(_link_tag(match.group(kind)))
+            _scan(match.group("link_text"), tokens)
+            tokens.append(CLOSE_TAGS["a"])
+        elif kind == "code_block" or kind == "code":
+            # Code formatting is not allowed, code is shown as plain text
+            tokens.append(("text", _escape(match.group(kind)), ""))
+        # Headers are removed, "#" in the middle of a line is kept
+        elif start and text[start - 1] != "\n":
+            tokens.append(("text", match.group(kind), ""))
+
+    if position < len(text):
+        tokens.append(("text", _escape(text[position:]), ""))
+    # Emphasis of the line which is still being generated is shown as is, it will be closed by the following tokens
+    if pending:
+        revert_pending(len(text))
+        if not partial:
+            for delimiter, (index, _) in pending.items():
+                tokens[index] = ("text", delimiter, "")
+
+
+def _balance(tokens: List[Token]) -> List[Token]:
+    """
+    Make tags properly nested: a closing tag closes tags which were opened after it and reopens them,
+    closing tags without opening ones are dropped, a tag inside the same tag (e.g. nested links) is dropped
+    together with its closing tag and all tags are closed at the end.
+    """
+    # Usually tags are already nested properly and only tags which are left open have to be closed
+    stack: List[Token] = []
+    for token in [token for token in tokens if token[0] != "text"]:
+        if token[0] == "open":
+            if any(tag[2] == token[2] for tag in stack):
+                break
+            stack.append(token)
+        elif not stack or stack.pop()[2] != token[2]:
+            break
+    else:
+        return tokens + [CLOSE_TAGS[tag[2]] for tag in reversed(stack)]
+
+    result: List[Token] = []
+    stack = []
+    # Number of dropped tags which are inside the same tag, their closing tags are dropped too
+    nested: Dict[str, int] = {}
+
+    def close(tag: Token) -> None:
+        # Don't leave empty tags, e.g. after reopening a tag which is closed right away
+        if result and result[-1] == tag:
+            result.pop()
+        else:
+            result.append(CLOSE_TAGS[tag[2]])
+
+    for token in tokens:
+        kind, _, name = token
+        if kind == "text":
+            result.append(token)
+        elif kind == "open":
+            if any(tag[2] == name for tag in stack):
+                nested[name] = nested.get(name, 0) + 1
+                continue
+            stack.append(token)
+            result.append(token)
+        elif nested.get(name):
+            nested[name] -= 1
+        elif any(tag[2] == name for tag in stack):
+            reopen: List[Token] = []
+            while stack:
+                tag = stack.pop()
+                close(tag)
+                if tag[2] == name:
+                    break
+                reopen.append(tag)
+            for tag in reversed(reopen):
+                stack.append(tag)
+                result.append(tag)
+    for tag in reversed(stack):
+        close(tag)
+    return result
+
+
+def _tokenize(text: str, partial: bool) -> List[Token]:
+    if partial:
+        for start in (text.rfind("<"), text.rfind("&")):
+            if start != -1 and UNFINISHED_TAG_PATTERN.fullmatch(text, start):
+                text = text[:start]
+    tokens: List[Token] = []
+    _scan(text, tokens, partial)
+    return _balance(tokens)
+
+
+def message_length(text: str) -> int:
+    """Length of the text as Telegram counts it, in UTF-16 code units"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _prefix_end(text: str, room: int) -> int:
+    """Number of characters at the start of the text which take at most room UTF-16 code units"""
+    if room <= 0:
+        return 0
+    if message_length(text[:room]) <= room:
+        return min(room, len(text))
+    end = 0
+    for character in text:
+        room -= 2 if ord(character) > 0xFFFF else 1
+        if room < 0:
+            break
+        end += 1
+    return end
+
+
+def _find_cut(text: str, room: int) -> int:
+    """Position of the best place to split escaped text to fit room UTF-16 code units: paragraph, line or word end. 0 if none"""
+    end = _prefix_end(text, room)
+    if end <= 0:
+        return 0
+    for separator in ("\n\n", "\n", " "):
+        position = text.rfind(separator, 0, end + len(separator))
+        if position > 0:
+            return position
+    return 0
+
+
+def _hard_cut(text: str, room: int) -> int:
+    """Position to split text without a separator, an entity is never cut in the middle"""
+    cut = max(_prefix_end(text, room), 1)
+    ampersand = text.rfind("&", max(0, cut - 10), cut)
+    if ampersand != -1 and ";" not in text[ampersand:cut]:
+        # The entity is moved to the next message or, if it is at the start, kept whole
+        cut = ampersand or text.find(";", ampersand) + 1
+    return cut
+
+
+def _split(tokens: List[Token], limit: int) -> List[str]:
+    """
+    Split balanced tokens into messages which fit the limit. Tags which are open at the end of a message
+    are closed in it and reopened in the next one. Messages without visible text are skipped.
+    """
+    # Most replies fit into one message
+    rendered = "".join([token[1] for token in tokens])
+    if message_length(rendered) <= limit:
+        return [rendered] if any(kind == "text" and value.strip() for kind, value, _ in tokens) else []
+
+    messages: List[str] = []
+    parts: List[str] = []
+    stack: List[Token] = []
+    state = {"length": 0, "reserved": 0, "has_text": False}
+
+    def flush() -> None:
+        if state["has_text"]:
+            messages.append("".join(parts).rstrip() + "".join(f"</{tag[2]}>" for tag in reversed(stack)))
+        parts.clear()
+        parts.extend(tag[1] for tag in stack)
+        state["length"] = sum(message_length(tag[1]) for tag in stack)
+        state["has_text"] = False
+
+    def append(part: str) -> None:
+        parts.append(part)
+        state["length"] += message_length(part)
+
+    for token in tokens:
+        kind, value, name = token
+        if kind == "open":
+            if state["length"] + state["reserved"] + message_length(value) + len(name) + 3 > limit:
+                flush()
+            append(value)
+            stack.append(token)
+            state["reserved"] += len(name) + 3
+        elif kind == "close":
+            stack.pop()
+            state["reserved"] -= len(name) + 3
+            append(value)
+        else:
+            text = value
+            while text and state["length"] + state["reserved"] + message_length(text) > limit:
+                room = limit - state["length"] - state["reserved"]
+                cut = _find_cut(text, room)
+                # Without a good place to split the text, move it to the next message if the current one has text
+                if cut == 0 and state["has_text"]:
+                    flush()
+                    continue
+                cut = cut or _hard_cut(text, room)
+                append(text[:cut])
+                state["has_text"] = state["has_text"] or bool(text[:cut].strip())
+                flush()
+                text = text[cut:].lstrip()
+            if text:
+                append(text)
+                state["has_text"] = state["has_text"] or bool(text.strip())
+    flush()
+    return messages
+
+
+def convert_markdown_to_html(text: str, partial: bool = False) -> str:
+    """
+    Convert allowed Markdown formatting to Telegram HTML and remove disallowed formatting.
+    Allowed formatting: bold, italic, links (as Markdown or HTML tags). Other text is escaped and tags are balanced.
+    If partial is True, the text is a prefix of a message which is still being generated, so unfinished tags are fixed.
+    """
+    try:
+        return "".join([token[1] for token in _tokenize(text, partial)])
+    except Exception as e:
+        logging.error(f"Error converting markdown to HTML: {e}")
+        # Return escaped text without any formatting as a fallback
+        return html.escape(text, quote=False)
+
+
+def convert_markdown_to_html_messages(text: str, partial: bool = False, limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """Convert text like convert_markdown_to_html and split it into Telegram messages of at most limit UTF-16 code units"""
+    try:
+        return _split(_tokenize(text, partial), limit)
+    except Exception as e:
+        logging.error(f"Error converting markdown to HTML: {e}")
+        escaped = html.escape(text, quote=False)
+        messages = []
+        while escaped:
+            cut = max(_prefix_end(escaped, limit), 1)
+            messages.append(escaped[:cut])
+            escaped = escaped[cut:]
+        return messages
+
+
+def html_to_text(text: str) -> str:
+    """Plain text of Telegram HTML, used when Telegram can't parse a message"""
+    return html.unescape(HTML_TAG_PATTERN.sub("", text))
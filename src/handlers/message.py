@@ -1,40 +1,18 @@
+import asyncio
 import logging
-import traceback
-import re
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, List, Optional
 
 from telegram import Update
 from telegram.ext import ContextTypes
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain_core.messages import AIMessage
 
-
-def convert_markdown_to_html(text: str) -> str:
-    """
-    Convert allowed Markdown formatting to HTML and remove disallowed formatting.
-    Allowed formatting: bold, italic, links
-    """
-    try:
-        # First convert links: [text](url) -> <a href="url">text</a>
-        # This needs to happen first to avoid formatting issues in URLs
-        text = re.sub(r'\[(.*?)\]\((.*?)\)', r'<a href="\2">\1</a>', text)
-        
-        # Convert bold: **text** or __text__ -> <b>text</b>
-        text = re.sub(r'\*\*(.*?)\*\*|__(.*?)__', lambda m: f'<b>{m.group(1) or m.group(2)}</b>', text)
-        
-        # Convert italic: *text* or _text_ -> <i>text</i>
-        # Modified to avoid matching underscores in URLs or email addresses
-        text = re.sub(r'(?<![a-zA-Z0-9/])\*((?!\*).+?)\*(?![a-zA-Z0-9/])|(?<![a-zA-Z0-9/.:@])_((?!_).+?)_(?![a-zA-Z0-9/])', 
-                     lambda m: f'<i>{m.group(1) or m.group(2)}</i>', text)
-        
-        # Remove other Markdown syntax (headers, code blocks, lists, etc.)
-        text = re.sub(r'^#+\s+', '', text, flags=re.MULTILINE)  # Remove headers
-        text = re.sub(r'`{1,3}(.*?)`{1,3}', r'\1', text, flags=re.DOTALL)  # Remove code formatting
-        
-        return text
-    
-    except Exception as e:
-        logging.error(f"Error converting markdown to HTML: {e}")
-        # Return original text without any formatting as a fallback
-        return text
+from src.settings import settings
+from src.storage import CachedCheckpointSaver
+from src.tracing import TracingCallbackHandler
+from .coalescing import MessageCoalescer
+from .streaming import TelegramMessageStream, stream_graph_reply
 
 
 async def handle_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -45,41 +23,84 @@ async def handle_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     # Get the user message and chat id
     user_message = update.message.text
     chat_id = update.effective_chat.id
+    # Chats with different bots (tenants) have separate histories
+    tenant = getattr(context.application, "tenant", None)
+    thread_id = tenant.thread_id(chat_id) if tenant is not None else str(chat_id)
+    coalescer: Optional[MessageCoalescer] = getattr(context.application, "message_coalescer", None)
     
     try:
-        # We need to provide update to the graph for actions like send image or send file.
-        # I don't know if there is better and easier way to provide non-serializable objects to the graph than through config.
-        # So any contributions to make this better are welcome.
-        config = {"configurable": {"thread_id": str(chat_id), "update": update}}
+        if coalescer is None:
+            await reply_to_user(update, context, thread_id, user_message)
+            return
+
+        async with coalescer.turn(thread_id, user_message) as turn:
+            # Until the bot replies, a newer message from the chat cancels this turn and is answered together with it
+            update_processor = context.application.update_processor
+            update_processor.set_supersedable(update, True)
+            await asyncio.sleep(coalescer.window)
+            await coalescer.discard_superseded_run(context.application.graph.checkpointer, thread_id, turn)
+            await reply_to_user(
+                update,
+                context,
+                thread_id,
+                turn.text,
+                configurable=turn.start_run(),
+                callbacks=[turn.llm_calls],
+                on_reply=lambda: update_processor.set_supersedable(update, False),
+            )
+
+    except Exception as e:
+        logging.exception(f"Error while processing user message: {e}")
+        
+    finally:
+        logging.info("User message processed.")
+
+
+async def reply_to_user(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    thread_id: str,
+    text: str,
+    configurable: Optional[Dict[str, Any]] = None,
+    callbacks: Optional[List[BaseCallbackHandler]] = None,
+    on_reply: Optional[Callable[[], None]] = None,
+) -> None:
+    """Run the graph with the user message and send its replies. on_reply is called before the first message is sent to the user"""
+    # We need to provide update to the graph for actions like send image or send file.
+    # I don't know if there is better and easier way to provide non-serializable objects to the graph than through config.
+    # So any contributions to make this better are welcome.
+    config = {
+        "configurable": {
+            "thread_id": thread_id,
+            "update": update,
+            "file_id_cache": getattr(context.application, "file_id_cache", None),
+            "on_reply": on_reply,
+            **(configurable or {}),
+        },
+        # Graph nodes, LLM calls, tools and retrieval are traced as children of the update span
+        "callbacks": [TracingCallbackHandler(), *(callbacks or [])],
+    }
+    graph_input = {
+        "messages": [
+            {"role": "user", "content": text}
+        ],
+    }
+
+    # Checkpoints of the graph steps are buffered and the final checkpoint of the turn is written when it ends
+    checkpointer = context.application.graph.checkpointer
+    async with checkpointer.turn(thread_id) if isinstance(checkpointer, CachedCheckpointSaver) else nullcontext():
+        # Stream LLM tokens to the user by editing the reply message as new tokens arrive
+        if settings.telegram_bot.STREAMING:
+            await stream_graph_reply(context.application.graph, graph_input, config, update.message)
+            return
+
         # Using async streaming method with values stream mode which makes graph to return all state values after each step.
         # We can use ainvoke, but astream gives us ability to send text response to the user as soon as we get it from the graph.
-        async for event in context.application.graph.astream(
-            {
-                "messages": [
-                    {"role": "user", "content": user_message}
-                ],
-            }, 
-            config, 
-            stream_mode="values"
-        ):
-            # Some logging to understand what is happening in the graph.
-            logging.info(f"\n\nAssistant: {event}")
+        async for event in context.application.graph.astream(graph_input, config, stream_mode="values"):
             message = event["messages"][-1]
 
-            if isinstance(message, tuple):
-                print(message)
-            else:
-                message.pretty_print()
-
             # If the message is AIMessage, we can send it to the user.
             # I think it would be greate to create some abstraction in the future to differentiate between agent inner thoughts and response to the user.
             if isinstance(message, AIMessage):
-                processed_content = convert_markdown_to_html(message.content)
-                await update.message.reply_text(processed_content, parse_mode="HTML")
-
-    except Exception as e:
-        print(traceback.format_exc())
-        logging.error(f"Error while processing user message: {e}")
-        
-    finally:
-        logging.info("User message processed.")
\ No newline at end of file
+                # Long replies are split into several messages, formatting errors fall back to plain text
+                await TelegramMessageStream(update.message, edit_interval=0, on_reply=on_reply).finish(message.content)
@@ -4,7 +4,13 @@ from telegram import Update
 from telegram.ext import ContextTypes
 
 
+# Reply to /start of bots (tenants) without their own start message
+START_MESSAGE = 'Привет! Я AI-ассистент в команде <a href="https://allsee.team/?utm_source=bot">AllSee.team</a> и помогу разобраться в возможностях искусственного интеллекта и кейсах моей команды. Задайте ваш первый вопрос!'
+
+
 async def handle_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
     logging.info(f"User {update.effective_user.first_name} started the conversation.")
-    await update.message.reply_text(f'Привет! Я AI-ассистент в команде <a href="https://allsee.team/?utm_source=bot">AllSee.team</a> и помогу разобраться в возможностях искусственного интеллекта и кейсах моей команды. Задайте ваш первый вопрос!', parse_mode="HTML")
+    tenant = getattr(context.application, "tenant", None)
+    start_message = tenant.config.start_message if tenant is not None and tenant.config.start_message else START_MESSAGE
+    await update.message.reply_text(start_message, parse_mode="HTML")
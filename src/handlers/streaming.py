@@ -0,0 +1,138 @@
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from telegram import Message
+from telegram.error import BadRequest
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+from src.settings import settings
+from .formatting import MAX_MESSAGE_LENGTH, convert_markdown_to_html_messages, html_to_text
+
+
+# Name of the agent node which generates replies to the user. Tokens from other nodes (e.g. history summary) are not streamed
+AGENT_NODE_NAME = "agent"
+
+# Symbol shown at the end of the message while it is still being generated
+CURSOR = " ▌"
+
+
+class TelegramMessageStream:
+    """
+    Progressive reply to the user: the first tokens are sent as a new message, which is then updated with edit_message_text
+    as new tokens arrive. Edits are sent not more often than once in edit_interval seconds to stay within Telegram flood limits.
+    Text longer than the Telegram limit continues in the following messages.
+    on_reply is called before a new message is sent.
+    """
+
+    def __init__(self, reply_to: Message, edit_interval: float, on_reply: Optional[Callable[[], None]] = None) -> None:
+        self.reply_to = reply_to
+        self.edit_interval = edit_interval
+        self.on_reply = on_reply
+        self.text = ""
+        self.messages: List[Message] = []
+        self.finished = False
+        self._shown_html: List[str] = []
+        self._last_edit_at = 0.0
+
+    async def push(self, delta: str) -> None:
+        """Add generated text and update the messages if enough time passed since the previous update"""
+        self.text += delta
+        if not self.text.strip() or time.monotonic() - self._last_edit_at < self.edit_interval:
+            return
+        chunks = convert_markdown_to_html_messages(self.text, partial=True, limit=MAX_MESSAGE_LENGTH - len(CURSOR))
+        if chunks:
+            chunks[-1] += CURSOR
+            await self._show(chunks)
+
+    async def finish(self, text: Optional[str] = None) -> None:
+        """Show the final text of the messages"""
+        if self.finished:
+            return
+        self.finished = True
+        if text is not None:
+            self.text = text
+        if not self.text.strip():
+            return
+        chunks = convert_markdown_to_html_messages(self.text)
+        await self._show(chunks)
+        # Preview could take more messages than the final text, e.g. because of the cursor
+        for message in self.messages[len(chunks):]:
+            await message.delete()
+        del self.messages[len(chunks):]
+
+    async def _show(self, chunks: List[str]) -> None:
+        """Send or edit the messages which have changed"""
+        self._last_edit_at = time.monotonic()
+        for index, html in enumerate(chunks):
+            if index < len(self._shown_html) and html == self._shown_html[index]:
+                continue
+            try:
+                await self._send(index, html, parse_mode="HTML")
+            except BadRequest as e:
+                # The reply must reach the user even if Telegram can't parse its formatting
+                if "can't parse entities" in str(e).lower():
+                    logging.error(f"Telegram can't parse reply HTML, sending it as plain text: {e}")
+                    await self._send(index, html_to_text(html))
+                # Telegram rejects edits which don't change the message, it is not an error for us
+                elif "not modified" not in str(e).lower():
+                    raise
+            if index < len(self._shown_html):
+                self._shown_html[index] = html
+            else:
+                self._shown_html.append(html)
+
+    async def _send(self, index: int, text: str, parse_mode: Optional[str] = None) -> None:
+        if index < len(self.messages):
+            await self.messages[index].edit_text(text, parse_mode=parse_mode)
+        else:
+            if self.on_reply is not None:
+                self.on_reply()
+            self.messages.append(await self.reply_to.reply_text(text, parse_mode=parse_mode))
+
+
+async def stream_graph_reply(graph: Any, graph_input: Dict[str, Any], config: Dict[str, Any], reply_to: Message) -> None:
+    """
+    Run the graph and stream LLM tokens of the agent replies to the user.
+    Every AI message of the turn gets its own Telegram message. Messages which were not streamed
+    (e.g. produced without LLM token stream) are sent as soon as they appear in the graph state.
+    """
+    streams: Dict[str, TelegramMessageStream] = {}
+    current_stream: Optional[TelegramMessageStream] = None
+    on_reply = config["configurable"].get("on_reply")
+
+    try:
+        async for mode, payload in graph.astream(graph_input, config, stream_mode=["messages", "values"]):
+            if mode == "messages":
+                chunk, metadata = payload
+                if metadata.get("langgraph_node") != AGENT_NODE_NAME or not isinstance(chunk, AIMessageChunk):
+                    continue
+                if not isinstance(chunk.content, str) or not chunk.content:
+                    continue
+
+                stream = streams.get(chunk.id)
+                if stream is None:
+                    # New message from the agent means that the previous one is complete
+                    if current_stream is not None:
+                        await current_stream.finish()
+                    stream = streams[chunk.id] = TelegramMessageStream(reply_to, settings.telegram_bot.STREAM_EDIT_INTERVAL, on_reply)
+                    current_stream = stream
+                await stream.push(chunk.content)
+
+            elif mode == "values":
+                message = payload["messages"][-1]
+                if not isinstance(message, AIMessage) or not message.content:
+                    continue
+                stream = streams.get(message.id)
+                if stream is None:
+                    stream = streams[message.id] = TelegramMessageStream(reply_to, settings.telegram_bot.STREAM_EDIT_INTERVAL, on_reply)
+                await stream.finish(message.content)
+
+    finally:
+        # Show the full text of messages which were interrupted or whose final state was not received
+        for stream in streams.values():
+            if not stream.finished and stream.messages:
+                try:
+                    await stream.finish()
+                except Exception as e:
+                    logging.error(f"Failed to finish streamed message: {e}")
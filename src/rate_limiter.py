@@ -0,0 +1,252 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Callable, Coroutine, Dict, Optional, Tuple, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from src.metrics import registry
+from src.settings import settings
+
+
+# Edits of a message which wait for their turn are merged: only the latest text is sent
+COALESCED_ENDPOINTS = frozenset({"editMessageText", "editMessageCaption"})
+
+telegram_requests = registry.counter(
+    "telegram_requests_total",
+    "Bot API requests by method and result (success, coalesced, retry, error)",
+    ["method", "result"],
+)
+telegram_send_wait_seconds = registry.histogram(
+    "telegram_send_wait_seconds",
+    "Time a Bot API request to a chat waited for its turn and for rate limits before it was sent",
+    ["method"],
+)
+telegram_sends_waiting = registry.gauge(
+    "telegram_sends_waiting",
+    "Number of Bot API requests waiting in chat queues",
+)
+telegram_flood_wait_seconds = registry.counter(
+    "telegram_flood_wait_seconds_total",
+    "Time all requests were paused because Telegram answered with 429 Too Many Requests",
+)
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter which is refilled continuously with `rate` units per second up to `capacity`.
+    Callers reserve units and sleep for the returned time, so one limiter is shared by sync and async calls.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._available = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._available = min(self.capacity, self._available + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def reserve(self, amount: float) -> float:
+        """Take amount from the bucket (possibly going below zero) and return time to wait until it is covered"""
+        with self._lock:
+            self._refill()
+            # The bucket can go below zero, following callers wait until the debt is refilled
+            self._available -= amount
+            return max(0.0, -self._available / self.rate)
+
+    def is_full(self) -> bool:
+        with self._lock:
+            self._refill()
+            return self._available >= self.capacity
+
+
+class _PendingEdit:
+    """Edit of a message waiting for its turn. Later edits of the same message replace its request data"""
+    __slots__ = ("args", "future")
+
+    def __init__(self, args: Any, future: asyncio.Future) -> None:
+        self.args = args
+        self.future = future
+
+
+class _ChatLimiter:
+    """Per-chat lock which keeps requests to the chat in order, rate limit of the chat and its pending edits"""
+    __slots__ = ("lock", "bucket", "pending", "edits")
+
+    def __init__(self, bucket: Optional[TokenBucket]) -> None:
+        # asyncio.Lock wakes up waiters in FIFO order, so messages to the same chat keep their order
+        self.lock = asyncio.Lock()
+        self.bucket = bucket
+        self.pending = 0
+        self.edits: Dict[Tuple[str, Any], _PendingEdit] = {}
+
+
+class TelegramRateLimiter(BaseRateLimiter[int]):
+    """
+    Rate limiter of outgoing Bot API requests:
+    - requests to the same chat are sent one by one in order and limited to the per-chat rate
+      (private chats and groups have different limits), requests to all chats are limited to the global rate;
+    - edits of a message which are still waiting for their turn are coalesced, only the latest one is sent;
+    - 429 Too Many Requests pauses all requests for retry_after seconds, then the request is retried.
+      Errors are raised to the caller when retries are exhausted, so failed sends are never reported as successful.
+    rate_limit_args of bot methods overrides the number of retries.
+    """
+
+    # Idle chat limiters are dropped when there are more of them
+    MAX_IDLE_CHATS = 512
+
+    def __init__(
+        self,
+        max_per_second: float,
+        chat_max_per_second: float,
+        group_max_per_minute: float,
+        chat_burst: int,
+        max_retries: int,
+        max_retry_after: float,
+    ) -> None:
+        self._bucket = TokenBucket(max_per_second, max_per_second) if max_per_second > 0 else None
+        self.chat_max_per_second = chat_max_per_second
+        self.group_max_per_minute = group_max_per_minute
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self._chats: Dict[Union[int, str], _ChatLimiter] = {}
+        self._resume_at = 0.0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat(self, chat_id: Union[int, str]) -> _ChatLimiter:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if len(self._chats) > self.MAX_IDLE_CHATS:
+                for key, limiter in list(self._chats.items()):
+                    if limiter.pending == 0 and (limiter.bucket is None or limiter.bucket.is_full()):
+                        del self._chats[key]
+            # Group chat ids are negative, string ids are usernames of channels and supergroups
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_max_per_minute / 60 if is_group else self.chat_max_per_second
+            chat = self._chats[chat_id] = _ChatLimiter(TokenBucket(rate, self.chat_burst) if rate > 0 else None)
+        return chat
+
+    async def _send(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        max_retries: int,
+    ) -> Any:
+        """Send the request when flood control allows it, retrying it after 429 Too Many Requests"""
+        for attempt in range(max_retries + 1):
+            # Flood wait applies to all requests of the bot, not only to the one which received 429
+            await asyncio.sleep(max(0.0, self._resume_at - time.monotonic()))
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                retry_after = float(e.retry_after)
+                if attempt == max_retries or retry_after > self.max_retry_after:
+                    telegram_requests.inc(method=endpoint, result="error")
+                    logging.error(f"Telegram flood control: {endpoint} failed after {attempt} retries, retry after {retry_after}s")
+                    raise
+                telegram_requests.inc(method=endpoint, result="retry")
+                telegram_flood_wait_seconds.inc(retry_after)
+                logging.warning(f"Telegram flood control: {endpoint} is retried in {retry_after}s")
+                self._resume_at = max(self._resume_at, time.monotonic() + retry_after + 0.1)
+                continue
+            except Exception:
+                telegram_requests.inc(method=endpoint, result="error")
+                raise
+            telegram_requests.inc(method=endpoint, result="success")
+            return result
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Any:
+        max_retries = self.max_retries if rate_limit_args is None else rate_limit_args
+        chat_id = data.get("chat_id")
+        queued_at = time.monotonic()
+        if chat_id is None:
+            telegram_send_wait_seconds.observe(0.0, method=endpoint)
+            return await self._send(callback, args, kwargs, endpoint, max_retries)
+
+        # Integer chat ids can be passed as strings
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        chat = self._chat(chat_id)
+
+        edit_key = (endpoint, data.get("message_id")) if endpoint in COALESCED_ENDPOINTS else None
+        pending: Optional[_PendingEdit] = None
+        if edit_key is not None:
+            pending = chat.edits.get(edit_key)
+            if pending is not None:
+                # The earlier edit is not sent yet, it is sent with the latest text and its result is returned to both callers
+                pending.args = args
+                telegram_requests.inc(method=endpoint, result="coalesced")
+                return await asyncio.shield(pending.future)
+            pending = chat.edits[edit_key] = _PendingEdit(args, asyncio.get_running_loop().create_future())
+
+        chat.pending += 1
+        telegram_sends_waiting.inc()
+        waiting = True
+        try:
+            async with chat.lock:
+                if chat.bucket is not None:
+                    await asyncio.sleep(chat.bucket.reserve(1))
+                if self._bucket is not None:
+                    await asyncio.sleep(self._bucket.reserve(1))
+                if pending is not None:
+                    # Edits coming from now on are sent after this one
+                    del chat.edits[edit_key]
+                    args = pending.args
+                waiting = False
+                telegram_sends_waiting.dec()
+                telegram_send_wait_seconds.observe(time.monotonic() - queued_at, method=endpoint)
+                result = await self._send(callback, args, kwargs, endpoint, max_retries)
+        except BaseException as e:
+            if pending is not None:
+                if chat.edits.get(edit_key) is pending:
+                    del chat.edits[edit_key]
+                if isinstance(e, asyncio.CancelledError):
+                    pending.future.cancel()
+                else:
+                    pending.future.set_exception(e)
+                    # The exception is raised to this caller, coalesced callers (if any) get it from the future
+                    pending.future.exception()
+            raise
+        finally:
+            chat.pending -= 1
+            if waiting:
+                telegram_sends_waiting.dec()
+        if pending is not None:
+            pending.future.set_result(result)
+        return result
+
+
+def create_rate_limiter() -> TelegramRateLimiter:
+    """Create rate limiter of outgoing Bot API requests from settings"""
+    return TelegramRateLimiter(
+        max_per_second=settings.telegram_bot.SEND_MAX_PER_SECOND,
+        chat_max_per_second=settings.telegram_bot.SEND_CHAT_MAX_PER_SECOND,
+        group_max_per_minute=settings.telegram_bot.SEND_GROUP_MAX_PER_MINUTE,
+        chat_burst=settings.telegram_bot.SEND_CHAT_BURST,
+        max_retries=settings.telegram_bot.SEND_MAX_RETRIES,
+        max_retry_after=settings.telegram_bot.SEND_MAX_RETRY_AFTER,
+    )
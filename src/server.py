@@ -0,0 +1,130 @@
+import asyncio
+import contextlib
+import hmac
+import logging
+from typing import Awaitable, Callable, Dict, Generator, Optional, Tuple
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from telegram import Update
+from telegram.ext import Application
+
+from src.metrics import registry
+
+
+class HealthChecks:
+    """
+    Registry of readiness checks. Failed critical checks make the bot not ready,
+    failed non-critical checks are only reported (the bot works in degraded mode).
+    """
+
+    def __init__(self) -> None:
+        self._checks: Dict[str, tuple[Callable[[], Awaitable[bool]], bool]] = {}
+
+    def register(self, name: str, check: Callable[[], Awaitable[bool]], critical: bool = True) -> None:
+        """Register a check which returns True if the component is ready"""
+        self._checks[name] = (check, critical)
+
+    async def run(self, timeout: float = 5.0) -> tuple[bool, Dict[str, bool]]:
+        """Run all checks concurrently. Returns overall readiness and result of every check"""
+        async def run_check(check: Callable[[], Awaitable[bool]]) -> bool:
+            try:
+                return bool(await asyncio.wait_for(check(), timeout=timeout))
+            except Exception as e:
+                logging.warning(f"Readiness check failed: {e}")
+                return False
+
+        names = list(self._checks)
+        results = await asyncio.gather(*(run_check(self._checks[name][0]) for name in names))
+        statuses = dict(zip(names, results))
+        ready = all(statuses[name] for name in names if self._checks[name][1])
+        return ready, statuses
+
+
+class _Server(uvicorn.Server):
+    """Uvicorn server which doesn't capture process signals, they are handled by the bot itself"""
+
+    @contextlib.contextmanager
+    def capture_signals(self) -> Generator[None, None, None]:
+        yield
+
+
+def create_web_app(
+    health_checks: HealthChecks,
+    webhooks: Optional[Dict[str, Tuple[Application, Optional[str]]]] = None,
+) -> Starlette:
+    """
+    Create ASGI app with health and metrics endpoints and (optionally) Telegram webhook endpoints.
+    webhooks maps path of every webhook to the application which processes its updates and the webhook secret token
+    """
+
+    async def healthz(request: Request) -> Response:
+        """Liveness: the process is running and the event loop is responsive"""
+        return JSONResponse({"status": "ok"})
+
+    async def readyz(request: Request) -> Response:
+        """Readiness: the bot can process updates"""
+        ready, checks = await health_checks.run()
+        return JSONResponse({"status": "ready" if ready else "not ready", "checks": checks}, status_code=200 if ready else 503)
+
+    async def metrics(request: Request) -> Response:
+        """Metrics in Prometheus text exposition format"""
+        return Response(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+    def create_webhook_endpoint(app: Application, webhook_secret_token: Optional[str]) -> Callable[[Request], Awaitable[Response]]:
+        async def telegram_webhook(request: Request) -> Response:
+            """Receive update from Telegram and put it to the update queue of the bot application"""
+            if webhook_secret_token is not None:
+                token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+                if not hmac.compare_digest(token, webhook_secret_token):
+                    logging.warning("Received webhook request with invalid secret token")
+                    return Response(status_code=403)
+
+            try:
+                update = Update.de_json(await request.json(), app.bot)
+            except Exception as e:
+                logging.error(f"Failed to parse webhook update: {e}")
+                return Response(status_code=400)
+
+            await app.update_queue.put(update)
+            return Response(status_code=200)
+
+        return telegram_webhook
+
+    routes = [
+        Route("/healthz", healthz, methods=["GET"]),
+        Route("/readyz", readyz, methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
+    ]
+    for webhook_path, (app, webhook_secret_token) in (webhooks or {}).items():
+        routes.append(Route(webhook_path, create_webhook_endpoint(app, webhook_secret_token), methods=["POST"]))
+    return Starlette(routes=routes)
+
+
+class HttpServer:
+    """Uvicorn server running in the bot event loop"""
+
+    def __init__(self, web_app: Starlette, host: str, port: int, log_level: str) -> None:
+        self._server = _Server(uvicorn.Config(web_app, host=host, port=port, log_level=log_level.lower(), lifespan="off"))
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        """Start serving requests in a background task"""
+        self._task = asyncio.create_task(self._server.serve(), name="HttpServer")
+        # Wait until the socket is bound, so startup errors (e.g. port in use) are raised here
+        while not self._server.started:
+            if self._task.done():
+                self._task.result()
+                raise RuntimeError("HTTP server stopped during startup")
+            await asyncio.sleep(0.05)
+
+    async def stop(self) -> None:
+        """Stop the server and wait for active requests to complete"""
+        if self._task is None:
+            return
+        self._server.should_exit = True
+        await self._task
+        self._task = None
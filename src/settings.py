@@ -1,5 +1,6 @@
 from typing import Optional, Literal
 
+from pydantic import model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict 
 # Read more about pydantic_settings here: https://docs.pydantic.dev/latest/concepts/pydantic_settings/.
 
@@ -9,13 +10,66 @@ class TelegramBotSettings(BaseSettings):
     Class for storing telegram bot settings
 
     Attributes:
-        TOKEN (str): The token for the telegram bot.
+        TOKEN (Optional[str]): The token for the telegram bot. Required unless bots are configured with TENANTS_CONFIG_PATH.
+        TENANTS_CONFIG_PATH (Optional[str]): YAML file with configs of several bots (tenants) served by one process,
+            see src/tenants.py. Default is None (one bot configured with the environment variables).
         LOGGING_LEVEL (str): The logging level for the telegram bot. Default is "INFO".
+        MAX_CONCURRENT_UPDATES (int): Maximum number of updates (from different chats) processed at the same time. Default is 16.
+        MAX_PENDING_UPDATES (int): Maximum number of updates held in processing and in chat queues. Default is 256.
+        STREAMING (bool): Stream replies to the user by editing the message as new tokens are generated. Default is True.
+        STREAM_EDIT_INTERVAL (float): Minimal interval between edits of a streamed message in seconds. Default is 1.0.
+        COALESCE_MESSAGES (bool): Answer messages which the user sends in quick succession with one reply: a newer message cancels
+            the turn of the previous one until it has replied, and all of them are answered together. Default is True.
+        COALESCE_WINDOW (float): Time in seconds a turn waits for more messages before the graph run. Default is 1.0.
+        MODE (str): How updates are received: "polling" (long polling) or "webhook". Default is "polling".
+        WEBHOOK_URL (str): Public URL of the webhook endpoint, its path is served by the HTTP server. Required in webhook mode.
+        WEBHOOK_SECRET_TOKEN (str): Secret token which Telegram sends with every webhook request. Default is None.
+        WEBHOOK_MAX_CONNECTIONS (int): Maximum number of simultaneous webhook connections from Telegram. Default is 40.
+        HTTP_SERVER_ENABLED (bool): Run HTTP server with health endpoints in polling mode. It always runs in webhook mode. Default is False.
+        HTTP_LISTEN (str): Listen address of the HTTP server. Default is "0.0.0.0".
+        HTTP_PORT (int): Port of the HTTP server. Default is 8080.
+        SEND_MAX_PER_SECOND (float): Maximum number of Bot API requests to all chats per second, 0 means unlimited. Default is 30.
+        SEND_CHAT_MAX_PER_SECOND (float): Maximum number of requests to a private chat per second, 0 means unlimited. Default is 1.
+        SEND_GROUP_MAX_PER_MINUTE (float): Maximum number of requests to a group chat per minute, 0 means unlimited. Default is 20.
+        SEND_CHAT_BURST (int): Number of requests to a chat which can be sent at once before its rate limit applies. Default is 3.
+        SEND_MAX_RETRIES (int): Number of retries of a request which received 429 Too Many Requests. Default is 3.
+        SEND_MAX_RETRY_AFTER (float): Requests are not retried if Telegram asks to wait longer (in seconds). Default is 60.
     """
     model_config = SettingsConfigDict(env_prefix='TELEGRAM_BOT_', env_file="./env/.env", extra='ignore')
     
-    TOKEN: str
+    TOKEN: Optional[str] = None
+    TENANTS_CONFIG_PATH: Optional[str] = None
     LOGGING_LEVEL: str = "INFO"
+    MAX_CONCURRENT_UPDATES: int = 16
+    MAX_PENDING_UPDATES: int = 256
+    STREAMING: bool = True
+    STREAM_EDIT_INTERVAL: float = 1.0
+    COALESCE_MESSAGES: bool = True
+    COALESCE_WINDOW: float = 1.0
+    MODE: Literal["polling", "webhook"] = "polling"
+    WEBHOOK_URL: Optional[str] = None
+    WEBHOOK_SECRET_TOKEN: Optional[str] = None
+    WEBHOOK_MAX_CONNECTIONS: int = 40
+    HTTP_SERVER_ENABLED: bool = False
+    HTTP_LISTEN: str = "0.0.0.0"
+    HTTP_PORT: int = 8080
+    SEND_MAX_PER_SECOND: float = 30
+    SEND_CHAT_MAX_PER_SECOND: float = 1
+    SEND_GROUP_MAX_PER_MINUTE: float = 20
+    SEND_CHAT_BURST: int = 3
+    SEND_MAX_RETRIES: int = 3
+    SEND_MAX_RETRY_AFTER: float = 60
+
+    @model_validator(mode="after")
+    def check_bot_config(self) -> "TelegramBotSettings":
+        """Single bot needs a token and, in webhook mode, public URL. Tenants have them in the tenants config"""
+        if self.TENANTS_CONFIG_PATH:
+            return self
+        if not self.TOKEN:
+            raise ValueError("TELEGRAM_BOT_TOKEN is required unless TELEGRAM_BOT_TENANTS_CONFIG_PATH is set")
+        if self.MODE == "webhook" and not self.WEBHOOK_URL:
+            raise ValueError("TELEGRAM_BOT_WEBHOOK_URL is required in webhook mode")
+        return self
 
 
 class LLMSettings(BaseSettings):
@@ -26,6 +80,23 @@ class LLMSettings(BaseSettings):
         BASE_API (str): The base API URL for the LLM. Default is None (OpenAI).
         API_KEY (str): The API key for the LLM.
         MODEL (str): The model name for the LLM.
+        STREAM_USAGE (bool): Request token usage of streamed responses (disable if the API doesn't support stream_options). Default is True.
+        TIMEOUT (float): Timeout of LLM requests in seconds (of every read for streamed responses). Default is 30.
+        MAX_RETRIES (int): Retries of failed LLM requests at the same endpoint before failing over. Default is 1.
+        FAST_MODEL (Optional[str]): Fast model for small talk (greetings, thanks), e.g. "gpt-4o-mini". Default is None (all requests go to MODEL).
+        FAST_MAX_CHARS (int): Only user messages not longer than this are sent to the fast model. Default is 80.
+        FAST_PATTERN (str): Regular expression which the whole user message (lowercase, without punctuation) must match
+            to be sent to the fast model. Default matches Russian and English greetings, thanks and acknowledgements.
+        SECONDARY_BASE_API (Optional[str]): Secondary endpoint of the main model for hedged requests and failover. Default is None (BASE_API).
+        SECONDARY_API_KEY (Optional[str]): API key of the secondary endpoint. Default is None (API_KEY).
+        SECONDARY_MODEL (Optional[str]): Model of the secondary endpoint. Default is None (MODEL).
+            The secondary endpoint is used if SECONDARY_BASE_API or SECONDARY_MODEL is set.
+        HEDGE (bool): Send a duplicate request to the backup endpoint when the first one exceeds its latency budget. Default is True.
+        HEDGE_PERCENTILE (float): Latency budget is this percentile of the recent times to the first token of the endpoint. Default is 95.
+        HEDGE_DELAY (float): Latency budget in seconds until the endpoint has enough latency samples. Default is 5.
+        HEDGE_MIN_DELAY (float): Minimal latency budget in seconds. Default is 0.5.
+        PROMPT_CACHE_KEY (bool): Send prompt_cache_key (hash of the system prompt and tools) with requests, so the provider
+            serves the static prompt prefix of all chats of a bot from one prompt cache (OpenAI). Default is False.
     """
     model_config = SettingsConfigDict(env_prefix="LLM_", env_file="./env/.env", extra='ignore')
 
@@ -33,6 +104,23 @@ class LLMSettings(BaseSettings):
     API_KEY: str
     MODEL: str = "gpt-4o-2024-08-06"
     PROXY_URL: Optional[str] = None
+    STREAM_USAGE: bool = True
+    TIMEOUT: float = 30
+    MAX_RETRIES: int = 1
+    FAST_MODEL: Optional[str] = None
+    FAST_MAX_CHARS: int = 80
+    FAST_PATTERN: str = (
+        r"((привет\w*|здравствуй\w*|добрый (день|вечер)|доброе утро|спасибо|большое|благодарю|ок|окей|хорошо|понятно|ясно|отлично|"
+        r"пока|до свидания|hi|hello|hey|thanks|thank you|ok|okay|bye)\s?)+"
+    )
+    SECONDARY_BASE_API: Optional[str] = None
+    SECONDARY_API_KEY: Optional[str] = None
+    SECONDARY_MODEL: Optional[str] = None
+    HEDGE: bool = True
+    HEDGE_PERCENTILE: float = 95
+    HEDGE_DELAY: float = 5
+    HEDGE_MIN_DELAY: float = 0.5
+    PROMPT_CACHE_KEY: bool = False
 
 
 class EmbedderSettings(BaseSettings):
@@ -43,6 +131,16 @@ class EmbedderSettings(BaseSettings):
         BASE_API (str): The base API URL for the embedder. Default is None (OpenAI).
         API_KEY (str): The API key for the embedder.
         MODEL (str): The model name for the embedder.
+        BATCH_SIZE (int): Number of texts embedded in one request. Default is 64.
+        MAX_CONCURRENCY (int): Number of embedding requests sent at the same time. Default is 4.
+        REQUESTS_PER_MINUTE (float): Rate limit of embedding requests, 0 means unlimited. Default is 0.
+        TOKENS_PER_MINUTE (float): Rate limit of embedded tokens (estimated), 0 means unlimited. Default is 0.
+        TIMEOUT (float): Timeout of an embedding request in seconds. Default is 30.
+        MAX_RETRIES (int): Number of retries of rate limited, timed out and failed requests. Default is 6.
+        RETRY_MIN_SECONDS (float): Delay before the first retry, doubled after every retry. Default is 1.
+        RETRY_MAX_SECONDS (float): Maximal delay between retries. Default is 60.
+        CACHE_PATH (Optional[str]): SQLite file of the persistent cache of document embeddings. Default is "data/embedding-cache.sqlite3",
+            empty value disables the cache.
     """
     model_config = SettingsConfigDict(env_prefix="EMBEDDER_", env_file="./env/.env", extra='ignore')
 
@@ -50,6 +148,120 @@ class EmbedderSettings(BaseSettings):
     API_KEY: str
     MODEL: str = "text-embedding-ada-002"
     PROXY_URL: Optional[str] = None
+    BATCH_SIZE: int = 64
+    MAX_CONCURRENCY: int = 4
+    REQUESTS_PER_MINUTE: float = 0
+    TOKENS_PER_MINUTE: float = 0
+    TIMEOUT: float = 30
+    MAX_RETRIES: int = 6
+    RETRY_MIN_SECONDS: float = 1
+    RETRY_MAX_SECONDS: float = 60
+    CACHE_PATH: Optional[str] = "data/embedding-cache.sqlite3"
+
+
+class HistorySettings(BaseSettings):
+    """
+    Class for storing conversation history policy of the manager agent
+
+    Attributes:
+        MAX_TOKENS (int): History token budget. If the history is longer, the oldest turns are summarized. Default is 6000.
+        KEEP_TOKENS (int): Number of tokens of the latest turns which are kept verbatim after summarization, must be less than
+            MAX_TOKENS. Default is 3000.
+        SUMMARY_MAX_TOKENS (int): Maximum length of the running summary in tokens. Default is 500.
+        TOOL_RESULT_MAX_CHARS (int): When the history is longer than MAX_TOKENS, tool results of the previous turns are truncated
+            to this number of characters before the oldest turns are summarized. Default is 1500.
+    """
+    model_config = SettingsConfigDict(env_prefix="HISTORY_", env_file="./env/.env", extra='ignore')
+
+    MAX_TOKENS: int = 6000
+    KEEP_TOKENS: int = 3000
+    SUMMARY_MAX_TOKENS: int = 500
+    TOOL_RESULT_MAX_CHARS: int = 1500
+
+    @model_validator(mode="after")
+    def check_budget(self) -> "HistorySettings":
+        """Turns kept after summarization must fit into the budget, otherwise every turn would be summarized again"""
+        if self.KEEP_TOKENS >= self.MAX_TOKENS:
+            raise ValueError("HISTORY_KEEP_TOKENS must be less than HISTORY_MAX_TOKENS")
+        return self
+
+
+class KnowledgeBaseSettings(BaseSettings):
+    """
+    Class for storing knowledge base (retrieval) settings
+
+    Attributes:
+        SOURCE_DIR (str): Directory with knowledge base source files. Default is "data/allsee-database".
+        SOURCE_GLOB (str): Glob pattern (relative to SOURCE_DIR) of markdown files to index. Default is "**/*.md".
+        CHROMA_DIR (str): Directory of the persistent Chroma database. Default is "data/rag-chroma".
+        COLLECTION_NAME (str): Name of the Chroma collection. Default is "rag-chroma".
+        CACHE_MAX_QUERIES (int): Number of query embeddings cached by exact (normalized) query text. Default is 1024.
+        CACHE_MAX_RESULTS (int): Number of cached search results looked up by query embedding. Default is 256.
+        CACHE_TTL_SECONDS (float): Time to live of cached search results. Default is 3600.
+        CACHE_SIMILARITY_THRESHOLD (Optional[float]): Minimal cosine similarity of query embeddings to reuse cached search results
+            of a different query, e.g. 0.99. Questions with different meaning can have very similar embeddings, so a loose
+            threshold makes the retriever answer another question. Default is None (results are reused only for the same embedding).
+        WARMUP_RETRY_SECONDS (float): Delay before retrying a failed knowledge base warm-up, doubled after every failure. Default is 5.
+        WARMUP_MAX_RETRY_SECONDS (float): Maximal delay between knowledge base warm-up retries. Default is 300.
+        READY_WAIT_SECONDS (float): Time a retrieval request waits for the knowledge base warm-up before answering without it. Default is 3.
+        RETRIEVAL_MODE (Literal["vector", "hybrid"]): Vector search only or vector search combined with BM25 keyword search. Default is "hybrid".
+        RETRIEVAL_K (int): Number of sections returned to the agent. Default is 3.
+        RETRIEVAL_FETCH_K (int): Number of candidates fetched by every search method before fusion and reranking. Default is 10.
+        RETRIEVAL_RRF_K (int): Constant of reciprocal rank fusion, larger values give more weight to lower ranks. Default is 60.
+        RETRIEVAL_VECTOR_MAX_DISTANCE (Optional[float]): Vector search candidates with larger distance are dropped. Default is None (no threshold).
+        RETRIEVAL_KEYWORD_MIN_SCORE (float): Keyword search candidates with BM25 score not above this value are dropped. Default is 0.
+        RERANKER_MODEL (Optional[str]): Local cross-encoder model for reranking of hybrid search candidates
+            (requires sentence-transformers package), e.g. "BAAI/bge-reranker-v2-m3". Default is None (no reranking).
+        RERANK_MIN_SCORE (Optional[float]): Reranked sections with lower score are dropped. Default is None (no threshold).
+        PREFETCH (bool): Search the knowledge base for every user message in parallel with history compaction and give the found
+            sections to the agent, so it usually answers without calling the retrieval tool first. Default is True.
+        PREFETCH_TIMEOUT (float): The agent is called without the prefetched sections if the search takes longer. Default is 2.
+    """
+    model_config = SettingsConfigDict(env_prefix="KNOWLEDGE_BASE_", env_file="./env/.env", extra='ignore')
+
+    SOURCE_DIR: str = "data/allsee-database"
+    SOURCE_GLOB: str = "**/*.md"
+    CHROMA_DIR: str = "data/rag-chroma"
+    COLLECTION_NAME: str = "rag-chroma"
+    CACHE_MAX_QUERIES: int = 1024
+    CACHE_MAX_RESULTS: int = 256
+    CACHE_TTL_SECONDS: float = 3600
+    CACHE_SIMILARITY_THRESHOLD: Optional[float] = None
+    WARMUP_RETRY_SECONDS: float = 5
+    WARMUP_MAX_RETRY_SECONDS: float = 300
+    READY_WAIT_SECONDS: float = 3
+    RETRIEVAL_MODE: Literal["vector", "hybrid"] = "hybrid"
+    RETRIEVAL_K: int = 3
+    RETRIEVAL_FETCH_K: int = 10
+    RETRIEVAL_RRF_K: int = 60
+    RETRIEVAL_VECTOR_MAX_DISTANCE: Optional[float] = None
+    RETRIEVAL_KEYWORD_MIN_SCORE: float = 0
+    RERANKER_MODEL: Optional[str] = None
+    RERANK_MIN_SCORE: Optional[float] = None
+    PREFETCH: bool = True
+    PREFETCH_TIMEOUT: float = 2
+
+
+class AnswerCacheSettings(BaseSettings):
+    """
+    Class for storing settings of the cache of replies to first-turn questions
+
+    Attributes:
+        ENABLED (bool): Answer the first question of a chat from the cache if the same question (ignoring case and punctuation)
+            was answered before with the same knowledge base version and prompt. Default is True.
+        PATH (str): SQLite file the cached replies are kept in across restarts, empty string keeps them only in memory.
+            Default is "data/answer-cache.sqlite3".
+        MAX_ENTRIES (int): Number of cached replies of every bot, the least recently used ones are evicted. Default is 1024.
+        TTL_SECONDS (float): Time to live of cached replies. Default is 86400.
+        MAX_QUESTION_CHARS (int): Longer questions are not cached, they are rarely asked again in the same words. Default is 300.
+    """
+    model_config = SettingsConfigDict(env_prefix="ANSWER_CACHE_", env_file="./env/.env", extra='ignore')
+
+    ENABLED: bool = True
+    PATH: str = "data/answer-cache.sqlite3"
+    MAX_ENTRIES: int = 1024
+    TTL_SECONDS: float = 86400
+    MAX_QUESTION_CHARS: int = 300
 
 
 class CheckpointerSettings(BaseSettings):
@@ -62,6 +274,27 @@ class CheckpointerSettings(BaseSettings):
         POSTGRES_DB (str): PostgreSQL database name. Default is "graph_memory".
         POSTGRES_USER (str): PostgreSQL user.
         POSTGRES_PASSWORD (str): PostgreSQL password.
+        CONNECT_TIMEOUT (int): Timeout of establishing a new connection in seconds. Default is 10.
+        POOL_MIN_SIZE (int): Minimal number of connections kept in the pool. Default is 2.
+        POOL_MAX_SIZE (int): Maximal number of connections in the pool. Default is 10.
+        POOL_TIMEOUT (float): Maximal time to wait for a connection from the pool in seconds. Default is 30.
+        POOL_MAX_WAITING (int): Maximal number of clients waiting for a connection, 0 means unlimited. Default is 0.
+        POOL_MAX_IDLE (float): Idle connections above min size are closed after this number of seconds. Default is 600.
+        POOL_MAX_LIFETIME (float): Connections are replaced after this number of seconds. Default is 3600.
+        POOL_RECONNECT_TIMEOUT (float): Time to keep trying to reconnect before reporting the failure in seconds. Default is 300.
+        POOL_CHECK_CONNECTIONS (bool): Check connections before giving them to clients, so broken connections are replaced. Default is True.
+        POOL_PREPARE_THRESHOLD (int): Number of executions of a query before it is prepared, 0 prepares at once,
+            negative value disables prepared statements (required behind PgBouncer in transaction mode). Default is 0.
+        RETENTION_KEEP_LAST (int): Number of the latest checkpoints kept for every thread, 0 disables pruning. Default is 20.
+        RETENTION_THREAD_TTL_DAYS (float): Threads without activity for this number of days are deleted. Default is None (never).
+        RETENTION_VACUUM (str): Vacuum after pruning: "none", "analyze" (VACUUM ANALYZE) or "full" (VACUUM FULL, locks tables). Default is "analyze".
+        RETENTION_INTERVAL_MINUTES (float): Interval of the retention background task in the bot, 0 disables it. Default is 60.
+        CACHE_ENABLED (Optional[bool]): Keep the latest checkpoints of active chats in memory and write only the final checkpoint
+            of every turn to the database. The cache is only correct if one process serves all chats. Default is None
+            (enabled in polling mode, disabled in webhook mode).
+        CACHE_MAX_THREADS (int): Maximal number of chats whose latest checkpoint is cached. Default is 10000.
+        CACHE_MAX_MB (float): Maximal estimated size of the cached checkpoints in megabytes. Default is 256.
+        CACHE_TTL_SECONDS (float): Checkpoints of chats without activity for this number of seconds are evicted. Default is 3600.
         DB_URI (property): Constructed PostgreSQL connection string.
     """
     model_config = SettingsConfigDict(env_prefix="CHECKPOINTER_", env_file="./env/.env", extra='ignore')
@@ -71,6 +304,24 @@ class CheckpointerSettings(BaseSettings):
     POSTGRES_DB: str = "checkpointer"
     POSTGRES_USER: str = "checkpointer"
     POSTGRES_PASSWORD: str
+    CONNECT_TIMEOUT: int = 10
+    POOL_MIN_SIZE: int = 2
+    POOL_MAX_SIZE: int = 10
+    POOL_TIMEOUT: float = 30
+    POOL_MAX_WAITING: int = 0
+    POOL_MAX_IDLE: float = 600
+    POOL_MAX_LIFETIME: float = 3600
+    POOL_RECONNECT_TIMEOUT: float = 300
+    POOL_CHECK_CONNECTIONS: bool = True
+    POOL_PREPARE_THRESHOLD: int = 0
+    RETENTION_KEEP_LAST: int = 20
+    RETENTION_THREAD_TTL_DAYS: Optional[float] = None
+    RETENTION_VACUUM: Literal["none", "analyze", "full"] = "analyze"
+    RETENTION_INTERVAL_MINUTES: float = 60
+    CACHE_ENABLED: Optional[bool] = None
+    CACHE_MAX_THREADS: int = 10000
+    CACHE_MAX_MB: float = 256
+    CACHE_TTL_SECONDS: float = 3600
 
     @property
     def POSGRES_CONNECTION_STRING(self) -> str:
@@ -78,11 +329,37 @@ class CheckpointerSettings(BaseSettings):
         return f"postgresql://{self.POSTGRES_USER}:{self.POSTGRES_PASSWORD}@{self.POSTGRES_HOST}:{self.POSTGRES_PORT}/{self.POSTGRES_DB}"
 
 
+class TracingSettings(BaseSettings):
+    """
+    Class for storing tracing settings
+
+    Attributes:
+        OTLP_ENDPOINT (Optional[str]): OTLP gRPC endpoint spans are exported to, e.g. "http://otel-collector:4317".
+            Default is None (spans are not exported, their durations are still available as metrics).
+        SERVICE_NAME (str): Service name of exported spans. Default is "allsee-info-bot".
+    """
+    model_config = SettingsConfigDict(env_prefix="TRACING_", env_file="./env/.env", extra='ignore')
+
+    OTLP_ENDPOINT: Optional[str] = None
+    SERVICE_NAME: str = "allsee-info-bot"
+
+
 class Settings(BaseSettings):
     telegram_bot: TelegramBotSettings = TelegramBotSettings()
     llm: LLMSettings = LLMSettings()
     embedder: EmbedderSettings = EmbedderSettings()
+    history: HistorySettings = HistorySettings()
+    knowledge_base: KnowledgeBaseSettings = KnowledgeBaseSettings()
+    answer_cache: AnswerCacheSettings = AnswerCacheSettings()
     checkpointer: CheckpointerSettings = CheckpointerSettings()
+    tracing: TracingSettings = TracingSettings()
+
+    @model_validator(mode="after")
+    def set_checkpoint_cache(self) -> "Settings":
+        """A webhook can be served by several processes by mistake, each with its own stale cache, so the cache is opt-in there"""
+        if self.checkpointer.CACHE_ENABLED is None:
+            self.checkpointer.CACHE_ENABLED = self.telegram_bot.MODE == "polling"
+        return self
 
 
 settings = Settings()
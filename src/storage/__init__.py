@@ -0,0 +1,17 @@
+from .file_ids import TelegramFileIdCache
+from .checkpointer import InstrumentedPostgresSaver
+from .checkpoint_cache import CachedCheckpointSaver, create_checkpoint_cache
+from .pool import InstrumentedConnectionPool, create_connection_pool
+from .retention import CheckpointRetention, create_checkpoint_retention
+
+
+__all__ = [
+    "TelegramFileIdCache",
+    "InstrumentedPostgresSaver",
+    "CachedCheckpointSaver",
+    "create_checkpoint_cache",
+    "InstrumentedConnectionPool",
+    "create_connection_pool",
+    "CheckpointRetention",
+    "create_checkpoint_retention",
+]
@@ -0,0 +1,398 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Iterator, Sequence
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    copy_checkpoint,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+
+from src.metrics import registry
+from src.settings import settings
+
+
+checkpoint_cache_requests = registry.counter(
+    "checkpoint_cache_requests_total",
+    "Reads of the latest checkpoint of a thread by result (hit: served from memory, miss: read from the database)",
+    ["result"],
+)
+checkpoint_cache_evictions = registry.counter(
+    "checkpoint_cache_evictions_total",
+    "Threads evicted from the checkpoint cache by reason (size, ttl)",
+    ["reason"],
+)
+checkpoint_cache_threads = registry.gauge(
+    "checkpoint_cache_threads",
+    "Number of threads whose latest checkpoint is cached",
+)
+checkpoint_cache_bytes = registry.gauge(
+    "checkpoint_cache_bytes",
+    "Estimated size of the cached checkpoints (serialized channel values)",
+)
+checkpoint_writes = registry.counter(
+    "checkpoint_writes_total",
+    "Checkpoint and pending writes saves by kind (checkpoint, writes) and result: "
+    "written to the database, deferred (buffered until the end of the turn and superseded by its final checkpoint) "
+    "or discarded (buffered by a turn which was cancelled)",
+    ["kind", "result"],
+)
+checkpoint_flush_seconds = registry.histogram(
+    "checkpoint_flush_seconds",
+    "Duration of writing the final checkpoint of a turn to the database",
+)
+
+
+def _checkpoint_config(thread_id: str, checkpoint_ns: str, checkpoint_id: str) -> RunnableConfig:
+    return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id}}
+
+
+class _CachedThread:
+    """Latest checkpoint of a thread (None if the thread has no checkpoints) and its estimated size"""
+    __slots__ = ("checkpoint", "size", "expires_at")
+
+    def __init__(self, checkpoint: Optional[CheckpointTuple], size: int, expires_at: float) -> None:
+        self.checkpoint = checkpoint
+        self.size = size
+        self.expires_at = expires_at
+
+
+class _NamespaceBuffer:
+    """Checkpoints of a namespace saved during the turn: config of the first save, the latest checkpoint and all changed channels"""
+    __slots__ = ("first_config", "config", "checkpoint", "metadata", "new_versions", "writes", "puts")
+
+    def __init__(self, first_config: RunnableConfig) -> None:
+        self.first_config = first_config
+        self.config: Optional[RunnableConfig] = None
+        self.checkpoint: Optional[Checkpoint] = None
+        self.metadata: Optional[CheckpointMetadata] = None
+        self.new_versions: ChannelVersions = {}
+        # Pending writes by checkpoint id: config, writes, task id and task path of every save
+        self.writes: Dict[str, List[Tuple[RunnableConfig, Sequence[Tuple[str, Any]], str, str]]] = {}
+        self.puts = 0
+
+
+class CachedCheckpointSaver(BaseCheckpointSaver):
+    """
+    Read-through / write-behind cache in front of a checkpointer (the PostgreSQL one in the bot).
+
+    - Reads: the latest checkpoint of recently active threads is kept in memory (LRU bounded by the number of threads
+      and the estimated size of their state, idle threads expire after ttl_seconds), so a turn usually starts without
+      a database read. Reads of other checkpoints go to the database.
+    - Writes: inside turn(thread_id) the checkpoints and pending writes of every graph step are buffered in memory.
+      When the turn completes, its final checkpoint is written to the database with all channels changed during the turn
+      as the child of the checkpoint the turn started from, so the database has one checkpoint per turn.
+      Checkpoints of subgraphs (other namespaces) are only needed to resume an interrupted subgraph and are not written.
+      Outside of turns saves are written through.
+
+    Recovery: a turn which fails is written as it is, like without the cache. A cancelled turn (e.g. superseded by a newer
+    message, see src/handlers/coalescing.py) or a turn in progress when the process crashes is lost as a whole: the thread
+    continues from the final checkpoint of the previous turn. The cache assumes that a thread is served by one process.
+    """
+
+    def __init__(self, saver: BaseCheckpointSaver, max_threads: int, max_bytes: int, ttl_seconds: float) -> None:
+        super().__init__(serde=saver.serde)
+        self.saver = saver
+        self.max_threads = max_threads
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._threads: "OrderedDict[str, _CachedThread]" = OrderedDict()
+        self._bytes = 0
+        # Buffers of the turns in progress by thread id and checkpoint namespace
+        self._turns: Dict[str, Dict[str, _NamespaceBuffer]] = {}
+
+    @property
+    def config_specs(self) -> list:
+        return self.saver.config_specs
+
+    def get_next_version(self, current: Optional[Any], channel: Any) -> Any:
+        return self.saver.get_next_version(current, channel)
+
+    # Cache of the latest checkpoints
+
+    def _estimate_size(self, checkpoint: Optional[CheckpointTuple]) -> int:
+        """Size of the serialized channel values, the memory taken by the objects is proportional to it"""
+        if checkpoint is None:
+            return 0
+        size = 0
+        for value in checkpoint.checkpoint["channel_values"].values():
+            try:
+                size += len(self.serde.dumps_typed(value)[1])
+            except Exception:
+                # Values which can't be serialized can't be saved either, the checkpointer reports them when writing
+                pass
+        return size
+
+    def _remember(self, thread_id: str, checkpoint: Optional[CheckpointTuple]) -> None:
+        """Cache the latest checkpoint of the thread and evict the least recently used threads above the limits"""
+        self._forget(thread_id)
+        size = self._estimate_size(checkpoint)
+        self._threads[thread_id] = _CachedThread(checkpoint, size, time.monotonic() + self.ttl_seconds)
+        self._bytes += size
+        while self._threads and (len(self._threads) > self.max_threads or self._bytes > self.max_bytes):
+            evicted_thread_id = next(iter(self._threads))
+            self._forget(evicted_thread_id)
+            checkpoint_cache_evictions.inc(reason="size")
+        self._update_gauges()
+
+    def _forget(self, thread_id: str) -> None:
+        cached = self._threads.pop(thread_id, None)
+        if cached is not None:
+            self._bytes -= cached.size
+
+    def _lookup(self, thread_id: str) -> Optional[_CachedThread]:
+        cached = self._threads.get(thread_id)
+        if cached is None:
+            return None
+        if cached.expires_at <= time.monotonic():
+            self._forget(thread_id)
+            checkpoint_cache_evictions.inc(reason="ttl")
+            self._update_gauges()
+            return None
+        cached.expires_at = time.monotonic() + self.ttl_seconds
+        self._threads.move_to_end(thread_id)
+        return cached
+
+    def _update_gauges(self) -> None:
+        checkpoint_cache_threads.set(len(self._threads))
+        checkpoint_cache_bytes.set(self._bytes)
+
+    # Turns
+
+    @asynccontextmanager
+    async def turn(self, thread_id: str) -> AsyncIterator[None]:
+        """Buffer checkpoints of the graph run in the thread and write its final checkpoint when the run ends"""
+        if thread_id in self._turns:
+            # Nested turn of the same thread, the outer one writes the checkpoint
+            yield
+            return
+        self._turns[thread_id] = {}
+        try:
+            yield
+        except asyncio.CancelledError:
+            self._discard(thread_id)
+            raise
+        except BaseException:
+            await asyncio.shield(self._flush(thread_id))
+            raise
+        await asyncio.shield(self._flush(thread_id))
+
+    def _discard(self, thread_id: str) -> None:
+        """Drop checkpoints of the cancelled turn, the cached checkpoint is still the one the turn started from"""
+        buffers = self._turns.pop(thread_id, {})
+        for buffer in buffers.values():
+            checkpoint_writes.inc(buffer.puts, kind="checkpoint", result="discarded")
+            checkpoint_writes.inc(sum(len(saves) for saves in buffer.writes.values()), kind="writes", result="discarded")
+        if buffers:
+            logging.info(f"Checkpoints of the cancelled turn in thread {thread_id} are discarded")
+
+    async def _flush(self, thread_id: str) -> None:
+        """Write the final checkpoint of the turn and its pending writes to the database"""
+        buffers = self._turns.pop(thread_id, {})
+        buffer = buffers.get("")
+        final_writes = buffer.writes.get(buffer.checkpoint["id"], []) if buffer is not None and buffer.checkpoint is not None else []
+        for checkpoint_ns, namespace_buffer in buffers.items():
+            written = checkpoint_ns == "" and namespace_buffer.checkpoint is not None
+            checkpoint_writes.inc(namespace_buffer.puts - written, kind="checkpoint", result="deferred")
+            saves = sum(len(saves) for saves in namespace_buffer.writes.values())
+            checkpoint_writes.inc(saves - (len(final_writes) if checkpoint_ns == "" else 0), kind="writes", result="deferred")
+        if buffer is None or buffer.checkpoint is None:
+            return
+
+        started_at = time.monotonic()
+        try:
+            # Only the final values of the channels changed during the turn are written
+            final_versions = buffer.checkpoint["channel_versions"]
+            new_versions = {channel: final_versions[channel] for channel in buffer.new_versions if channel in final_versions}
+            # The final checkpoint becomes the child of the checkpoint the turn started from
+            config = await self.saver.aput(buffer.first_config, buffer.checkpoint, buffer.metadata, new_versions)
+            checkpoint_writes.inc(kind="checkpoint", result="written")
+            pending_writes = []
+            for _, writes, task_id, task_path in final_writes:
+                await self.saver.aput_writes(config, writes, task_id, task_path)
+                checkpoint_writes.inc(kind="writes", result="written")
+                pending_writes.extend((task_id, channel, value) for channel, value in writes)
+        except Exception:
+            # The database has the previous turn, the cache must not serve the turn which was not saved
+            self._forget(thread_id)
+            self._update_gauges()
+            raise
+        finally:
+            checkpoint_flush_seconds.observe(time.monotonic() - started_at)
+
+        parent_id = get_checkpoint_id(buffer.first_config)
+        self._remember(thread_id, CheckpointTuple(
+            config=_checkpoint_config(thread_id, "", buffer.checkpoint["id"]),
+            checkpoint=buffer.checkpoint,
+            metadata=get_checkpoint_metadata(buffer.first_config, buffer.metadata),
+            parent_config=_checkpoint_config(thread_id, "", parent_id) if parent_id else None,
+            pending_writes=pending_writes,
+        ))
+
+    # Checkpointer interface
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        configurable = config["configurable"]
+        thread_id = configurable["thread_id"]
+        checkpoint_ns = configurable.get("checkpoint_ns", "")
+        checkpoint_id = get_checkpoint_id(config)
+
+        buffer = self._turns.get(thread_id, {}).get(checkpoint_ns)
+        if buffer is not None and buffer.checkpoint is not None and checkpoint_id in (None, buffer.checkpoint["id"]):
+            return CheckpointTuple(
+                config=_checkpoint_config(thread_id, checkpoint_ns, buffer.checkpoint["id"]),
+                checkpoint=copy_checkpoint(buffer.checkpoint),
+                metadata=get_checkpoint_metadata(buffer.first_config, buffer.metadata),
+                parent_config=None,
+                pending_writes=[
+                    (task_id, channel, value)
+                    for _, writes, task_id, _ in buffer.writes.get(buffer.checkpoint["id"], [])
+                    for channel, value in writes
+                ],
+            )
+        if checkpoint_ns != "":
+            return await self.saver.aget_tuple(config)
+
+        cached = self._lookup(thread_id)
+        if cached is not None and (
+            checkpoint_id is None or (cached.checkpoint is not None and cached.checkpoint.checkpoint["id"] == checkpoint_id)
+        ):
+            checkpoint_cache_requests.inc(result="hit")
+            if cached.checkpoint is None:
+                return None
+            # The graph run changes the checkpoint it started from, the cached one must stay intact
+            return cached.checkpoint._replace(checkpoint=copy_checkpoint(cached.checkpoint.checkpoint))
+
+        checkpoint_cache_requests.inc(result="miss")
+        checkpoint = await self.saver.aget_tuple(config)
+        if checkpoint_id is None:
+            self._remember(thread_id, checkpoint)
+            if checkpoint is not None:
+                return checkpoint._replace(checkpoint=copy_checkpoint(checkpoint.checkpoint))
+        return checkpoint
+
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        # History is read from the database, checkpoints of turns in progress are not there yet
+        async for checkpoint in self.saver.alist(config, filter=filter, before=before, limit=limit):
+            yield checkpoint
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        configurable = config["configurable"]
+        thread_id = configurable["thread_id"]
+        checkpoint_ns = configurable.get("checkpoint_ns", "")
+        buffers = self._turns.get(thread_id)
+        if buffers is None:
+            next_config = await self.saver.aput(config, checkpoint, metadata, new_versions)
+            checkpoint_writes.inc(kind="checkpoint", result="written")
+            if checkpoint_ns == "":
+                parent_id = get_checkpoint_id(config)
+                self._remember(thread_id, CheckpointTuple(
+                    config=next_config,
+                    checkpoint=checkpoint,
+                    metadata=get_checkpoint_metadata(config, metadata),
+                    parent_config=_checkpoint_config(thread_id, "", parent_id) if parent_id else None,
+                    pending_writes=[],
+                ))
+            return next_config
+
+        buffer = buffers.get(checkpoint_ns)
+        if buffer is None:
+            buffer = buffers[checkpoint_ns] = _NamespaceBuffer(config)
+        buffer.config = config
+        buffer.checkpoint = checkpoint
+        buffer.metadata = metadata
+        buffer.new_versions.update(new_versions)
+        buffer.puts += 1
+        return _checkpoint_config(thread_id, checkpoint_ns, checkpoint["id"])
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        configurable = config["configurable"]
+        thread_id = configurable["thread_id"]
+        buffer = self._turns.get(thread_id, {}).get(configurable.get("checkpoint_ns", ""))
+        if buffer is None:
+            await self.saver.aput_writes(config, writes, task_id, task_path)
+            checkpoint_writes.inc(kind="writes", result="written")
+            cached = self._threads.get(thread_id)
+            if (
+                configurable.get("checkpoint_ns", "") == "" and cached is not None and cached.checkpoint is not None
+                and cached.checkpoint.checkpoint["id"] == configurable.get("checkpoint_id")
+            ):
+                cached.checkpoint.pending_writes.extend((task_id, channel, value) for channel, value in writes)
+            return
+        buffer.writes.setdefault(configurable["checkpoint_id"], []).append((config, writes, task_id, task_path))
+
+    # Sync methods are not used by the bot, they bypass the cache
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return self.saver.get_tuple(config)
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        return self.saver.list(config, filter=filter, before=before, limit=limit)
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        self._forget(config["configurable"]["thread_id"])
+        self._update_gauges()
+        return self.saver.put(config, checkpoint, metadata, new_versions)
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        self._forget(config["configurable"]["thread_id"])
+        self._update_gauges()
+        self.saver.put_writes(config, writes, task_id, task_path)
+
+
+def create_checkpoint_cache(saver: BaseCheckpointSaver) -> CachedCheckpointSaver:
+    """Put the checkpoint cache configured in settings in front of the checkpointer"""
+    return CachedCheckpointSaver(
+        saver,
+        max_threads=settings.checkpointer.CACHE_MAX_THREADS,
+        max_bytes=int(settings.checkpointer.CACHE_MAX_MB * 1024 * 1024),
+        ttl_seconds=settings.checkpointer.CACHE_TTL_SECONDS,
+    )
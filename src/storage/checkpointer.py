@@ -0,0 +1,36 @@
+from collections.abc import Sequence
+from typing import Any, Optional
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import ChannelVersions, Checkpoint, CheckpointMetadata, CheckpointTuple
+from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+
+from src.tracing import traced
+
+
+class InstrumentedPostgresSaver(AsyncPostgresSaver):
+    """PostgreSQL checkpointer which traces checkpoint reads and writes"""
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        with traced("checkpoint.get"):
+            return await super().aget_tuple(config)
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        with traced("checkpoint.put", **{"checkpoint.channels": len(new_versions)}):
+            return await super().aput(config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        with traced("checkpoint.put_writes", **{"checkpoint.writes": len(writes)}):
+            await super().aput_writes(config, writes, task_id, task_path)
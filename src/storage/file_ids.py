@@ -0,0 +1,90 @@
+import asyncio
+import hashlib
+import logging
+import os
+from typing import Dict, Optional, Tuple
+
+from psycopg_pool import AsyncConnectionPool
+
+
+CREATE_TABLE_QUERY = """
+CREATE TABLE IF NOT EXISTS telegram_file_ids (
+    bot_id BIGINT NOT NULL,
+    path TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (bot_id, path)
+)
+"""
+
+SELECT_FILE_ID_QUERY = """
+SELECT file_id FROM telegram_file_ids WHERE bot_id = %s AND path = %s AND content_hash = %s
+"""
+
+UPSERT_FILE_ID_QUERY = """
+INSERT INTO telegram_file_ids (bot_id, path, content_hash, file_id)
+VALUES (%s, %s, %s, %s)
+ON CONFLICT (bot_id, path) DO UPDATE
+SET content_hash = EXCLUDED.content_hash, file_id = EXCLUDED.file_id, updated_at = now()
+"""
+
+DELETE_FILE_ID_QUERY = """
+DELETE FROM telegram_file_ids WHERE bot_id = %s AND path = %s
+"""
+
+
+def _hash_file(path: str) -> str:
+    """Calculate sha256 hash of the file content"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class TelegramFileIdCache:
+    """
+    Persistent cache of Telegram file_id values of already uploaded local files.
+    Records are stored in PostgreSQL and keyed by bot id (file_id is only valid for the bot which uploaded the file),
+    file path and file content hash, so a changed file is uploaded again.
+    """
+
+    def __init__(self, pool: AsyncConnectionPool) -> None:
+        self.pool = pool
+        # Content hashes are memoized by file modification time and size to avoid reading the whole file on every send
+        self._hashes: Dict[str, Tuple[int, int, str]] = {}
+
+    async def setup(self) -> None:
+        """Create table for the cache if it doesn't exist"""
+        async with self.pool.connection() as conn:
+            await conn.execute(CREATE_TABLE_QUERY)
+
+    async def hash_file(self, path: str) -> str:
+        """Get content hash of the file"""
+        stat = await asyncio.to_thread(os.stat, path)
+        cached = self._hashes.get(path)
+        if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+
+        content_hash = await asyncio.to_thread(_hash_file, path)
+        self._hashes[path] = (stat.st_mtime_ns, stat.st_size, content_hash)
+        return content_hash
+
+    async def get(self, bot_id: int, path: str, content_hash: str) -> Optional[str]:
+        """Get file_id of the file if this exact file content was already uploaded"""
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(SELECT_FILE_ID_QUERY, (bot_id, path, content_hash))
+            row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def put(self, bot_id: int, path: str, content_hash: str, file_id: str) -> None:
+        """Store file_id of the uploaded file"""
+        async with self.pool.connection() as conn:
+            await conn.execute(UPSERT_FILE_ID_QUERY, (bot_id, path, content_hash, file_id))
+        logging.info(f"Cached Telegram file_id for {path}")
+
+    async def delete(self, bot_id: int, path: str) -> None:
+        """Remove file_id of the file, e.g. if Telegram doesn't accept it anymore"""
+        async with self.pool.connection() as conn:
+            await conn.execute(DELETE_FILE_ID_QUERY, (bot_id, path))
@@ -0,0 +1,116 @@
+import logging
+import time
+from typing import Any, Dict, Optional
+
+from psycopg import AsyncConnection
+from psycopg_pool import AsyncConnectionPool
+
+from src.metrics import registry
+from src.settings import settings
+
+
+pool_checkout_wait_seconds = registry.histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent waiting for a connection from the pool",
+    ["pool"],
+)
+pool_checkout_errors = registry.counter(
+    "db_pool_checkout_errors_total",
+    "Failed attempts to get a connection from the pool (timeouts, pool closed)",
+    ["pool"],
+)
+pool_connections = registry.gauge(
+    "db_pool_connections",
+    "Pool connections by state",
+    ["pool", "state"],
+)
+pool_requests_waiting = registry.gauge(
+    "db_pool_requests_waiting",
+    "Number of clients waiting for a connection",
+    ["pool"],
+)
+pool_events = registry.counter(
+    "db_pool_events_total",
+    "Pool counters from psycopg_pool statistics (connections opened, lost, failed, bad returns, queued requests)",
+    ["pool", "event"],
+)
+
+# psycopg_pool counters exported as pool events
+POOL_STATS_COUNTERS = (
+    "requests_num",
+    "requests_queued",
+    "requests_errors",
+    "returns_bad",
+    "connections_num",
+    "connections_errors",
+    "connections_lost",
+)
+
+
+class InstrumentedConnectionPool(AsyncConnectionPool):
+    """AsyncConnectionPool which records connection checkout wait time and errors"""
+
+    async def getconn(self, timeout: Optional[float] = None) -> AsyncConnection:
+        started_at = time.monotonic()
+        try:
+            conn = await super().getconn(timeout)
+        except Exception:
+            pool_checkout_errors.inc(pool=self.name)
+            raise
+        finally:
+            pool_checkout_wait_seconds.observe(time.monotonic() - started_at, pool=self.name)
+        return conn
+
+    def collect_metrics(self) -> None:
+        """Export pool statistics, counters are reset in the pool after every collection"""
+        if self.closed:
+            return
+        stats = self.pop_stats()
+        size, available = stats.get("pool_size", 0), stats.get("pool_available", 0)
+        pool_connections.set(size - available, pool=self.name, state="in_use")
+        pool_connections.set(available, pool=self.name, state="idle")
+        pool_requests_waiting.set(stats.get("requests_waiting", len(getattr(self, "_waiting", ()))), pool=self.name)
+        for counter in POOL_STATS_COUNTERS:
+            if stats.get(counter):
+                pool_events.inc(stats[counter], pool=self.name, event=counter)
+        if stats.get("requests_wait_ms"):
+            pool_events.inc(stats["requests_wait_ms"], pool=self.name, event="requests_wait_ms")
+
+
+async def _log_reconnect_failed(pool: AsyncConnectionPool) -> None:
+    """Called when the pool failed to reconnect during reconnect_timeout"""
+    logging.error(f"Connection pool {pool.name} failed to reconnect to PostgreSQL, will keep trying")
+
+
+def create_connection_pool(name: str = "checkpointer", **overrides: Any) -> InstrumentedConnectionPool:
+    """
+    Create connection pool for the checkpointer database from settings. Connections are checked before they are given
+    to clients, so connections broken by a PostgreSQL restart are replaced transparently. The pool must be opened with `async with`.
+    """
+    connection_kwargs: Dict[str, Any] = {
+        "autocommit": True,
+        "connect_timeout": settings.checkpointer.CONNECT_TIMEOUT,
+        # Checkpointer runs the same few queries all the time, so preparing them saves parsing and planning on every call
+        "prepare_threshold": settings.checkpointer.POOL_PREPARE_THRESHOLD if settings.checkpointer.POOL_PREPARE_THRESHOLD >= 0 else None,
+    }
+    pool_kwargs: Dict[str, Any] = {
+        "min_size": settings.checkpointer.POOL_MIN_SIZE,
+        "max_size": settings.checkpointer.POOL_MAX_SIZE,
+        "timeout": settings.checkpointer.POOL_TIMEOUT,
+        "max_waiting": settings.checkpointer.POOL_MAX_WAITING,
+        "max_idle": settings.checkpointer.POOL_MAX_IDLE,
+        "max_lifetime": settings.checkpointer.POOL_MAX_LIFETIME,
+        "reconnect_timeout": settings.checkpointer.POOL_RECONNECT_TIMEOUT,
+        "check": AsyncConnectionPool.check_connection if settings.checkpointer.POOL_CHECK_CONNECTIONS else None,
+        **overrides,
+    }
+    pool = InstrumentedConnectionPool(
+        conninfo=settings.checkpointer.POSGRES_CONNECTION_STRING,
+        kwargs=connection_kwargs,
+        name=name,
+        open=False,
+        reconnect_failed=_log_reconnect_failed,
+        **pool_kwargs,
+    )
+    registry.register_collector(pool.collect_metrics)
+    return pool
@@ -0,0 +1,283 @@
+import argparse
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Literal, Optional
+
+from psycopg import AsyncConnection
+from psycopg_pool import AsyncConnectionPool
+
+from src.metrics import registry
+from src.settings import settings
+from .pool import create_connection_pool
+
+
+# Key of the advisory lock which makes sure that only one bot replica runs retention at a time
+RETENTION_LOCK_KEY = 7_351_002_018
+
+CHECKPOINT_TABLES = ("checkpoints", "checkpoint_blobs", "checkpoint_writes")
+
+# Delete all data of threads which were not active for the given number of seconds
+EXPIRE_IDLE_THREADS_QUERY = """
+WITH idle AS (
+    SELECT thread_id FROM checkpoints
+    GROUP BY thread_id
+    HAVING max((checkpoint->>'ts')::timestamptz) < now() - make_interval(secs => %(ttl_seconds)s)
+),
+deleted_writes AS (
+    DELETE FROM checkpoint_writes w USING idle WHERE w.thread_id = idle.thread_id
+    RETURNING pg_column_size(w.*) AS size
+),
+deleted_blobs AS (
+    DELETE FROM checkpoint_blobs b USING idle WHERE b.thread_id = idle.thread_id
+    RETURNING pg_column_size(b.*) AS size
+),
+deleted_checkpoints AS (
+    DELETE FROM checkpoints c USING idle WHERE c.thread_id = idle.thread_id
+    RETURNING pg_column_size(c.*) AS size
+)
+SELECT
+    (SELECT count(*) FROM idle),
+    (SELECT count(*) FROM deleted_checkpoints), (SELECT coalesce(sum(size), 0) FROM deleted_checkpoints),
+    (SELECT count(*) FROM deleted_blobs), (SELECT coalesce(sum(size), 0) FROM deleted_blobs),
+    (SELECT count(*) FROM deleted_writes), (SELECT coalesce(sum(size), 0) FROM deleted_writes)
+"""
+
+# Keep only the last N root checkpoints of every thread. Subgraph checkpoints (non-empty checkpoint_ns) which are older
+# than the oldest kept root checkpoint are deleted too (checkpoint ids are time ordered). Writes of the parents
+# of kept checkpoints are kept, because they can contain pending sends of the kept checkpoints.
+PRUNE_OLD_CHECKPOINTS_QUERY = """
+WITH ranked AS (
+    SELECT thread_id, checkpoint_id,
+        row_number() OVER (PARTITION BY thread_id ORDER BY checkpoint_id DESC) AS position
+    FROM checkpoints
+    WHERE checkpoint_ns = ''
+),
+cutoff AS (
+    SELECT thread_id, checkpoint_id FROM ranked WHERE position = %(keep_last)s
+),
+kept_parents AS (
+    SELECT c.thread_id, c.checkpoint_ns, c.parent_checkpoint_id AS checkpoint_id
+    FROM checkpoints c JOIN cutoff ON c.thread_id = cutoff.thread_id
+    WHERE c.checkpoint_id >= cutoff.checkpoint_id AND c.parent_checkpoint_id IS NOT NULL
+),
+deleted_checkpoints AS (
+    DELETE FROM checkpoints c USING cutoff
+    WHERE c.thread_id = cutoff.thread_id AND c.checkpoint_id < cutoff.checkpoint_id
+    RETURNING pg_column_size(c.*) AS size
+),
+deleted_writes AS (
+    DELETE FROM checkpoint_writes w USING cutoff
+    WHERE w.thread_id = cutoff.thread_id AND w.checkpoint_id < cutoff.checkpoint_id
+        AND NOT EXISTS (
+            SELECT 1 FROM kept_parents p
+            WHERE p.thread_id = w.thread_id AND p.checkpoint_ns = w.checkpoint_ns AND p.checkpoint_id = w.checkpoint_id
+        )
+    RETURNING pg_column_size(w.*) AS size
+)
+SELECT
+    (SELECT count(*) FROM cutoff),
+    (SELECT count(*) FROM deleted_checkpoints), (SELECT coalesce(sum(size), 0) FROM deleted_checkpoints),
+    (SELECT count(*) FROM deleted_writes), (SELECT coalesce(sum(size), 0) FROM deleted_writes)
+"""
+
+# Delete blobs which are not referenced by any checkpoint. Blobs are written before their checkpoint,
+# so only threads without recent checkpoints are processed to not delete blobs of a checkpoint which is being written.
+DELETE_ORPHAN_BLOBS_QUERY = """
+WITH settled AS (
+    SELECT thread_id FROM checkpoints
+    GROUP BY thread_id
+    HAVING max((checkpoint->>'ts')::timestamptz) < now() - make_interval(secs => %(grace_seconds)s)
+),
+deleted_blobs AS (
+    DELETE FROM checkpoint_blobs b USING settled
+    WHERE b.thread_id = settled.thread_id
+        AND NOT EXISTS (
+            SELECT 1 FROM checkpoints c
+            WHERE c.thread_id = b.thread_id AND c.checkpoint_ns = b.checkpoint_ns
+                AND c.checkpoint -> 'channel_versions' ->> b.channel = b.version
+        )
+    RETURNING pg_column_size(b.*) AS size
+)
+SELECT count(*), coalesce(sum(size), 0) FROM deleted_blobs
+"""
+
+TABLES_SIZE_QUERY = """
+SELECT coalesce(sum(pg_total_relation_size(to_regclass(name))), 0) FROM unnest(%(tables)s::text[]) AS name
+"""
+
+# Grace period for orphan blobs of active threads, see DELETE_ORPHAN_BLOBS_QUERY
+ORPHAN_BLOBS_GRACE_SECONDS = 600
+
+
+retention_deleted_rows = registry.counter(
+    "checkpoint_retention_deleted_rows_total",
+    "Rows deleted by checkpoint retention by table",
+    ["table"],
+)
+retention_deleted_bytes = registry.counter(
+    "checkpoint_retention_deleted_bytes_total",
+    "Size of rows deleted by checkpoint retention by table",
+    ["table"],
+)
+retention_run_seconds = registry.histogram(
+    "checkpoint_retention_run_seconds",
+    "Duration of checkpoint retention runs",
+    buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0),
+)
+
+
+@dataclass
+class RetentionReport:
+    """Result of a checkpoint retention run"""
+    expired_threads: int = 0
+    pruned_threads: int = 0
+    deleted_rows: Dict[str, int] = field(default_factory=lambda: dict.fromkeys(CHECKPOINT_TABLES, 0))
+    deleted_bytes: Dict[str, int] = field(default_factory=lambda: dict.fromkeys(CHECKPOINT_TABLES, 0))
+    size_before: int = 0
+    size_after: int = 0
+    skipped: bool = False
+
+    def add(self, table: str, rows: int, size: int) -> None:
+        self.deleted_rows[table] += rows
+        self.deleted_bytes[table] += size
+
+    @property
+    def reclaimed_bytes(self) -> int:
+        """Decrease of the tables size on disk (only VACUUM FULL returns space to the operating system)"""
+        return self.size_before - self.size_after
+
+    def __str__(self) -> str:
+        if self.skipped:
+            return "skipped (another retention run is in progress)"
+        rows = ", ".join(f"{table}: {self.deleted_rows[table]} rows / {self.deleted_bytes[table]} bytes" for table in CHECKPOINT_TABLES)
+        return (
+            f"{self.expired_threads} idle threads expired, {self.pruned_threads} threads pruned; deleted {rows}; "
+            f"tables size {self.size_before} -> {self.size_after} bytes ({self.reclaimed_bytes} bytes reclaimed)"
+        )
+
+
+class CheckpointRetention:
+    """
+    Retention of LangGraph PostgreSQL checkpoints:
+    - threads without activity for thread_ttl_seconds are deleted completely;
+    - only keep_last latest checkpoints of every thread are kept (history before them can't be time-traveled to,
+      but the latest state of the thread is complete);
+    - blobs which are not referenced by any checkpoint anymore are deleted;
+    - tables are vacuumed to make space of deleted rows reusable (or returned to the OS with VACUUM FULL).
+    """
+
+    def __init__(
+        self,
+        pool: AsyncConnectionPool,
+        keep_last: int,
+        thread_ttl_seconds: Optional[float],
+        vacuum: Literal["none", "analyze", "full"],
+    ) -> None:
+        self.pool = pool
+        self.keep_last = keep_last
+        self.thread_ttl_seconds = thread_ttl_seconds
+        self.vacuum = vacuum
+
+    async def _tables_size(self, conn: AsyncConnection) -> int:
+        cursor = await conn.execute(TABLES_SIZE_QUERY, {"tables": list(CHECKPOINT_TABLES)})
+        return (await cursor.fetchone())[0]
+
+    async def run(self) -> RetentionReport:
+        """Run retention once"""
+        report = RetentionReport()
+        started_at = time.monotonic()
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute("SELECT pg_try_advisory_lock(%s)", (RETENTION_LOCK_KEY,))
+            if not (await cursor.fetchone())[0]:
+                report.skipped = True
+                return report
+
+            try:
+                report.size_before = await self._tables_size(conn)
+
+                if self.thread_ttl_seconds:
+                    async with conn.transaction():
+                        cursor = await conn.execute(EXPIRE_IDLE_THREADS_QUERY, {"ttl_seconds": self.thread_ttl_seconds})
+                        threads, checkpoints, checkpoints_size, blobs, blobs_size, writes, writes_size = await cursor.fetchone()
+                    report.expired_threads = threads
+                    report.add("checkpoints", checkpoints, checkpoints_size)
+                    report.add("checkpoint_blobs", blobs, blobs_size)
+                    report.add("checkpoint_writes", writes, writes_size)
+
+                if self.keep_last > 0:
+                    async with conn.transaction():
+                        cursor = await conn.execute(PRUNE_OLD_CHECKPOINTS_QUERY, {"keep_last": self.keep_last})
+                        threads, checkpoints, checkpoints_size, writes, writes_size = await cursor.fetchone()
+                    report.pruned_threads = threads
+                    report.add("checkpoints", checkpoints, checkpoints_size)
+                    report.add("checkpoint_writes", writes, writes_size)
+
+                async with conn.transaction():
+                    cursor = await conn.execute(DELETE_ORPHAN_BLOBS_QUERY, {"grace_seconds": ORPHAN_BLOBS_GRACE_SECONDS})
+                    blobs, blobs_size = await cursor.fetchone()
+                report.add("checkpoint_blobs", blobs, blobs_size)
+
+                # VACUUM can't run inside a transaction block, pool connections are in autocommit mode
+                if self.vacuum != "none":
+                    vacuum_options = "FULL, ANALYZE" if self.vacuum == "full" else "ANALYZE"
+                    for table in CHECKPOINT_TABLES:
+                        await conn.execute(f"VACUUM ({vacuum_options}) {table}")
+
+                report.size_after = await self._tables_size(conn)
+
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock(%s)", (RETENTION_LOCK_KEY,))
+
+        for table in CHECKPOINT_TABLES:
+            retention_deleted_rows.inc(report.deleted_rows[table], table=table)
+            retention_deleted_bytes.inc(report.deleted_bytes[table], table=table)
+        retention_run_seconds.observe(time.monotonic() - started_at)
+        return report
+
+    async def run_periodically(self, interval_seconds: float) -> None:
+        """Run retention every interval_seconds until cancelled"""
+        while True:
+            try:
+                report = await self.run()
+                logging.info(f"Checkpoint retention: {report}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Checkpoint retention failed: {e}")
+            await asyncio.sleep(interval_seconds)
+
+
+def create_checkpoint_retention(pool: AsyncConnectionPool) -> CheckpointRetention:
+    """Create checkpoint retention from settings"""
+    ttl_days = settings.checkpointer.RETENTION_THREAD_TTL_DAYS
+    return CheckpointRetention(
+        pool=pool,
+        keep_last=settings.checkpointer.RETENTION_KEEP_LAST,
+        thread_ttl_seconds=ttl_days * 24 * 3600 if ttl_days else None,
+        vacuum=settings.checkpointer.RETENTION_VACUUM,
+    )
+
+
+async def _run_once() -> RetentionReport:
+    async with create_connection_pool(name="retention", min_size=1, max_size=1) as pool:
+        return await create_checkpoint_retention(pool).run()
+
+
+def main():
+    """Command line entry point: python -m src.storage.retention"""
+    parser = argparse.ArgumentParser(description="Prune LangGraph checkpoints according to retention settings")
+    parser.add_argument("--vacuum", choices=["none", "analyze", "full"], help="Override CHECKPOINTER_RETENTION_VACUUM")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=settings.telegram_bot.LOGGING_LEVEL)
+    if args.vacuum:
+        settings.checkpointer.RETENTION_VACUUM = args.vacuum
+
+    report = asyncio.run(_run_once())
+    logging.info(f"Checkpoint retention: {report}")
+
+
+if __name__ == "__main__":
+    main()
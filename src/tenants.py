@@ -0,0 +1,182 @@
+import logging
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional
+from urllib.parse import urlparse
+
+import yaml
+from pydantic import BaseModel, ConfigDict, model_validator
+from langgraph.graph.graph import CompiledGraph
+
+from src.settings import KnowledgeBaseSettings, settings
+from src.agentic.agents import (
+    MANAGER_AGENT_SYSTEM_PROMPT,
+    RETRIEVAL_TOOL_DESCRIPTION,
+    RETRIEVAL_TOOL_NAME,
+    AnswerCache,
+    create_answer_cache,
+    create_context_retrieval,
+    create_manager_agent,
+    create_retrieval_tool,
+)
+from src.agentic.agents.manager.tools.telegram import send_document_to_user
+from src.agentic.knowledge_base import KnowledgeBase, create_knowledge_base
+
+
+DEFAULT_TENANT_NAME = "default"
+
+
+class TenantConfig(BaseModel):
+    """
+    Config of one bot (tenant) served by the process
+
+    Attributes:
+        name (str): Unique name of the tenant, used in logs, metrics and readiness checks.
+        token (str): The token for the telegram bot.
+        system_prompt (Optional[str]): System prompt of the manager agent. Default is None (the built-in prompt).
+        system_prompt_file (Optional[str]): File with the system prompt, used if system_prompt is not set.
+        start_message (Optional[str]): HTML reply to /start. Default is None (the built-in greeting).
+        retrieval_tool_name (str): Name of the knowledge base tool shown to the LLM.
+        retrieval_tool_description (str): Description of the knowledge base tool shown to the LLM.
+        knowledge_base (Dict[str, Any]): Knowledge base settings of the tenant, e.g. {"chroma_dir": "data/other-chroma"}.
+            Keys are KnowledgeBaseSettings fields (case-insensitive), settings which are not set are taken from KNOWLEDGE_BASE_* variables.
+        webhook_url (Optional[str]): Public URL of the tenant webhook, paths of tenants must differ. Required in webhook mode.
+        webhook_secret_token (Optional[str]): Secret token which Telegram sends with every webhook request. Default is None.
+        preload_knowledge_base (bool): Warm up the knowledge base at startup instead of on the first retrieval query. Default is False.
+        thread_id_prefix (Optional[str]): Prefix of checkpointer thread ids of the tenant chats, so chats of different bots
+            never share history. Default is None ("<name>:").
+    """
+    model_config = ConfigDict(extra="forbid")
+
+    name: str
+    token: str
+    system_prompt: Optional[str] = None
+    system_prompt_file: Optional[str] = None
+    start_message: Optional[str] = None
+    retrieval_tool_name: str = RETRIEVAL_TOOL_NAME
+    retrieval_tool_description: str = RETRIEVAL_TOOL_DESCRIPTION
+    knowledge_base: Dict[str, Any] = {}
+    webhook_url: Optional[str] = None
+    webhook_secret_token: Optional[str] = None
+    preload_knowledge_base: bool = False
+    thread_id_prefix: Optional[str] = None
+
+    @model_validator(mode="after")
+    def set_thread_id_prefix(self) -> "TenantConfig":
+        if self.thread_id_prefix is None:
+            self.thread_id_prefix = f"{self.name}:"
+        return self
+
+    def knowledge_base_settings(self) -> KnowledgeBaseSettings:
+        """Knowledge base settings of the tenant: its overrides on top of the environment settings"""
+        if not self.knowledge_base:
+            return settings.knowledge_base
+        return KnowledgeBaseSettings(**{key.upper(): value for key, value in self.knowledge_base.items()})
+
+    def load_system_prompt(self) -> str:
+        if self.system_prompt is not None:
+            return self.system_prompt
+        if self.system_prompt_file is not None:
+            return Path(self.system_prompt_file).read_text(encoding="utf-8")
+        return MANAGER_AGENT_SYSTEM_PROMPT
+
+    @property
+    def webhook_path(self) -> Optional[str]:
+        return (urlparse(self.webhook_url).path or "/") if self.webhook_url else None
+
+
+class Tenant:
+    """
+    Bot of a tenant: its knowledge base, manager agent, the graph node which prefetches knowledge base sections for the agent
+    and the cache of replies to first questions.
+    The knowledge base is warmed up lazily by the first retrieval query unless it is preloaded, so idle tenants don't hold
+    their indexes in memory
+    """
+
+    def __init__(self, config: TenantConfig) -> None:
+        self.config = config
+        self.name = config.name
+        self.knowledge_base: KnowledgeBase = create_knowledge_base(config.knowledge_base_settings(), name=config.name)
+        retrieval_tool = create_retrieval_tool(
+            self.knowledge_base,
+            name=config.retrieval_tool_name,
+            description=config.retrieval_tool_description,
+        )
+        system_prompt = config.load_system_prompt()
+        tools = [send_document_to_user, retrieval_tool]
+        self.manager_agent: CompiledGraph = create_manager_agent(
+            system_prompt=system_prompt,
+            tools=tools,
+            retrieval_tool_name=config.retrieval_tool_name,
+        )
+        knowledge_base_settings = self.knowledge_base.config
+        self.retrieve_context: Optional[Callable[..., Awaitable[Dict[str, Any]]]] = (
+            create_context_retrieval(self.knowledge_base, timeout=knowledge_base_settings.PREFETCH_TIMEOUT)
+            if knowledge_base_settings.PREFETCH else None
+        )
+        self.answer_cache: Optional[AnswerCache] = create_answer_cache(
+            config.name, self.knowledge_base, system_prompt, tools, retrieval_tool_name=config.retrieval_tool_name,
+        ) if settings.answer_cache.ENABLED else None
+
+    def thread_id(self, chat_id: int) -> str:
+        """Checkpointer thread id of the chat with the tenant bot"""
+        return f"{self.config.thread_id_prefix}{chat_id}"
+
+
+class TenantRegistry:
+    """Tenants served by the process by name"""
+
+    def __init__(self, tenants: List[Tenant]) -> None:
+        self._tenants = {tenant.name: tenant for tenant in tenants}
+
+    def __iter__(self) -> Iterator[Tenant]:
+        return iter(self._tenants.values())
+
+    def __len__(self) -> int:
+        return len(self._tenants)
+
+    def get(self, name: str) -> Tenant:
+        if name not in self._tenants:
+            raise KeyError(f"Unknown tenant {name!r}, configured tenants: {', '.join(self._tenants)}")
+        return self._tenants[name]
+
+
+def load_tenant_configs(path: Optional[str] = None) -> List[TenantConfig]:
+    """
+    Load tenant configs from the YAML file (TELEGRAM_BOT_TENANTS_CONFIG_PATH by default).
+    Without the file there is one default tenant configured with the environment variables,
+    its thread ids are plain chat ids as before tenants were introduced
+    """
+    path = path or settings.telegram_bot.TENANTS_CONFIG_PATH
+    if not path:
+        return [TenantConfig(
+            name=DEFAULT_TENANT_NAME,
+            token=settings.telegram_bot.TOKEN,
+            webhook_url=settings.telegram_bot.WEBHOOK_URL,
+            webhook_secret_token=settings.telegram_bot.WEBHOOK_SECRET_TOKEN,
+            preload_knowledge_base=True,
+            thread_id_prefix="",
+        )]
+
+    with open(path, encoding="utf-8") as file:
+        data = yaml.safe_load(file) or {}
+    configs = [TenantConfig(**item) for item in data.get("tenants") or []]
+    if not configs:
+        raise ValueError(f"No tenants are configured in {path}")
+    for field in ("name", "token", "thread_id_prefix"):
+        values = [getattr(config, field) for config in configs]
+        if len(set(values)) != len(values):
+            raise ValueError(f"Tenant {field} values must be unique in {path}")
+    if settings.telegram_bot.MODE == "webhook":
+        paths = [config.webhook_path for config in configs]
+        if None in paths:
+            raise ValueError(f"webhook_url of every tenant is required in webhook mode ({path})")
+        if len(set(paths)) != len(paths):
+            raise ValueError(f"Webhook URL paths of tenants must be unique in {path}")
+    return configs
+
+
+def load_tenants(path: Optional[str] = None) -> TenantRegistry:
+    """Load tenant configs and create their knowledge bases and agents"""
+    configs = load_tenant_configs(path)
+    logging.info(f"Loading tenants: {', '.join(config.name for config in configs)}")
+    return TenantRegistry([Tenant(config) for config in configs])
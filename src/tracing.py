@@ -0,0 +1,226 @@
+import logging
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.outputs import LLMResult
+from opentelemetry import context as otel_context
+from opentelemetry import trace
+from opentelemetry.trace import Span, Status, StatusCode
+
+from src.metrics import registry
+from src.settings import settings
+
+
+tracer = trace.get_tracer("allsee-info-bot")
+
+# Durations of all spans are exported as metrics too, so latency breakdown is available without a tracing backend
+span_seconds = registry.histogram(
+    "trace_span_seconds",
+    "Duration of traced operations by span name",
+    ["span"],
+)
+span_errors = registry.counter(
+    "trace_span_errors_total",
+    "Failed traced operations by span name",
+    ["span"],
+)
+llm_tokens = registry.counter(
+    "llm_tokens_total",
+    "Tokens used by LLM calls by model and token type (input, output, cache_read: input tokens served from the provider prompt cache)",
+    ["model", "type"],
+)
+
+
+def setup_tracing() -> None:
+    """Export spans with OTLP if the endpoint is configured, otherwise spans are only used for metrics"""
+    if not settings.tracing.OTLP_ENDPOINT:
+        return
+
+    from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+    from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+    provider = TracerProvider(resource=Resource.create({SERVICE_NAME: settings.tracing.SERVICE_NAME}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=settings.tracing.OTLP_ENDPOINT)))
+    trace.set_tracer_provider(provider)
+    logging.info(f"Exporting traces to {settings.tracing.OTLP_ENDPOINT}")
+
+
+def shutdown_tracing() -> None:
+    """Flush spans which were not exported yet"""
+    provider = trace.get_tracer_provider()
+    if hasattr(provider, "shutdown"):
+        provider.shutdown()
+
+
+def _end_span(span: Span, name: str, started_at: float, error: Optional[BaseException] = None) -> None:
+    if error is not None:
+        span.record_exception(error)
+        span.set_status(Status(StatusCode.ERROR, str(error)))
+        span_errors.inc(span=name)
+    span.end()
+    span_seconds.observe(time.monotonic() - started_at, span=name)
+
+
+@contextmanager
+def traced(name: str, **attributes: Any) -> Iterator[Span]:
+    """Trace the block as a span which is a child of the current span"""
+    started_at = time.monotonic()
+    span = tracer.start_span(name, attributes=attributes)
+    token = otel_context.attach(trace.set_span_in_context(span))
+    error: Optional[BaseException] = None
+    try:
+        yield span
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        otel_context.detach(token)
+        _end_span(span, name, started_at, error)
+
+
+class TracingCallbackHandler(AsyncCallbackHandler):
+    """
+    LangChain callback handler which traces graph nodes, LLM calls, tools and retrievers as spans.
+    Spans are children of the span which was current when the handler was created (e.g. the Telegram update span).
+    Token usage of LLM calls is recorded as span attributes and metrics.
+    """
+
+    def __init__(self) -> None:
+        self._root_context = otel_context.get_current()
+        self._spans: Dict[UUID, tuple[Span, str, float]] = {}
+        self._models: Dict[UUID, str] = {}
+        # Parents of runs which are not traced, so spans are attached to the nearest traced ancestor
+        self._untraced_parents: Dict[UUID, Optional[UUID]] = {}
+
+    def _start(self, run_id: UUID, parent_run_id: Optional[UUID], name: str, **attributes: Any) -> None:
+        while parent_run_id in self._untraced_parents:
+            parent_run_id = self._untraced_parents[parent_run_id]
+        parent = self._spans.get(parent_run_id) if parent_run_id is not None else None
+        parent_context = trace.set_span_in_context(parent[0]) if parent is not None else self._root_context
+        span = tracer.start_span(name, context=parent_context, attributes=attributes)
+        self._spans[run_id] = (span, name, time.monotonic())
+
+    def _end(self, run_id: UUID, error: Optional[BaseException] = None, **attributes: Any) -> None:
+        self._untraced_parents.pop(run_id, None)
+        entry = self._spans.pop(run_id, None)
+        if entry is None:
+            return
+        span, name, started_at = entry
+        span.set_attributes(attributes)
+        _end_span(span, name, started_at, error)
+
+    async def on_chain_start(
+        self,
+        serialized: Dict[str, Any],
+        inputs: Dict[str, Any],
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+        name: Optional[str] = None,
+        **kwargs: Any,
+    ) -> None:
+        node = (metadata or {}).get("langgraph_node")
+        # Only the graph itself and its nodes are traced, not every runnable inside them (and not internal nodes like __start__)
+        if parent_run_id is None:
+            self._start(run_id, parent_run_id, "graph")
+        elif node is not None and name == node and not node.startswith("__"):
+            self._start(run_id, parent_run_id, f"node.{node}", **{"langgraph.step": (metadata or {}).get("langgraph_step", -1)})
+        else:
+            self._untraced_parents[run_id] = parent_run_id
+
+    async def on_chain_end(self, outputs: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id)
+
+    async def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, error)
+
+    async def on_chat_model_start(
+        self,
+        serialized: Dict[str, Any],
+        messages: List[List[Any]],
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> None:
+        model = self._models[run_id] = (metadata or {}).get("ls_model_name") or settings.llm.MODEL
+        self._start(run_id, parent_run_id, "llm", **{"llm.model": model, "llm.messages": len(messages[0]) if messages else 0})
+
+    async def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        model = self._models.pop(run_id, settings.llm.MODEL)
+        # The model router reports the model which answered the request
+        model = _routed_model(response) or model
+        usage = _token_usage(response)
+        for token_type, count in usage.items():
+            llm_tokens.inc(count, model=model, type=token_type)
+        self._end(run_id, **{f"llm.{token_type}_tokens": count for token_type, count in usage.items()})
+
+    async def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._models.pop(run_id, None)
+        self._end(run_id, error)
+
+    async def on_tool_start(
+        self,
+        serialized: Dict[str, Any],
+        input_str: str,
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        **kwargs: Any,
+    ) -> None:
+        self._start(run_id, parent_run_id, f"tool.{kwargs.get('name') or (serialized or {}).get('name', 'unknown')}")
+
+    async def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id)
+
+    async def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, error)
+
+    async def on_retriever_start(
+        self,
+        serialized: Dict[str, Any],
+        query: str,
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        **kwargs: Any,
+    ) -> None:
+        self._start(run_id, parent_run_id, "retriever")
+
+    async def on_retriever_end(self, documents: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, **{"retriever.documents": len(documents)})
+
+    async def on_retriever_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, error)
+
+
+def _routed_model(response: LLMResult) -> Optional[str]:
+    for generations in response.generations:
+        for generation in generations:
+            metadata = getattr(getattr(generation, "message", None), "response_metadata", None) or {}
+            if metadata.get("routed_model"):
+                return metadata["routed_model"]
+    return None
+
+
+def _token_usage(response: LLMResult) -> Dict[str, int]:
+    """Get token usage of the LLM response, it is available in the message usage metadata (also for streamed responses)"""
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                # Input tokens read from the provider prompt cache are also counted in input tokens
+                cached = (usage.get("input_token_details") or {}).get("cache_read", 0)
+                return {"input": usage.get("input_tokens", 0), "output": usage.get("output_tokens", 0), "cache_read": cached}
+    token_usage = (response.llm_output or {}).get("token_usage") or {}
+    if token_usage:
+        cached = (token_usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+        return {"input": token_usage.get("prompt_tokens", 0), "output": token_usage.get("completion_tokens", 0), "cache_read": cached}
+    return {}
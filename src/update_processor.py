@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from src.metrics import registry
+from src.tracing import traced
+
+
+# Metrics which help to size concurrency limit under real load
+updates_waiting = registry.gauge(
+    "bot_updates_waiting",
+    "Number of updates waiting for their chat queue or for a free processing slot",
+)
+updates_active = registry.gauge(
+    "bot_updates_active",
+    "Number of updates being processed right now",
+)
+chat_queues_active = registry.gauge(
+    "bot_chat_queues_active",
+    "Number of chats which have at least one update in processing or waiting",
+)
+update_wait_seconds = registry.histogram(
+    "bot_update_wait_seconds",
+    "Time between receiving an update and starting its processing",
+)
+update_processing_seconds = registry.histogram(
+    "bot_update_processing_seconds",
+    "Time spent processing an update",
+)
+updates_superseded = registry.counter(
+    "bot_updates_superseded_total",
+    "Updates whose processing was cancelled by a newer update from the same chat",
+)
+
+
+class _ChatQueue:
+    """Per-chat lock with a counter of updates which are waiting for it"""
+    __slots__ = ("lock", "pending", "superseding", "supersedable")
+
+    def __init__(self) -> None:
+        # asyncio.Lock wakes up waiters in FIFO order, so updates for the same chat keep their order
+        self.lock = asyncio.Lock()
+        self.pending = 0
+        # Number of waiting updates which supersede the processed one
+        self.superseding = 0
+        # Task processing the current update if a newer update may cancel it
+        self.supersedable: Optional[asyncio.Task] = None
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Update processor which processes updates from different chats concurrently
+    and updates from the same chat (same graph thread_id) strictly in order.
+
+    Updates first wait for their chat queue and only then for a global processing slot,
+    so a chat which sent a burst of messages doesn't occupy slots needed by other chats.
+    The total number of updates held by the processor (waiting + processing) is bounded by max_pending_updates.
+
+    Updates matching `supersedes` (e.g. new user messages) cancel processing of the current update of their chat
+    if its handler marked it supersedable with set_supersedable (e.g. because it hasn't replied yet).
+    """
+
+    def __init__(
+        self,
+        max_concurrent_updates: int,
+        max_pending_updates: Optional[int] = None,
+        supersedes: Optional[Callable[[object], Any]] = None,
+    ) -> None:
+        # Base class semaphore bounds all updates held by the processor, our own semaphore bounds processing
+        max_pending_updates = max(max_pending_updates or max_concurrent_updates * 16, max_concurrent_updates)
+        super().__init__(max_pending_updates)
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        self._processing_limit = max_concurrent_updates
+        self._processing_semaphore = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._chat_queues: Dict[str, _ChatQueue] = {}
+        self._supersedes = supersedes
+
+    @property
+    def processing_limit(self) -> int:
+        """Maximum number of updates which can be processed at the same time"""
+        return self._processing_limit
+
+    @staticmethod
+    def get_thread_id(update: object) -> Optional[str]:
+        """Get the key used to order updates. It matches thread_id used for graph checkpoints"""
+        if isinstance(update, Update) and update.effective_chat is not None:
+            return str(update.effective_chat.id)
+        return None
+
+    @asynccontextmanager
+    async def _chat_queue(self, thread_id: Optional[str], supersedes: bool) -> AsyncIterator[Optional[_ChatQueue]]:
+        """Wait for our turn in the chat queue. Updates without chat are not ordered"""
+        if thread_id is None:
+            yield None
+            return
+
+        queue = self._chat_queues.get(thread_id)
+        if queue is None:
+            queue = self._chat_queues[thread_id] = _ChatQueue()
+            chat_queues_active.set(len(self._chat_queues))
+        queue.pending += 1
+        if supersedes:
+            queue.superseding += 1
+            self._cancel_supersedable(queue)
+        try:
+            async with queue.lock:
+                if supersedes:
+                    queue.superseding -= 1
+                    supersedes = False
+                yield queue
+        finally:
+            if supersedes:
+                queue.superseding -= 1
+            queue.pending -= 1
+            if queue.pending == 0:
+                del self._chat_queues[thread_id]
+                chat_queues_active.set(len(self._chat_queues))
+
+    @staticmethod
+    def _cancel_supersedable(queue: _ChatQueue) -> None:
+        if queue.supersedable is not None:
+            queue.supersedable.cancel()
+            queue.supersedable = None
+            updates_superseded.inc()
+
+    def set_supersedable(self, update: object, supersedable: bool) -> None:
+        """
+        Allow or forbid newer updates from the chat to cancel processing of the update. Must be called by its handler.
+        If a superseding update is already waiting, the handler is cancelled at once
+        """
+        queue = self._chat_queues.get(self.get_thread_id(update))
+        if queue is None:
+            return
+        queue.supersedable = asyncio.current_task() if supersedable else None
+        if supersedable and queue.superseding:
+            self._cancel_supersedable(queue)
+
+    async def _process(self, coroutine: Awaitable[Any], queue: Optional[_ChatQueue]) -> None:
+        """Process the update in its own task, so a newer update can cancel it without cancelling the processor"""
+        if self._supersedes is None or queue is None:
+            await coroutine
+            return
+        task = asyncio.ensure_future(coroutine)
+        try:
+            await asyncio.wait([task])
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            if queue.supersedable is task:
+                queue.supersedable = None
+        # Cancelled task was superseded, errors of the handler are raised as usual
+        if not task.cancelled():
+            task.result()
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        """Process update after all previous updates from the same chat are processed and a processing slot is free"""
+        received_at = time.monotonic()
+        updates_waiting.inc()
+        waiting = True
+        thread_id = self.get_thread_id(update)
+        supersedes = self._supersedes is not None and bool(self._supersedes(update))
+        try:
+            async with self._chat_queue(thread_id, supersedes) as queue:
+                async with self._processing_semaphore:
+                    waiting = False
+                    updates_waiting.dec()
+                    started_at = time.monotonic()
+                    update_wait_seconds.observe(started_at - received_at)
+                    updates_active.inc()
+                    try:
+                        # Root span of the update, spans of the handler, graph and tools are its children
+                        with traced("telegram.update", **{"telegram.chat_id": thread_id or "", "telegram.wait_seconds": started_at - received_at}):
+                            await self._process(coroutine, queue)
+                    finally:
+                        updates_active.dec()
+                        update_processing_seconds.observe(time.monotonic() - started_at)
+        finally:
+            if waiting:
+                updates_waiting.dec()
+                # Coroutine was never awaited (e.g. task was cancelled on shutdown), close it to avoid warnings
+                if asyncio.iscoroutine(coroutine):
+                    coroutine.close()
+
+    async def initialize(self) -> None:
+        """Nothing to initialize, all state is created lazily"""
+        logging.info(
+            f"Update processor: up to {self._processing_limit} updates in processing, "
+            f"up to {self.max_concurrent_updates} updates in total"
+        )
+
+    async def shutdown(self) -> None:
+        """Nothing to shut down, queues are released by the updates which hold them"""
+        if self._chat_queues:
+            logging.warning(f"Update processor is shutting down with {len(self._chat_queues)} active chat queues")